@@ -1,3 +1,25 @@
 # flake8: noqa: F401
 
-from ckanext.dbquery.actions.dbquery import query_database, dbquery_executed_list, dbquery_executor_users_list
+from ckanext.dbquery.actions.dbquery import (
+    query_database,
+    dbquery_executed_list,
+    dbquery_executed_stats,
+    dbquery_fingerprint_stats,
+    dbquery_executor_users_list,
+    dbquery_running_list,
+    dbquery_cancel,
+    dbquery_activity,
+    dbquery_schema,
+    dbquery_slot_usage,
+    dbquery_job_status,
+    dbquery_job_result,
+    dbquery_pool_stats,
+)
+from ckanext.dbquery.actions.saved import (
+    dbquery_saved_create,
+    dbquery_saved_update,
+    dbquery_saved_delete,
+    dbquery_saved_list,
+    dbquery_saved_show,
+    dbquery_saved_refresh,
+)
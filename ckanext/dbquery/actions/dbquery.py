@@ -1,8 +1,14 @@
 import logging
 import datetime
-from ckanext.dbquery.model import DBQueryExecuted
-from sqlalchemy.sql.expression import text
-from sqlalchemy import func
+import json
+import time
+from ckanext.dbquery import activity, admission, audit, execution, registry, schema, search, serialize, sql, timing
+from ckanext.dbquery.cache import result_cache
+from ckanext.dbquery.explain import EXPLAIN_MODES, explain
+from ckanext.dbquery.jobs import run_query_job
+from ckanext.dbquery.model import DBQueryExecuted, DBQueryJob
+from ckanext.dbquery.schema import schema_cache
+from sqlalchemy import exists, func, tuple_
 from ckan import model
 from ckan.plugins import toolkit
 
@@ -10,79 +16,547 @@ from ckan.plugins import toolkit
 log = logging.getLogger(__name__)
 
 
-def query_database(context, data_dict):
-    """Execute a database query and return the results using CKAN's session."""
-    toolkit.check_access('query_database', context, data_dict)
+def _get_int(data_dict, key, default):
+    """ Read a non negative integer from the data_dict """
+    value = data_dict.get(key)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({key: ['Must be an integer']})
+    if value < 0:
+        raise toolkit.ValidationError({key: ['Must be a positive integer']})
+    return value
 
-    query = data_dict.get('query')
-    # Use CKAN's SQLAlchemy session
-    engine = model.meta.engine
 
+def _page_message(offset, rows, has_more, truncated, max_rows, page=None, max_bytes=0):
+    if offset or has_more or truncated:
+        message = f"Showing rows {offset + 1} to {offset + len(rows)}"
+    else:
+        message = f"Query returned {len(rows)} rows"
+    if page and page.capped:
+        message += f". Results are limited to {max_bytes} bytes, {len(rows)} rows ({page.size} bytes) were read"
+    elif truncated:
+        message += f". Results are limited to {max_rows} rows"
+    return message
+
+
+def _enqueue_query(data_dict, user_id):
+    """ Create a DBQueryJob and send the query to the background jobs queue """
+    job = DBQueryJob(query=data_dict['query'], user_id=user_id).save()
+    job_data_dict = dict(data_dict)
+    job_data_dict.pop('async', None)
+    toolkit.enqueue_job(
+        run_query_job,
+        [job.id, job_data_dict],
+        title=f'DBQuery job {job.id}',
+        rq_kwargs={'timeout': toolkit.config.get('ckanext.dbquery.job_timeout')},
+    )
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "message": "Query sent to the background jobs queue",
+    }
+
+
+def _query_options(data_dict):
+    """ Validate and read the query_database parameters """
+    max_rows = toolkit.config.get('ckanext.dbquery.max_rows')
+    offset = _get_int(data_dict, 'offset', 0)
+    limit = _get_int(data_dict, 'limit', toolkit.config.get('ckanext.dbquery.page_size'))
+    if offset >= max_rows:
+        raise toolkit.ValidationError({'offset': [f'Must be lower than {max_rows}']})
+
+    explain_mode = data_dict.get('explain')
+    if explain_mode and explain_mode not in EXPLAIN_MODES:
+        raise toolkit.ValidationError({'explain': [f'Must be one of {", ".join(EXPLAIN_MODES)}']})
+
+    fmt = data_dict.get('format') or serialize.RECORDS
+    if fmt not in serialize.FORMATS:
+        raise toolkit.ValidationError({'format': [f'Must be one of {", ".join(serialize.FORMATS)}']})
+
+    params = data_dict.get('params') or {}
+    if not isinstance(params, dict):
+        raise toolkit.ValidationError({'params': ['Must be a dictionary of parameter names and values']})
+
+    return {
+        'offset': offset,
+        'limit': limit,
+        # Never read past the hard cap
+        'fetch_limit': min(limit, max_rows - offset),
+        'max_rows': max_rows,
+        'max_bytes': toolkit.config.get('ckanext.dbquery.max_result_bytes'),
+        'timeout': _get_int(data_dict, 'timeout', toolkit.config.get('ckanext.dbquery.statement_timeout')),
+        'explain': explain_mode,
+        'cache': toolkit.asbool(data_dict.get('cache', True)),
+        'params': params,
+        'format': fmt,
+    }
+
+
+def _elapsed(started):
+    """ Milliseconds since a time.perf_counter() value """
+    return round((time.perf_counter() - started) * 1000, 3)
+
+
+def _save_executed(query, user_id, started, metrics):
+    """ Save the executed query with its metrics in the audit table """
+    audit.record(
+        query=query,
+        user_id=user_id,
+        duration_total=_elapsed(started),
+        **metrics
+    )
+
+
+def _explain_query(query, options, user_id, metrics):
+    """ Run EXPLAIN for a query and build the query_database response """
+    mode = options['explain']
+    started = time.perf_counter()
     try:
-        text_sql = text(query)
-        result = engine.execute(text_sql)
+        resp = explain(query, mode, timeout=options['timeout'], user_id=user_id, params=options['params'])
+    except Exception as e:
+        log.critical(f"Error explaining query {query}: {e}")
+        metrics.update(status=execution.error_status(e), error=str(e))
+        raise toolkit.ValidationError({"query": f"Invalid Query: {e}"})
+    metrics['duration_execute'] = _elapsed(started)
+
+    resp['explain'] = mode
+    resp['message'] = f"Query plan ({mode})"
+    return resp
+
+
+def _run_query(query, options, user_id, metrics, timer):
+    """ Execute a query and build the query_database response """
+    offset = options['offset']
+    fetch_limit = options['fetch_limit']
+    max_rows = options['max_rows']
+    rows = []
+    colnames = []
+    has_more = False
+    truncated = False
+    capped = False
+    result_bytes = 0
+    started = time.perf_counter()
+    try:
+        # Row returning statements run on a server-side cursor so only
+        # the requested page travels from the database,
+        stream = sql.is_select(query)
+        # and on the read engine, if there is one
+        with execution.execute(
+            query, stream=stream, params=options['params'], read_only=stream,
+            timeout=options['timeout'], user_id=user_id,
+        ) as result:
+            metrics['duration_execute'] = _elapsed(started)
+            started = time.perf_counter()
+            # Delete or update queries don't return results
+            if result.returns_rows:
+                colnames = list(result.keys())
+                page = execution.fetch_page(result, offset, fetch_limit, max_bytes=options['max_bytes'])
+                rows, capped, result_bytes = page.rows, page.capped, page.size
+                if stream:
+                    truncated = capped or (page.has_more and offset + fetch_limit >= max_rows)
+                    has_more = page.has_more and not truncated
+                else:
+                    # RETURNING rows of a write: the next page would run it again
+                    truncated = page.has_more
+                    max_rows = fetch_limit
+                message = _page_message(
+                    offset, rows, has_more, truncated, max_rows, page=page, max_bytes=options['max_bytes'],
+                )
+                metrics['row_count'] = len(rows)
+            else:
+                message = f"Query affected {result.rowcount} rows"
+                metrics['row_count'] = result.rowcount
     except Exception as e:
         log.critical(f"Error executing query {query}: {e}")
+        metrics.update(status=execution.error_status(e), error=str(e))
         raise toolkit.ValidationError({"query": f"Invalid Query: {e}"})
+    metrics['duration_fetch'] = _elapsed(started)
+    metrics['result_bytes'] = result_bytes
 
-    # Check if it's a SELECT query that returns rows
-    has_results = result.returns_rows
-    # Delete or update queries don't return results
-    if has_results:
-        rows = result.fetchall()
-        colnames = result.keys()
-        message = f"Query returned {len(rows)} rows"
+    with timer.phase('serialize'):
+        data = serialize.shape(colnames, rows, options['format'])
+    return dict(
+        data,
+        kind=sql.classify(query),
+        colnames=colnames,
+        message=message,
+        has_more=has_more,
+        truncated=truncated,
+        bytes_capped=capped,
+        result_bytes=result_bytes,
+    )
+
+
+def _run_statement(conn, statement, kind, options, max_bytes=0):
+    """ Run one statement of a script and build its result, with at most `max_bytes` of rows """
+    started = time.perf_counter()
+    result = execution.run(conn, statement, stream=kind == sql.SELECT, params=options['params'])
+    page = execution.Page([], False, 0, False)
+    colnames = []
+    if result.returns_rows:
+        colnames = list(result.keys())
+        page = execution.fetch_page(result, 0, options['max_rows'], max_bytes=max_bytes)
+        # Close the server-side cursor before running the next statement
+        result.close()
+        rowcount = len(page.rows)
+        message = f"Statement returned {rowcount} rows"
+        if page.capped:
+            message += f", limited to {max_bytes} bytes"
     else:
-        rows = []
-        colnames = []
-        message = f"Query affected {result.rowcount} rows"
+        rowcount = result.rowcount
+        message = f"Statement affected {rowcount} rows"
+
+    return dict(
+        serialize.shape(colnames, page.rows, options['format']),
+        query=statement,
+        kind=kind,
+        colnames=colnames,
+        rowcount=rowcount,
+        truncated=page.has_more,
+        bytes_capped=page.capped,
+        message=message,
+        duration=_elapsed(started),
+    ), page.size
+
+
+def _run_script(query, statements, options, user_id, metrics):
+    """
+    Run all the statements of a script on one connection, in a single
+    transaction, and build the query_database response with a result
+    per statement. Read-only scripts run in a READ ONLY transaction.
+    """
+    kinds = [sql.classify(statement) for statement in statements]
+    read_only = all(kind == sql.SELECT for kind in kinds)
+    results = []
+    result_bytes = 0
+    started = time.perf_counter()
+    try:
+        with execution.connect(
+            query, timeout=options['timeout'], user_id=user_id,
+            read_only=read_only, read_only_transaction=read_only,
+        ) as conn:
+            for statement, kind in zip(statements, kinds):
+                # The byte limit applies to the rows of the whole script
+                remaining = options['max_bytes'] and max(options['max_bytes'] - result_bytes, 1)
+                statement_result, size = _run_statement(conn, statement, kind, options, max_bytes=remaining)
+                results.append(statement_result)
+                result_bytes += size
+    except Exception as e:
+        log.critical(f"Error executing statement {len(results) + 1} of script {query}: {e}")
+        metrics.update(status=execution.error_status(e), error=str(e))
+        raise toolkit.ValidationError({"query": f"Invalid Query (statement {len(results) + 1}): {e}"})
+
+    if not read_only:
+        # The script may have changed the data behind cached results
+        result_cache.invalidate()
+    if sql.DDL in kinds:
+        schema_cache.invalidate()
+    metrics.update(
+        duration_execute=_elapsed(started),
+        row_count=sum(r['rowcount'] for r in results if r['rowcount'] > 0),
+        result_bytes=result_bytes,
+    )
+
+    # The top level rows are the ones of the last statement returning rows
+    last = next((r for r in reversed(results) if r['colnames']), None)
+    top = serialize.shape([], [], options['format'])
+    if last:
+        top = {key: last[key] for key in top}
+    message = f"Script with {len(statements)} statements executed"
+    if read_only:
+        message += " in a read-only transaction"
+    return dict(
+        top,
+        colnames=last['colnames'] if last else [],
+        message=message,
+        has_more=False,
+        truncated=any(r['truncated'] for r in results),
+        bytes_capped=any(r['bytes_capped'] for r in results),
+        result_bytes=result_bytes,
+        read_only=read_only,
+        statements=results,
+    )
+
+
+def _cached_query(query, options, user_id, metrics, timer):
+    """ Return the query_database response from the result cache, or run the query """
+    cache_ttl = toolkit.config.get('ckanext.dbquery.cache_ttl')
+    read_only = sql.is_select(query)
+    use_cache = bool(cache_ttl) and read_only and options['cache']
+    cache_key = (
+        sql.normalize(query),
+        json.dumps(options['params'], sort_keys=True, default=str),
+        options['offset'],
+        options['fetch_limit'],
+        options['max_rows'],
+        options['format'],
+    )
+
+    cached = result_cache.get(cache_key, cache_ttl) if use_cache else None
+    if cached:
+        resp, cache_age = cached
+        metrics['row_count'] = serialize.count(resp)
+        return dict(resp, cached=True, cache_age=round(cache_age, 3))
 
-    # Save executed query
+    resp = _run_query(query, options, user_id, metrics, timer)
+    if not read_only:
+        # The statement may have changed the data behind cached results
+        result_cache.invalidate()
+        if sql.classify(query) == sql.DDL:
+            schema_cache.invalidate()
+    elif use_cache:
+        max_bytes = toolkit.config.get('ckanext.dbquery.cache_max_bytes')
+        result_cache.set(cache_key, resp, metrics['result_bytes'], max_bytes)
+    return dict(resp, cached=False, cache_age=0)
+
+
+def query_database(context, data_dict):
+    """
+    Execute a database query and return one page of the results.
+
+    :param query: the SQL statement to run, or a script with several
+        statements separated by semicolons
+    :param format: shape of the rows in the response: `records` (a dict
+        per row), `rows` (a list of values per row, in the `colnames`
+        order) or `columns` (a list of values per column, returned in
+        `columns` instead of `rows`). `rows` and `columns` don't repeat
+        the column names on every row and return JSON-safe values
+        (optional, default: `records`)
+    :param params: values for the `:name` bind parameters of the query,
+        e.g. ``{"name": "test"}`` for ``SELECT * FROM package WHERE name = :name``
+        (optional)
+    :param limit: max number of rows to return
+        (optional, default: ``ckanext.dbquery.page_size``)
+    :param offset: number of rows to skip, only for SELECT queries
+        (optional, default: 0)
+    :param timeout: statement timeout in milliseconds, 0 for no timeout
+        (optional, default: ``ckanext.dbquery.statement_timeout``)
+    :param async: run the query as a background job and return its `job_id`
+        at once. Use dbquery_job_status and dbquery_job_result to get the
+        results (optional, default: False)
+    :param cache: use the result cache for read-only queries
+        (optional, default: True)
+    :param explain: return the query plan instead of the results. One of
+        `plain` (EXPLAIN), `analyze` (EXPLAIN ANALYZE) or `buffers`
+        (EXPLAIN ANALYZE with BUFFERS). ANALYZE runs in a transaction that
+        is rolled back (optional)
+
+    Only the requested page (plus one row to know if there are more) is
+    fetched from the database, in chunks. No row beyond
+    ``ckanext.dbquery.max_rows`` is ever returned, results reaching that cap
+    are flagged as `truncated`. Fetching also stops before the rows go over
+    ``ckanext.dbquery.max_result_bytes``: the rows read so far are returned,
+    flagged as `truncated` and `bytes_capped`. `result_bytes` is the
+    approximate size of the returned rows.
+
+    When ``ckanext.dbquery.cache_ttl`` is set, SELECT results are cached and
+    the response tells if it was `cached` and the `cache_age` in seconds.
+    Any other statement clears the cache.
+
+    Scripts run all their statements on one connection in a single
+    transaction (READ ONLY if they only have SELECT statements) and return
+    a result per statement in `statements`, with its `kind` (select, dml,
+    ddl or utility), rows (up to ``ckanext.dbquery.max_rows``), row count
+    and duration. Paging and the result cache don't apply to scripts.
+
+    Statements with parameters that don't return rows from a server-side
+    cursor (INSERT, UPDATE, DELETE...) run as server-side prepared
+    statements, so repeated executions with different values are planned
+    once per database connection. Up to
+    ``ckanext.dbquery.prepared_cache_size`` prepared statements are kept
+    per connection. SELECT queries are streamed, with their values bound.
+
+    Every execution, including failed ones, is saved in the audit table
+    with its durations, row count, result size and status. The response
+    has the `timings` of each phase in milliseconds: `queue` (waiting for
+    an execution slot), `execute`, `fetch`, `serialize` (building the rows
+    of the response), `audit` and `total`.
+
+    With ``ckanext.dbquery.max_concurrent`` or
+    ``ckanext.dbquery.max_concurrent_per_user`` set, queries wait up to
+    ``ckanext.dbquery.queue_timeout`` seconds for a free execution slot
+    and are rejected with a ValidationError if none is freed in time.
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    query = data_dict.get('query')
+    if not query:
+        raise toolkit.ValidationError({'query': 'Missing value'})
+    options = _query_options(data_dict)
+    if options['offset'] and not sql.is_select(query):
+        raise toolkit.ValidationError({'offset': ['Only the results of a SELECT query can be paged']})
     user_obj = context.get('auth_user_obj')
     user_id = user_obj.id
-    executed = DBQueryExecuted(
-        query=query,
-        user_id=user_id
-    )
-    executed.save()
+    if toolkit.asbool(data_dict.get('async')):
+        return _enqueue_query(data_dict, user_id)
 
-    resp = {
-        "rows": [dict(zip(colnames, row)) for row in rows],
-        "colnames": colnames,
-        "message": message,
-    }
+    statements = sql.split_statements(query)
+    if options['explain'] and len(statements) > 1:
+        raise toolkit.ValidationError({'explain': ['Only a single statement can be explained']})
+
+    metrics = {'status': 'ok'}
+    timer = timing.Timer()
+    with timer.phase('queue'):
+        slot = admission.acquire(user_id)
+    started = time.perf_counter()
+    try:
+        if options['explain']:
+            resp = _explain_query(query, options, user_id, metrics)
+        elif len(statements) > 1:
+            resp = _run_script(query, statements, options, user_id, metrics)
+        else:
+            resp = _cached_query(query, options, user_id, metrics, timer)
+    finally:
+        slot.release()
+        timer.add('execute', metrics.get('duration_execute'))
+        timer.add('fetch', metrics.get('duration_fetch'))
+        # Save executed query
+        with timer.phase('audit'):
+            _save_executed(query, user_id, started, metrics)
+        timer.add('total', _elapsed(started))
+        timing.log_execution(query, user_id, metrics['status'], metrics.get('row_count'), timer.as_dict())
+
+    if not options['explain']:
+        resp.update({
+            "offset": options['offset'],
+            "limit": options['limit'],
+        })
+    resp['timings'] = timer.as_dict()
 
     return resp
 
 
+def _get_float(data_dict, key):
+    value = data_dict.get(key)
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({key: ['Must be a number']})
+
+
+def _get_date(data_dict, key):
+    """ Read a YYYY-MM-DD date from the data_dict as a datetime """
+    value = data_dict.get(key)
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({key: ['Must be a date in the format YYYY-MM-DD']})
+
+
+def _get_cursor(data_dict, key):
+    """ Read a `<timestamp>,<id>` keyset pagination cursor """
+    value = data_dict.get(key)
+    if not value:
+        return None
+    try:
+        timestamp, query_id = value.split(',', 1)
+        return datetime.datetime.fromisoformat(timestamp), query_id
+    except (AttributeError, ValueError):
+        raise toolkit.ValidationError({key: ['Invalid cursor']})
+
+
+def _filter_executed(queries, data_dict):
+    """ Apply the dbquery_executed_list filters to a DBQueryExecuted query """
+    user_filter = data_dict.get('user')
+    search_terms = search.terms(data_dict.get('q'))
+    if search_terms and max(len(term) for term in search_terms) < search.MIN_TERM_LENGTH:
+        # The trigram index can't serve them, and a full scan of the audit table is slow
+        raise toolkit.ValidationError(
+            {'q': [f'At least one search term must have {search.MIN_TERM_LENGTH} or more characters']}
+        )
+    status_filter = data_dict.get('status')
+    min_duration = _get_float(data_dict, 'min_duration')
+    max_duration = _get_float(data_dict, 'max_duration')
+    from_date = _get_date(data_dict, 'from')
+    to_date = _get_date(data_dict, 'to')
+    date_filter = _get_date(data_dict, 'date')
+    if date_filter:
+        # Queries from that exact date
+        from_date = to_date = date_filter
+
+    if user_filter:
+        queries = queries.filter(DBQueryExecuted.user_id == user_filter)
+    if data_dict.get('fingerprint'):
+        queries = queries.filter(DBQueryExecuted.fingerprint == data_dict['fingerprint'])
+
+    # Compare the raw column with a range so the timestamp indexes can be used
+    if from_date:
+        queries = queries.filter(DBQueryExecuted.timestamp >= from_date)
+    if to_date:
+        queries = queries.filter(DBQueryExecuted.timestamp < to_date + datetime.timedelta(days=1))
+
+    # Each term is matched anywhere in the query, served by the trigram index
+    for term in search_terms:
+        queries = queries.filter(DBQueryExecuted.query.ilike(search.like_pattern(term), escape='\\'))
+
+    if status_filter:
+        queries = queries.filter(DBQueryExecuted.status == status_filter)
+    if min_duration is not None:
+        queries = queries.filter(DBQueryExecuted.duration_total >= min_duration)
+    if max_duration is not None:
+        queries = queries.filter(DBQueryExecuted.duration_total <= max_duration)
+
+    return queries
+
+
 @toolkit.side_effect_free
 def dbquery_executed_list(context, data_dict):
     """
-    Return a list of all executed queries ordered by timestamp descending
+    Return a list of executed queries, newest first
+
+    :param user: only queries run by this user id (optional)
+    :param fingerprint: only queries with this fingerprint, as returned by
+        dbquery_fingerprint_stats (optional)
+    :param q: only queries containing all these space separated terms,
+        case insensitive (optional)
+    :param from: only queries run on or after this day, YYYY-MM-DD (optional)
+    :param to: only queries run on or before this day, YYYY-MM-DD (optional)
+    :param date: only queries run on this day, YYYY-MM-DD (optional)
+    :param status: only queries with this status: ok, error, timeout
+        or cancelled (optional)
+    :param min_duration: only queries that took at least these
+        milliseconds (optional)
+    :param max_duration: only queries that took at most these
+        milliseconds (optional)
+    :param sort: `timestamp` (newest first) or `duration` (slowest first)
+        (optional, default: timestamp)
+    :param before: keyset pagination cursor, only queries older than this
+        `<timestamp>,<id>` pair, usually the ones of the last query of the
+        previous page. Only valid when sorting by timestamp (optional)
+    :param limit: max number of queries to return
+        (optional, default: ``ckanext.dbquery.history_page_size``)
     """
     # Check if user is authorized
     toolkit.check_access('query_database', context, data_dict)
 
-    # Get filter parameters
-    user_filter = data_dict.get('user')
-    date_filter = data_dict.get('date')
-    limit = int(data_dict.get('limit', 10))
+    limit = _get_int(data_dict, 'limit', toolkit.config.get('ckanext.dbquery.history_page_size'))
+    sort = data_dict.get('sort') or 'timestamp'
+    if sort not in ('timestamp', 'duration'):
+        raise toolkit.ValidationError({'sort': ['Must be timestamp or duration']})
+    before = _get_cursor(data_dict, 'before')
+    if before and sort != 'timestamp':
+        raise toolkit.ValidationError({'before': ['Can only be used when sorting by timestamp']})
 
     # Get all executed queries
     queries = model.Session.query(DBQueryExecuted)
 
     # Apply filters if provided
-    if user_filter:
-        queries = queries.filter(DBQueryExecuted.user_id == user_filter)
-
-    if date_filter:
-        # date_filter is a string in the format YYYY-MM-DD
-        # we want queries from that exact date
-        date_obj = datetime.datetime.strptime(date_filter, "%Y-%m-%d").date()
-        # Use PostgreSQL's DATE function to extract just the date part
-        queries = queries.filter(func.date(DBQueryExecuted.timestamp) == date_obj)
+    queries = _filter_executed(queries, data_dict)
 
-    queries = queries.order_by(DBQueryExecuted.timestamp.desc())
+    if sort == 'duration':
+        queries = queries.order_by(DBQueryExecuted.duration_total.desc().nullslast())
+    else:
+        if before:
+            # Row comparison, served by the (timestamp DESC, id DESC) indexes
+            queries = queries.filter(tuple_(DBQueryExecuted.timestamp, DBQueryExecuted.id) < before)
+        queries = queries.order_by(DBQueryExecuted.timestamp.desc(), DBQueryExecuted.id.desc())
     if limit:
         queries = queries.limit(limit)  # Use SQLAlchemy's limit() method instead of Python slicing
 
@@ -93,19 +567,133 @@ def dbquery_executed_list(context, data_dict):
     return result
 
 
+@toolkit.side_effect_free
+def dbquery_executed_stats(context, data_dict):
+    """
+    Return daily latency stats of the executed queries, newest day first:
+    number of queries and p50, p95 and max total duration in milliseconds
+
+    Accepts the same filters as dbquery_executed_list.
+
+    :param days: number of days to include (optional, default: 30)
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    days = _get_int(data_dict, 'days', 30)
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    duration = DBQueryExecuted.duration_total
+    day = func.date_trunc('day', DBQueryExecuted.timestamp).label('day')
+
+    stats = model.Session.query(
+        day,
+        func.count().label('count'),
+        func.percentile_cont(0.5).within_group(duration.asc()).label('p50'),
+        func.percentile_cont(0.95).within_group(duration.asc()).label('p95'),
+        func.max(duration).label('max'),
+    ).filter(DBQueryExecuted.timestamp >= since)
+    stats = _filter_executed(stats, data_dict)
+    stats = stats.group_by(day).order_by(day.desc())
+
+    return [
+        {
+            'day': row.day.date().isoformat(),
+            'count': row.count,
+            'p50': row.p50,
+            'p95': row.p95,
+            'max': row.max,
+        }
+        for row in stats.all()
+    ]
+
+
+FINGERPRINT_SORTS = ('calls', 'total', 'mean', 'p95', 'rows')
+
+
+@toolkit.side_effect_free
+def dbquery_fingerprint_stats(context, data_dict):
+    """
+    Aggregate the executed queries by fingerprint (the query with its
+    constants replaced by `?`): number of calls, total, mean and p95
+    duration in milliseconds, total and mean rows and last execution,
+    heaviest first
+
+    Accepts the same filters as dbquery_executed_list.
+
+    :param days: number of days to include (optional, default: 30)
+    :param sort: `calls`, `total`, `mean`, `p95` or `rows`
+        (optional, default: total)
+    :param limit: max number of fingerprints to return (optional, default: 50)
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    days = _get_int(data_dict, 'days', 30)
+    limit = _get_int(data_dict, 'limit', 50)
+    sort = data_dict.get('sort') or 'total'
+    if sort not in FINGERPRINT_SORTS:
+        raise toolkit.ValidationError({'sort': [f'Must be one of {", ".join(FINGERPRINT_SORTS)}']})
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    duration = DBQueryExecuted.duration_total
+    fingerprint = DBQueryExecuted.fingerprint
+
+    aggregates = {
+        'calls': func.count(),
+        'total': func.sum(duration),
+        'mean': func.avg(duration),
+        'p95': func.percentile_cont(0.95).within_group(duration.asc()),
+        'rows': func.sum(DBQueryExecuted.row_count),
+    }
+
+    # Grouped over the (fingerprint, timestamp) index, only on the partitions of the time window
+    stats = model.Session.query(
+        fingerprint.label('fingerprint'),
+        *[aggregate.label(name) for name, aggregate in aggregates.items()],
+        func.avg(DBQueryExecuted.row_count).label('mean_rows'),
+        func.max(DBQueryExecuted.timestamp).label('last'),
+    ).filter(DBQueryExecuted.timestamp >= since, fingerprint.isnot(None))
+    stats = _filter_executed(stats, data_dict)
+    stats = stats.group_by(fingerprint).order_by(aggregates[sort].desc().nullslast())
+    if limit:
+        stats = stats.limit(limit)
+    rows = stats.all()
+
+    # The latest query of each fingerprint shows its normalized text
+    samples = dict(
+        model.Session.query(fingerprint, DBQueryExecuted.query)
+        .filter(fingerprint.in_([row.fingerprint for row in rows]), DBQueryExecuted.timestamp >= since)
+        .order_by(fingerprint, DBQueryExecuted.timestamp.desc())
+        .distinct(fingerprint)
+        .all()
+    ) if rows else {}
+
+    return [
+        {
+            'fingerprint': row.fingerprint,
+            'query': sql.fingerprint_text(samples.get(row.fingerprint)),
+            'calls': row.calls,
+            'total': row.total,
+            'mean': float(row.mean) if row.mean is not None else None,
+            'p95': row.p95,
+            'rows': row.rows,
+            'mean_rows': float(row.mean_rows) if row.mean_rows is not None else None,
+            'last': row.last.isoformat(),
+        }
+        for row in rows
+    ]
+
+
 @toolkit.side_effect_free
 def dbquery_executor_users_list(context, data_dict):
     """ Get a list of users that have executed queries """
     # Check if user is authorized
     toolkit.check_access('query_database', context, data_dict)
 
-    # Get distinct users with names by joining with the user table
+    # A semi-join probing the (user_id, timestamp) index once per user,
+    # instead of a DISTINCT over the whole audit table
+    executed = exists().where(DBQueryExecuted.user_id == model.User.id)
     query = model.Session.query(
         model.User.id.label('id'),
         model.User.name.label('name')
-    ).join(
-        DBQueryExecuted, DBQueryExecuted.user_id == model.User.id
-    ).distinct()
+    ).filter(executed).order_by(model.User.name)
 
     # Convert to list of user dictionaries
     result = [
@@ -114,3 +702,189 @@ def dbquery_executor_users_list(context, data_dict):
     ]
 
     return result
+
+
+@toolkit.side_effect_free
+def dbquery_running_list(context, data_dict):
+    """ List the statements currently running in this CKAN process, oldest first """
+    toolkit.check_access('query_database', context, data_dict)
+
+    result = []
+    for entry in registry.running():
+        entry['started'] = entry['started'].isoformat()
+        result.append(entry)
+
+    return result
+
+
+def dbquery_cancel(context, data_dict):
+    """
+    Cancel a running statement with pg_cancel_backend, or terminate its
+    backend with pg_terminate_backend
+
+    :param id: the id of the statement, as returned by dbquery_running_list
+    :param pid: the pid of any backend of CKAN's database, as returned by
+        dbquery_activity, instead of `id`. Other pids, and backends this
+        database role isn't allowed to signal, raise a ValidationError
+    :param terminate: close the backend's connection instead of only
+        cancelling its statement (optional, default: False)
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    terminate = toolkit.asbool(data_dict.get('terminate', False))
+    action = 'Terminating' if terminate else 'Cancelling'
+    if data_dict.get('pid') and not data_dict.get('id'):
+        pid = _get_int(data_dict, 'pid', None)
+        with model.meta.engine.connect() as conn:
+            if not activity.is_backend(conn, pid):
+                raise toolkit.ValidationError({'pid': [f'{pid} is not a backend of the database']})
+        log.info(f"{action} backend {pid}")
+        try:
+            done = execution.cancel(pid, terminate=terminate)
+        except Exception as e:
+            # E.g. a backend of another role, without pg_signal_backend
+            log.error(f"Error {action.lower()} backend {pid}: {e}")
+            raise toolkit.ValidationError({'pid': [f'Backend {pid} can not be signalled: {getattr(e, "orig", e)}']})
+        return {'pid': pid, 'cancelled': bool(done), 'terminated': bool(done and terminate)}
+
+    entry_id = data_dict.get('id')
+    entry = registry.get(entry_id)
+    if not entry:
+        raise toolkit.ObjectNotFound(f'Query {entry_id} is not running')
+
+    log.info(f"{action} query {entry['query']} on backend {entry['pid']}")
+    done = execution.cancel(entry['pid'], read_only=entry['read_only'], terminate=terminate)
+
+    return {'id': entry_id, 'cancelled': bool(done), 'terminated': bool(done and terminate)}
+
+
+@toolkit.side_effect_free
+def dbquery_slot_usage(context, data_dict):
+    """
+    Return the usage of the execution slots: the global `limit` and the
+    slots `used`, the `user_limit` and the slots used by the current user
+    (`user_used`) and the number of `queued` requests waiting for one.
+    Limits are 0 when not set.
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    user_obj = context.get('auth_user_obj')
+    return admission.usage(user_obj.id if user_obj else None)
+
+
+@toolkit.side_effect_free
+def dbquery_activity(context, data_dict):
+    """
+    Return the live activity of CKAN's database: its backends from
+    pg_stat_activity (with their wait events and the pids blocking them),
+    the blocking chains from the backend holding the lock to the waiting
+    ones, the longest open transactions and the tables with the most
+    sequential reads and dead rows from pg_stat_user_tables. Ages are in
+    seconds.
+
+    :param tables: include the table stats (optional, default: True)
+    :param limit: max number of transactions and tables (optional, default: 20)
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    tables = toolkit.asbool(data_dict.get('tables', True))
+    limit = _get_int(data_dict, 'limit', 20)
+    with model.meta.engine.connect() as conn:
+        return activity.snapshot(conn, tables=tables, limit=limit)
+
+
+@toolkit.side_effect_free
+def dbquery_schema(context, data_dict):
+    """
+    Return the catalog of the database schema for the query editor: its
+    `tables`, views, materialized views and foreign tables (without the
+    system ones and the partitions), each one with its `schema`, `name`,
+    `kind`, `row_estimate` (the planner's estimate, None if the table was
+    never analyzed), `comment`, `columns` (name, type, nullable, default)
+    and `indexes` (name, primary, unique, definition).
+
+    The catalog is cached in process for ``ckanext.dbquery.schema_cache_ttl``
+    seconds and the response tells if it was `cached`, its `cache_age` in
+    seconds and when it was `generated`. DDL statements run with
+    query_database clear the cache.
+
+    :param schema: only return the tables of this schema (optional)
+    :param refresh: read the catalog again from the database
+        (optional, default: False)
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    if toolkit.asbool(data_dict.get('refresh')):
+        schema_cache.invalidate()
+
+    def load():
+        # The catalog of the read engine, where the SELECT queries run
+        with execution.get_engine(read_only=True).connect() as conn:
+            # The three catalog queries see the same snapshot
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+            with conn.begin():
+                return schema.introspect(conn)
+
+    catalog, cache_age = schema_cache.get(load, toolkit.config.get('ckanext.dbquery.schema_cache_ttl'))
+    tables = catalog['tables']
+    if data_dict.get('schema'):
+        tables = [table for table in tables if table['schema'] == data_dict['schema']]
+    return {
+        'tables': tables,
+        'generated': catalog['generated'],
+        'cached': cache_age is not None,
+        'cache_age': round(cache_age or 0, 3),
+    }
+
+
+def _get_job(data_dict):
+    job_id = data_dict.get('id')
+    job = DBQueryJob.get(job_id) if job_id else None
+    if not job:
+        raise toolkit.ObjectNotFound(f'DBQuery job {job_id} not found')
+    return job
+
+
+@toolkit.side_effect_free
+def dbquery_job_status(context, data_dict):
+    """
+    Return the status of a query sent to the background jobs queue
+
+    :param id: the job id returned by query_database
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    return _get_job(data_dict).dictize()
+
+
+@toolkit.side_effect_free
+def dbquery_job_result(context, data_dict):
+    """
+    Return the query_database response of a finished background job
+
+    :param id: the job id returned by query_database
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    job = _get_job(data_dict)
+    if job.status == DBQueryJob.STATUS_FAILED:
+        raise toolkit.ValidationError({'query': job.error})
+    if job.status != DBQueryJob.STATUS_FINISHED:
+        raise toolkit.ValidationError({'id': [f'The job is {job.status}']})
+
+    return job.get_result()
+
+
+@toolkit.side_effect_free
+def dbquery_pool_stats(context, data_dict):
+    """
+    Return the connection pool usage of CKAN's engine (`primary`)
+    and of the read engine (`read`, None if it isn't configured)
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    read_engine = execution.get_read_engine()
+    return {
+        'primary': execution.pool_stats(model.meta.engine),
+        'read': execution.pool_stats(read_engine) if read_engine else None,
+    }
@@ -0,0 +1,154 @@
+import datetime
+import logging
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.dbquery.actions.dbquery import _get_int
+from ckanext.dbquery.jobs import refresh_saved_query, refresh_saved_query_job
+from ckanext.dbquery.model import DBQuerySaved
+
+
+log = logging.getLogger(__name__)
+
+MAX_NAME_LENGTH = 100
+
+
+def _get_saved(data_dict):
+    saved_id = data_dict.get('id')
+    saved = DBQuerySaved.get(saved_id) if saved_id else None
+    if not saved:
+        raise toolkit.ObjectNotFound(f'Saved query {saved_id} not found')
+    return saved
+
+
+def _validate_saved(data_dict, saved=None):
+    """ Validate the fields of a saved query, the ones not given keep their current values """
+    errors = {}
+    name = (data_dict.get('name') or (saved.name if saved else '')).strip()
+    if not name:
+        errors['name'] = ['Missing value']
+    elif len(name) > MAX_NAME_LENGTH:
+        errors['name'] = [f'Must be at most {MAX_NAME_LENGTH} characters long']
+    else:
+        existing = DBQuerySaved.get_by_name(name)
+        if existing and (not saved or existing.id != saved.id):
+            errors['name'] = ['A saved query with this name already exists']
+
+    query = (data_dict.get('query') or (saved.query if saved else '')).strip()
+    if not query:
+        errors['query'] = ['Missing value']
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    default_interval = saved.refresh_interval if saved else 0
+    return {
+        'name': name,
+        'query': query,
+        'refresh_interval': _get_int(data_dict, 'refresh_interval', default_interval),
+    }
+
+
+def dbquery_saved_create(context, data_dict):
+    """
+    Save a named query
+
+    :param name: unique name of the query
+    :param query: the SQL statement or script
+    :param refresh_interval: minutes between automatic refreshes of the
+        snapshot by ``ckan dbquery refresh``, 0 to refresh it only on
+        demand (optional, default: 0)
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    values = _validate_saved(data_dict)
+    saved = DBQuerySaved(owner_id=context['auth_user_obj'].id, **values).save()
+
+    return saved.dictize()
+
+
+def dbquery_saved_update(context, data_dict):
+    """
+    Update a saved query. Changing its SQL discards the snapshot.
+
+    :param id: the id of the saved query
+    :param name: unique name of the query (optional)
+    :param query: the SQL statement or script (optional)
+    :param refresh_interval: minutes between automatic refreshes (optional)
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    saved = _get_saved(data_dict)
+    values = _validate_saved(data_dict, saved)
+    if values['query'] != saved.query:
+        saved.snapshot = saved.snapshot_taken = saved.snapshot_duration = None
+        saved.snapshot_status = saved.snapshot_error = None
+    for key, value in values.items():
+        setattr(saved, key, value)
+    saved.modified = datetime.datetime.utcnow()
+    saved.save()
+
+    return saved.dictize()
+
+
+def dbquery_saved_delete(context, data_dict):
+    """
+    Delete a saved query and its snapshot
+
+    :param id: the id of the saved query
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    saved = _get_saved(data_dict)
+    saved.delete()
+
+    return {'id': saved.id}
+
+
+@toolkit.side_effect_free
+def dbquery_saved_list(context, data_dict):
+    """ List the saved queries by name, without their snapshots """
+    toolkit.check_access('query_database', context, data_dict)
+
+    saved_queries = model.Session.query(DBQuerySaved).order_by(DBQuerySaved.name)
+    return [saved.dictize() for saved in saved_queries.all()]
+
+
+@toolkit.side_effect_free
+def dbquery_saved_show(context, data_dict):
+    """
+    Return a saved query with its latest snapshot: the query_database
+    response of the last successful refresh (None if it was never
+    refreshed), with its age in seconds in `snapshot_age`
+
+    :param id: the id of the saved query
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    saved = _get_saved(data_dict)
+    return dict(saved.dictize(), snapshot=saved.get_snapshot())
+
+
+def dbquery_saved_refresh(context, data_dict):
+    """
+    Run a saved query now and store its results as the new snapshot
+
+    :param id: the id of the saved query
+    :param async: refresh it in a background job and return at once
+        (optional, default: False)
+    """
+    toolkit.check_access('query_database', context, data_dict)
+
+    saved = _get_saved(data_dict)
+    if toolkit.asbool(data_dict.get('async')):
+        toolkit.enqueue_job(
+            refresh_saved_query_job,
+            [saved.id],
+            title=f'DBQuery saved query {saved.name}',
+            rq_kwargs={'timeout': toolkit.config.get('ckanext.dbquery.job_timeout')},
+        )
+        return dict(saved.dictize(), message='Refresh sent to the background jobs queue')
+
+    saved = refresh_saved_query(saved.id)
+    return dict(saved.dictize(), snapshot=saved.get_snapshot())
@@ -0,0 +1,117 @@
+"""
+Live activity of CKAN's database: its backends from pg_stat_activity (the
+ones connected to other databases of the server are left out), the
+blocking chains between them (pg_blocking_pids), the longest open
+transactions and the hot spots of pg_stat_user_tables.
+"""
+from sqlalchemy.sql.expression import text
+
+
+# Longest query text returned per backend
+MAX_QUERY_LENGTH = 2000
+
+_BACKENDS = text(f"""
+    SELECT
+        pid,
+        usename AS username,
+        datname AS database,
+        application_name,
+        host(client_addr) AS client_addr,
+        backend_type,
+        state,
+        wait_event_type,
+        wait_event,
+        pg_blocking_pids(pid) AS blocked_by,
+        EXTRACT(EPOCH FROM now() - backend_start)::float8 AS backend_age,
+        EXTRACT(EPOCH FROM now() - xact_start)::float8 AS xact_age,
+        EXTRACT(EPOCH FROM now() - query_start)::float8 AS query_age,
+        EXTRACT(EPOCH FROM now() - state_change)::float8 AS state_age,
+        left(query, {MAX_QUERY_LENGTH}) AS query
+    FROM pg_stat_activity
+    WHERE pid <> pg_backend_pid() AND datname = current_database()
+    ORDER BY query_start NULLS LAST
+""")
+
+_IS_BACKEND = text("""
+    SELECT 1 FROM pg_stat_activity
+    WHERE pid = :pid AND pid <> pg_backend_pid() AND datname = current_database()
+""")
+
+_TABLES = text("""
+    SELECT
+        schemaname AS schema,
+        relname AS table_name,
+        n_live_tup AS live_rows,
+        n_dead_tup AS dead_rows,
+        round(100.0 * n_dead_tup / NULLIF(n_live_tup + n_dead_tup, 0), 1)::float8 AS dead_percent,
+        seq_scan,
+        seq_tup_read,
+        idx_scan,
+        last_autovacuum,
+        last_autoanalyze
+    FROM pg_stat_user_tables
+    ORDER BY seq_tup_read DESC, n_dead_tup DESC
+    LIMIT :limit
+""")
+
+
+def backends(conn):
+    """ Backends of the database, except the one running this query, oldest query first """
+    return [dict(row) for row in conn.execute(_BACKENDS).mappings()]
+
+
+def is_backend(conn, pid):
+    """ Check if a pid is one of the backends listed by backends() """
+    return bool(conn.execute(_IS_BACKEND, pid=pid).scalar())
+
+
+def blocking_chains(backends):
+    """
+    Chains of lock waits: for every blocked backend, the pids from the one
+    holding the lock (the root, which is not waiting for anyone) to it.
+    """
+    blockers = {backend['pid']: backend['blocked_by'] or [] for backend in backends}
+    chains = []
+    for backend in backends:
+        if not backend['blocked_by']:
+            continue
+        chain = [backend['pid']]
+        pid = backend['blocked_by'][0]
+        # Deadlocks make cycles until the deadlock detector breaks them
+        while pid not in chain:
+            chain.insert(0, pid)
+            if not blockers.get(pid):
+                break
+            pid = blockers[pid][0]
+        chains.append({'pid': backend['pid'], 'root': chain[0], 'chain': chain})
+    return chains
+
+
+def longest_transactions(backends, limit=10):
+    """ Backends with an open transaction, oldest first """
+    open_transactions = [backend for backend in backends if backend['xact_age'] is not None]
+    return sorted(open_transactions, key=lambda backend: backend['xact_age'], reverse=True)[:limit]
+
+
+def table_stats(conn, limit=20):
+    """ Tables with the most rows read by sequential scans and the most dead rows """
+    tables = []
+    for row in conn.execute(_TABLES, limit=limit).mappings():
+        table = dict(row)
+        for key in ('last_autovacuum', 'last_autoanalyze'):
+            table[key] = table[key].isoformat() if table[key] else None
+        tables.append(table)
+    return tables
+
+
+def snapshot(conn, tables=True, limit=20):
+    """ Activity of the database, table stats only with `tables` """
+    current = backends(conn)
+    result = {
+        'backends': current,
+        'blocking': blocking_chains(current),
+        'transactions': longest_transactions(current, limit=limit),
+    }
+    if tables:
+        result['tables'] = table_stats(conn, limit=limit)
+    return result
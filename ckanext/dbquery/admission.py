@@ -0,0 +1,229 @@
+"""
+Admission control: limits on the concurrent executions of this extension,
+global and per user, shared by all the CKAN processes.
+
+The slots are a semaphore built on PostgreSQL advisory locks: slot `n` is
+the session lock `(key, n)`, where the key is a constant for the global
+slots and a hash of the user id for the user ones. A request takes its
+slots on a dedicated connection to CKAN's database, opened without a pool
+so it doesn't take one of the connections of CKAN's pool, and unlocks them
+when it's done. If the process dies the connection is closed and
+PostgreSQL releases them. Requests that find no free slot wait, polling,
+for up to ``ckanext.dbquery.queue_timeout`` seconds holding a shared lock
+on the queue key, so the waiting requests can be counted in pg_locks. At
+most ``ckanext.dbquery.max_queued`` requests wait, the next ones are
+rejected at once.
+"""
+import contextlib
+import logging
+import threading
+import time
+import zlib
+
+import sqlalchemy
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.expression import text
+
+from ckan import model
+from ckan.plugins import toolkit
+
+
+log = logging.getLogger(__name__)
+
+# First polling interval while queued, doubled up to the max
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 0.5
+
+
+def _key(name):
+    """ Positive int4 advisory lock key for a name """
+    return zlib.crc32(name.encode('utf-8')) & 0x7fffffff
+
+
+GLOBAL_KEY = _key('ckanext.dbquery:slots')
+QUEUE_KEY = _key('ckanext.dbquery:queue')
+
+
+_lock_engine = None
+_lock_engine_lock = threading.Lock()
+
+
+def get_lock_engine():
+    """
+    Engine for the connections holding the slots: CKAN's database without a
+    pool, so waiting and running queries don't use up the connections of
+    CKAN's pool
+    """
+    global _lock_engine
+    url = model.meta.engine.url
+    with _lock_engine_lock:
+        if _lock_engine is None or _lock_engine.url != url:
+            if _lock_engine is not None:
+                _lock_engine.dispose()
+            _lock_engine = sqlalchemy.create_engine(url, poolclass=NullPool)
+        return _lock_engine
+
+
+def user_key(user_id):
+    return _key(f'ckanext.dbquery:user:{user_id}')
+
+
+def limits():
+    """ The global and per user limits, 0 means no limit """
+    return (
+        toolkit.config.get('ckanext.dbquery.max_concurrent'),
+        toolkit.config.get('ckanext.dbquery.max_concurrent_per_user'),
+    )
+
+
+_TRY_SLOT = text(
+    'SELECT slot FROM generate_series(0, :limit - 1) AS slot '
+    'WHERE pg_try_advisory_lock(:key, slot) LIMIT 1'
+)
+
+_USAGE = text("""
+    SELECT
+        count(*) FILTER (WHERE classid::bigint = :global_key AND objid::bigint < :global_limit
+                         AND mode = 'ExclusiveLock') AS used,
+        count(*) FILTER (WHERE classid::bigint = :user_key AND objid::bigint < :user_limit
+                         AND mode = 'ExclusiveLock') AS user_used,
+        count(*) FILTER (WHERE classid::bigint = :queue_key AND mode = 'ShareLock') AS queued
+    FROM pg_locks
+    WHERE locktype = 'advisory' AND objsubid = 2 AND granted
+        AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+""")
+
+
+class Slot(object):
+    """ The slots held by a request, released when leaving its context """
+
+    def __init__(self, conn=None, locks=()):
+        self.conn = conn
+        self.locks = list(locks)
+
+    def release(self):
+        if self.conn is None:
+            return
+        try:
+            for key, slot in self.locks:
+                self.conn.execute(text('SELECT pg_advisory_unlock(:key, :slot)'), key=key, slot=slot)
+        except Exception as e:
+            # Closing the connection for good releases its locks
+            log.error(f'Error releasing the query slots: {e}')
+            self.conn.invalidate()
+        self.conn.close()
+        self.conn = None
+        self.locks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _try_slot(conn, key, limit):
+    return conn.execute(_TRY_SLOT, key=key, limit=limit).scalar()
+
+
+def _try_acquire(conn, user_id, global_limit, user_limit):
+    """ Lock a user slot and a global slot, or none of them """
+    locks = []
+    for key, limit in ((user_key(user_id), user_limit), (GLOBAL_KEY, global_limit)):
+        if not limit:
+            continue
+        slot = _try_slot(conn, key, limit)
+        if slot is None:
+            for held in locks:
+                conn.execute(text('SELECT pg_advisory_unlock(:key, :slot)'), key=held[0], slot=held[1])
+            return None
+        locks.append((key, slot))
+    return locks
+
+
+def acquire(user_id, timeout=None):
+    """
+    Take an execution slot for a user, waiting up to `timeout` seconds
+    (``ckanext.dbquery.queue_timeout``) for one. Returns a Slot to release
+    when the execution ends. Raises a ValidationError when no slot is
+    freed in time, or right away if ``ckanext.dbquery.max_queued``
+    requests are already waiting.
+    """
+    global_limit, user_limit = limits()
+    if not global_limit and not user_limit:
+        return Slot()
+    if timeout is None:
+        timeout = toolkit.config.get('ckanext.dbquery.queue_timeout')
+
+    max_queued = toolkit.config.get('ckanext.dbquery.max_queued')
+
+    conn = get_lock_engine().connect().execution_options(isolation_level='AUTOCOMMIT')
+    deadline = time.monotonic() + timeout
+    interval = POLL_INTERVAL
+    queued = False
+    try:
+        while True:
+            locks = _try_acquire(conn, user_id, global_limit, user_limit)
+            if locks is not None:
+                return Slot(conn, locks)
+            if time.monotonic() >= deadline:
+                break
+            if not queued:
+                # Each waiting request holds a connection, the queue is bounded
+                if max_queued and usage(user_id, conn=conn)['queued'] >= max_queued:
+                    break
+                conn.execute(text('SELECT pg_advisory_lock_shared(:key, 0)'), key=QUEUE_KEY)
+                queued = True
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+        current = usage(user_id, conn=conn)
+    except Exception:
+        conn.invalidate()
+        conn.close()
+        raise
+    finally:
+        if queued and not conn.closed:
+            conn.execute(text('SELECT pg_advisory_unlock_shared(:key, 0)'), key=QUEUE_KEY)
+
+    conn.close()
+    if user_limit and current['user_used'] >= user_limit:
+        message = f'You are already running {current["user_used"]} queries, the maximum per user'
+    else:
+        message = f'The database is busy: {current["used"]} of {global_limit} query slots in use'
+    raise toolkit.ValidationError({
+        'query': [f'{message}, {current["queued"]} queued. Try again later'],
+    })
+
+
+def usage(user_id=None, conn=None):
+    """
+    Current usage of the slots: the limits, the slots in use (global and of
+    the user) and the number of queued requests
+    """
+    global_limit, user_limit = limits()
+    params = {
+        'global_key': GLOBAL_KEY,
+        'global_limit': global_limit or 0,
+        'user_key': user_key(user_id) if user_id else -1,
+        'user_limit': user_limit or 0,
+        'queue_key': QUEUE_KEY,
+    }
+    with contextlib.ExitStack() as stack:
+        if conn is None:
+            conn = stack.enter_context(get_lock_engine().connect())
+        row = conn.execute(_USAGE, **params).first()
+    return {
+        'limit': global_limit,
+        'used': row.used,
+        'user_limit': user_limit,
+        'user_used': row.user_used,
+        'queued': row.queued,
+    }
+
+
+def hold(slot, chunks):
+    """ Generator with the chunks of a streamed response, releasing the slot at the end """
+    try:
+        yield from chunks
+    finally:
+        slot.release()
@@ -0,0 +1,196 @@
+"""
+Apache Arrow and Parquet serialization of query results.
+Needs the optional `pyarrow` dependency (``pip install ckanext-dbquery[arrow]``).
+"""
+import json
+
+from ckanext.dbquery import execution
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+FORMATS = ('arrow', 'parquet')
+# Widest precision of Arrow's decimal128
+MAX_DECIMAL_PRECISION = 38
+
+# PostgreSQL type OIDs, as in pg_type
+BOOL = 16
+BYTEA = 17
+INT8 = 20
+INT2 = 21
+INT4 = 23
+OID = 26
+JSON = 114
+FLOAT4 = 700
+FLOAT8 = 701
+DATE = 1082
+TIME = 1083
+TIMESTAMP = 1114
+TIMESTAMPTZ = 1184
+INTERVAL = 1186
+NUMERIC = 1700
+JSONB = 3802
+
+# Array type OID: element type OID
+ARRAY_ELEMENTS = {
+    1000: BOOL,
+    1005: INT2,
+    1007: INT4,
+    1016: INT8,
+    1021: FLOAT4,
+    1022: FLOAT8,
+    1182: DATE,
+    1115: TIMESTAMP,
+    1185: TIMESTAMPTZ,
+    1231: NUMERIC,
+}
+
+
+def available():
+    """ Check if pyarrow is installed """
+    return pyarrow is not None
+
+
+def _scalar_types():
+    return {
+        BOOL: pyarrow.bool_(),
+        BYTEA: pyarrow.binary(),
+        INT2: pyarrow.int16(),
+        INT4: pyarrow.int32(),
+        INT8: pyarrow.int64(),
+        OID: pyarrow.int64(),
+        FLOAT4: pyarrow.float32(),
+        FLOAT8: pyarrow.float64(),
+        DATE: pyarrow.date32(),
+        TIME: pyarrow.time64('us'),
+        TIMESTAMP: pyarrow.timestamp('us'),
+        # psycopg2 returns aware datetimes, Arrow stores them in UTC
+        TIMESTAMPTZ: pyarrow.timestamp('us', tz='UTC'),
+        INTERVAL: pyarrow.duration('us'),
+    }
+
+
+def _decimal_type(precision, scale):
+    """ decimal128 for numeric(p, s) columns that fit it, None otherwise """
+    if precision and 0 < precision <= MAX_DECIMAL_PRECISION and scale is not None and 0 <= scale <= precision:
+        return pyarrow.decimal128(precision, scale)
+    return None
+
+
+def column_type(type_code, precision=None, scale=None):
+    """
+    Arrow type for a PostgreSQL column, from the type OID of the cursor
+    description. Types without an Arrow equivalent (text, uuid, json,
+    unconstrained numeric, enums...) are strings.
+    """
+    if type_code == NUMERIC:
+        return _decimal_type(precision, scale) or pyarrow.string()
+    if type_code in ARRAY_ELEMENTS:
+        element = ARRAY_ELEMENTS[type_code]
+        # The typmod of array columns is not reported, so numeric items are strings
+        item_type = pyarrow.string() if element == NUMERIC else _scalar_types()[element]
+        return pyarrow.list_(item_type)
+    return _scalar_types().get(type_code, pyarrow.string())
+
+
+def _to_string(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _converter(type_code, arrow_type):
+    """ Conversion of the values psycopg2 returns to the ones pyarrow expects, or None """
+    if type_code in (JSON, JSONB):
+        return json.dumps
+    if type_code == BYTEA:
+        return bytes
+    if pyarrow.types.is_string(arrow_type):
+        return _to_string
+    if pyarrow.types.is_list(arrow_type) and pyarrow.types.is_string(arrow_type.value_type):
+        return lambda items: [None if item is None else str(item) for item in items]
+    return None
+
+
+def schema(description):
+    """ Arrow schema and value converters for a DBAPI cursor description """
+    fields = []
+    converters = []
+    for column in description:
+        arrow_type = column_type(column.type_code, column.precision, column.scale)
+        fields.append(pyarrow.field(column.name, arrow_type))
+        converters.append(_converter(column.type_code, arrow_type))
+    return pyarrow.schema(fields), converters
+
+
+def record_batch(rows, arrow_schema, converters):
+    """ Build a record batch from a list of rows """
+    columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in arrow_schema]
+    arrays = []
+    for values, field, converter in zip(columns, arrow_schema, converters):
+        if converter:
+            values = [None if value is None else converter(value) for value in values]
+        arrays.append(pyarrow.array(values, type=field.type))
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=arrow_schema)
+
+
+class ChunkSink:
+    """
+    Minimal writable file that keeps what is written until it's taken,
+    so the Arrow and Parquet writers can be streamed chunk by chunk.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        """ Return and forget what was written since the last call """
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _writer(fmt, sink, arrow_schema):
+    if fmt == 'parquet':
+        return pyarrow.parquet.ParquetWriter(sink, arrow_schema)
+    return pyarrow.ipc.new_stream(sink, arrow_schema)
+
+
+def generate(result, fmt, chunk_size):
+    """
+    Generator with the rows of a result as an Arrow IPC stream or a Parquet
+    file, one record batch (Parquet row group) per chunk of `chunk_size`
+    rows, so memory usage is bounded by the chunk size.
+    The first chunk only has the schema (Arrow) or the file header (Parquet).
+    """
+    arrow_schema, converters = schema(result.cursor.description)
+    sink = ChunkSink()
+    writer = _writer(fmt, sink, arrow_schema)
+    yield sink.take()
+    for rows in execution.iter_chunks(result, chunk_size):
+        writer.write_batch(record_batch(rows, arrow_schema, converters))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
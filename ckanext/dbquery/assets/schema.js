@@ -0,0 +1,294 @@
+/* Schema browser and autocomplete of the query editor.
+ *
+ * The catalog of the database (tables, columns, indexes and row estimates)
+ * is fetched once per page from the `schema.json` endpoint, which caches
+ * it on the server. The browser lists the tables, clicking a table or a
+ * column name inserts it in the editor. While typing, the editor suggests
+ * table names, and the columns of the tables in the query, or of the table
+ * (or alias) before a dot.
+ *
+ * Options:
+ *   endpoint: URL of the JSON endpoint returning the catalog
+ *   editor: id of the query textarea
+ */
+ckan.module("dbquery-schema", function ($, _) {
+  "use strict";
+
+  var SIMPLE_IDENTIFIER = /^[a-z_][a-z0-9_$]*$/;
+  var KEYWORDS = /^(where|on|using|join|left|right|inner|outer|full|cross|natural|group|order|limit|offset|having|union|set|values|as)$/i;
+
+  return {
+    options: {
+      debug: false,
+      endpoint: null,
+      editor: "query",
+      maxSuggestions: 10,
+    },
+
+    initialize: function () {
+      $.proxyAll(this, /_on/);
+      this.editor = $(document.getElementById(this.options.editor));
+      this.tables = [];
+      this.byName = {};
+
+      this.filter = this.$(".dbquery-schema-filter").on("input", this._onFilter);
+      this.list = this.$(".dbquery-schema-tables");
+      this.status = this.$(".dbquery-schema-status");
+      this.$(".dbquery-schema-refresh").on("click", this._onRefresh);
+      this.list.on("click", "[data-insert]", this._onInsert);
+
+      this.suggestions = $('<ul class="dbquery-autocomplete list-unstyled"></ul>').hide();
+      this.editor.after(this.suggestions).parent().addClass("dbquery-autocomplete-container");
+      this.editor.on("input", this._onType).on("keydown", this._onKeyDown).on("blur", this._onBlur);
+      this.suggestions.on("mousedown", "li", this._onPick);
+
+      this._load(false);
+    },
+
+    _load: function (refresh) {
+      this.status.text(_("Loading the schema..."));
+      var url = this.options.endpoint + (refresh ? "?refresh=true" : "");
+      fetch(url, { credentials: "same-origin" })
+        .then(function (response) {
+          return response.json();
+        })
+        .then(this._onCatalog)
+        .catch(this._onError);
+    },
+
+    _onCatalog: function (catalog) {
+      this.tables = catalog.tables || [];
+      this.byName = {};
+      this.tables.forEach(function (table) {
+        this.byName[table.schema + "." + table.name] = table;
+        // Unqualified names resolve to the first schema with the table, e.g. public
+        if (!this.byName[table.name] || table.schema === "public") {
+          this.byName[table.name] = table;
+        }
+      }, this);
+      this.status.text(
+        _("%(count)s tables, read %(generated)s UTC", {
+          count: this.tables.length,
+          generated: catalog.generated.slice(0, 19).replace("T", " "),
+        })
+      );
+      this._renderTables();
+    },
+
+    _onError: function (error) {
+      this.status.text(_("Error loading the schema: %(error)s", { error: error }));
+      if (this.options.debug) {
+        console.error(error);
+      }
+    },
+
+    _onRefresh: function (event) {
+      event.preventDefault();
+      this._load(true);
+    },
+
+    _onFilter: function () {
+      this._renderTables();
+    },
+
+    _quote: function (name) {
+      return SIMPLE_IDENTIFIER.test(name) ? name : '"' + name.replace(/"/g, '""') + '"';
+    },
+
+    _tableName: function (table) {
+      var name = this._quote(table.name);
+      return table.schema === "public" ? name : this._quote(table.schema) + "." + name;
+    },
+
+    _rowEstimate: function (table) {
+      if (table.row_estimate === null || table.kind === "view") {
+        return "";
+      }
+      return "~" + table.row_estimate.toLocaleString();
+    },
+
+    _renderTables: function () {
+      var term = this.filter.val().trim().toLowerCase();
+      var fragment = $(document.createDocumentFragment());
+      this.tables.forEach(function (table) {
+        var name = this._tableName(table);
+        var columns = table.columns.filter(function (column) {
+          return column.name.toLowerCase().indexOf(term) !== -1;
+        });
+        if (term && name.toLowerCase().indexOf(term) === -1 && !columns.length) {
+          return;
+        }
+        var item = $('<details class="dbquery-schema-table"></details>').prop("open", !!term && !!columns.length);
+        var summary = $("<summary></summary>").attr("title", table.comment || table.kind);
+        $('<a href="#" class="dbquery-schema-name"></a>').attr("data-insert", name).text(name).appendTo(summary);
+        $('<small class="text-muted"></small>').text(this._rowEstimate(table)).appendTo(summary);
+        item.append(summary);
+
+        var list = $('<ul class="list-unstyled dbquery-schema-columns"></ul>');
+        (term && name.toLowerCase().indexOf(term) === -1 ? columns : table.columns).forEach(function (column) {
+          var entry = $("<li></li>").attr("title", column.default ? "DEFAULT " + column.default : null);
+          $('<a href="#"></a>').attr("data-insert", this._quote(column.name)).text(column.name).appendTo(entry);
+          $('<small class="text-muted"></small>')
+            .text(" " + column.type + (column.nullable ? "" : " NOT NULL"))
+            .appendTo(entry);
+          list.append(entry);
+        }, this);
+        table.indexes.forEach(function (index) {
+          $('<li class="dbquery-schema-index"></li>')
+            .attr("title", index.definition)
+            .text((index.primary ? "PK " : index.unique ? "UQ " : "IX ") + index.name)
+            .appendTo(list);
+        });
+        item.append(list);
+        fragment.append(item);
+      }, this);
+      this.list.empty().append(fragment);
+    },
+
+    _insert: function (start, end, text) {
+      var editor = this.editor[0];
+      var value = editor.value;
+      editor.value = value.slice(0, start) + text + value.slice(end);
+      editor.selectionStart = editor.selectionEnd = start + text.length;
+      editor.focus();
+      // Other listeners, e.g. the query parameters, see the change, but
+      // inserted names aren't completed
+      this.inserting = true;
+      editor.dispatchEvent(new Event("input"));
+      this.inserting = false;
+    },
+
+    _onInsert: function (event) {
+      event.preventDefault();
+      var editor = this.editor[0];
+      this._insert(editor.selectionStart, editor.selectionEnd, $(event.currentTarget).attr("data-insert"));
+    },
+
+    /* Tables of the query by name and alias, from its FROM and JOIN clauses */
+    _queryTables: function (query) {
+      var tables = {};
+      var regex = /\b(?:from|join|update|into)\s+((?:"[^"]+"|[\w$]+)(?:\.(?:"[^"]+"|[\w$]+))?)(?:\s+(?:as\s+)?([\w$]+))?/gi;
+      var match;
+      while ((match = regex.exec(query)) !== null) {
+        var table = this.byName[match[1].replace(/"/g, "")] || this.byName[match[1].replace(/"/g, "").toLowerCase()];
+        if (!table) {
+          continue;
+        }
+        tables[table.name.toLowerCase()] = table;
+        if (match[2] && !KEYWORDS.test(match[2])) {
+          tables[match[2].toLowerCase()] = table;
+        }
+      }
+      return tables;
+    },
+
+    /* Suggestions for the word before the cursor, and where it starts */
+    _complete: function () {
+      var editor = this.editor[0];
+      var before = editor.value.slice(0, editor.selectionStart);
+      var match = /(?:([\w$]+|"[^"]+")\.)?([\w$]*)$/.exec(before);
+      var prefix = match[2].toLowerCase();
+      var start = editor.selectionStart - match[2].length;
+      var candidates = [];
+      var queryTables = this._queryTables(editor.value);
+
+      if (match[1]) {
+        var qualifier = match[1].replace(/"/g, "").toLowerCase();
+        var table = queryTables[qualifier] || this.byName[qualifier];
+        if (table) {
+          candidates = table.columns.map(function (column) {
+            return { text: this._quote(column.name), label: column.name, hint: column.type };
+          }, this);
+        } else {
+          // A schema: its tables
+          candidates = this.tables
+            .filter(function (table) {
+              return table.schema.toLowerCase() === qualifier;
+            })
+            .map(function (table) {
+              return { text: this._quote(table.name), label: table.name, hint: table.kind };
+            }, this);
+        }
+      } else if (prefix) {
+        candidates = this.tables.map(function (table) {
+          return { text: this._tableName(table), label: this._tableName(table), hint: this._rowEstimate(table) };
+        }, this);
+        Object.keys(queryTables).forEach(function (key) {
+          var table = queryTables[key];
+          table.columns.forEach(function (column) {
+            candidates.push({ text: this._quote(column.name), label: column.name, hint: table.name });
+          }, this);
+        }, this);
+      }
+
+      var seen = {};
+      var suggestions = candidates.filter(function (candidate) {
+        var label = candidate.label.toLowerCase();
+        if (seen[candidate.text] || label.indexOf(prefix) !== 0 || label === prefix) {
+          return false;
+        }
+        seen[candidate.text] = true;
+        return true;
+      });
+      return { start: start, items: suggestions.slice(0, this.options.maxSuggestions) };
+    },
+
+    _onType: function () {
+      if (!this.tables.length || this.inserting) {
+        return;
+      }
+      this.completion = this._complete();
+      this.selected = 0;
+      this._renderSuggestions();
+    },
+
+    _renderSuggestions: function () {
+      var items = this.completion ? this.completion.items : [];
+      this.suggestions.empty().toggle(items.length > 0);
+      items.forEach(function (item, i) {
+        var entry = $("<li></li>").toggleClass("active", i === this.selected).data("index", i);
+        $("<span></span>").text(item.label).appendTo(entry);
+        $('<small class="text-muted"></small>').text(" " + (item.hint || "")).appendTo(entry);
+        this.suggestions.append(entry);
+      }, this);
+    },
+
+    _accept: function (index) {
+      var completion = this.completion;
+      this.completion = null;
+      this.suggestions.hide();
+      this._insert(completion.start, this.editor[0].selectionStart, completion.items[index].text);
+    },
+
+    _onKeyDown: function (event) {
+      var items = this.completion ? this.completion.items : [];
+      if (!items.length || !this.suggestions.is(":visible")) {
+        return;
+      }
+      if (event.key === "ArrowDown" || event.key === "ArrowUp") {
+        var step = event.key === "ArrowDown" ? 1 : -1;
+        this.selected = (this.selected + step + items.length) % items.length;
+        this._renderSuggestions();
+      } else if (event.key === "Enter" || event.key === "Tab") {
+        this._accept(this.selected);
+      } else if (event.key === "Escape") {
+        this.completion = null;
+        this.suggestions.hide();
+      } else {
+        return;
+      }
+      event.preventDefault();
+    },
+
+    _onPick: function (event) {
+      // On mousedown, before the editor loses the focus
+      event.preventDefault();
+      this._accept($(event.currentTarget).data("index"));
+    },
+
+    _onBlur: function () {
+      this.completion = null;
+      this.suggestions.hide();
+    },
+  };
+});
@@ -1,10 +1,314 @@
+/* Virtualized results grid of the query page.
+ *
+ * Only the rows in view (plus a few above and below) are in the DOM, each
+ * one absolutely positioned in a spacer as tall as all the loaded rows.
+ * Further pages are fetched from the `rows` endpoint when scrolling near
+ * the end. Columns can be sorted (the loaded rows) and resized without
+ * running the query again.
+ *
+ * Options:
+ *   grid: {colnames, rows, offset, limit, has_more} of the first page, and
+ *     the {query, params, timeout} of the request that produced it, sent
+ *     again for every page so edits of the form don't change the results
+ *   endpoint: URL of the JSON endpoint returning the next pages
+ */
 ckan.module("dbquery-module", function ($, _) {
   "use strict";
   return {
     options: {
       debug: false,
+      grid: null,
+      endpoint: null,
+      rowHeight: 28,
+      columnWidth: 160,
+      minColumnWidth: 40,
+      overscan: 10,
+      height: 480,
     },
 
-    initialize: function () {},
+    initialize: function () {
+      $.proxyAll(this, /_on/);
+      var grid = this.options.grid;
+      if (!grid || !grid.colnames) {
+        return;
+      }
+      this.colnames = grid.colnames;
+      this.rows = grid.rows || [];
+      this.loaded = this.rows.slice();
+      this.nextOffset = grid.offset + this.rows.length;
+      this.pageSize = grid.limit || this.rows.length || 100;
+      this.hasMore = grid.has_more;
+      this.request = grid.request || {};
+      this.loading = false;
+      this.sortColumn = null;
+      this.sortDirection = 1;
+      this.widths = this.colnames.map(function () {
+        return this.options.columnWidth;
+      }, this);
+
+      this._build();
+      this._render();
+    },
+
+    _build: function () {
+      var options = this.options;
+      this.el.empty().addClass("dbquery-grid");
+      // The grid replaces the page navigation
+      this.el.siblings(".dbquery-pager").hide();
+
+      this.header = $('<div class="dbquery-grid-header"></div>');
+      this.headerRow = $('<div class="dbquery-grid-row"></div>');
+      this.colnames.forEach(function (name, i) {
+        var cell = $('<div class="dbquery-grid-cell dbquery-grid-heading"></div>')
+          .attr("title", _("Sort by %(name)s", { name: name }))
+          .data("column", i);
+        $('<span class="dbquery-grid-label"></span>').text(name).appendTo(cell);
+        $('<span class="dbquery-grid-sort"></span>').appendTo(cell);
+        $('<span class="dbquery-grid-resize"></span>').data("column", i).appendTo(cell);
+        this.headerRow.append(cell);
+      }, this);
+      this.header.append(this.headerRow);
+
+      this.viewport = $('<div class="dbquery-grid-viewport"></div>').css("height", options.height);
+      this.spacer = $('<div class="dbquery-grid-spacer"></div>');
+      this.viewport.append(this.spacer);
+      this.status = $('<div class="dbquery-grid-status"></div>');
+
+      this.el.append(this.header, this.viewport, this.status);
+
+      this.viewport.on("scroll", this._onScroll);
+      this.headerRow.on("click", ".dbquery-grid-heading", this._onSort);
+      this.headerRow.on("mousedown", ".dbquery-grid-resize", this._onResizeStart);
+    },
+
+    _totalWidth: function () {
+      return this.widths.reduce(function (total, width) {
+        return total + width;
+      }, 0);
+    },
+
+    _cellText: function (value) {
+      if (value === null || value === undefined) {
+        return null;
+      }
+      if (typeof value === "object") {
+        return JSON.stringify(value);
+      }
+      return String(value);
+    },
+
+    _renderRow: function (row, index) {
+      var options = this.options;
+      var element = $('<div class="dbquery-grid-row"></div>').css({
+        top: index * options.rowHeight,
+        height: options.rowHeight,
+      });
+      row.forEach(function (value, i) {
+        var text = this._cellText(value);
+        var cell = $('<div class="dbquery-grid-cell"></div>').css("width", this.widths[i]);
+        if (text === null) {
+          cell.addClass("dbquery-grid-null").text("NULL");
+        } else {
+          cell.text(text).attr("title", text.length > 40 ? text : null);
+        }
+        element.append(cell);
+      }, this);
+      return element;
+    },
+
+    /* Put the rows in view in the DOM, and load the next page near the end */
+    _render: function () {
+      var options = this.options;
+      var scrollTop = this.viewport.scrollTop();
+      var visible = Math.ceil(options.height / options.rowHeight);
+      var start = Math.max(0, Math.floor(scrollTop / options.rowHeight) - options.overscan);
+      var end = Math.min(this.rows.length, start + visible + 2 * options.overscan);
+      var width = this._totalWidth();
+
+      this.headerRow.css("width", width).children().each(
+        function (i, cell) {
+          $(cell).css("width", this.widths[i]);
+        }.bind(this)
+      );
+      this.spacer.css({ height: this.rows.length * options.rowHeight, width: width });
+
+      var fragment = document.createDocumentFragment();
+      for (var i = start; i < end; i++) {
+        fragment.appendChild(this._renderRow(this.rows[i], i)[0]);
+      }
+      this.spacer.empty().append(fragment);
+      this._renderStatus();
+
+      if (this.hasMore && !this.loading && end >= this.rows.length - options.overscan) {
+        this._loadMore();
+      }
+    },
+
+    _renderStatus: function () {
+      var message = _("%(count)s rows loaded", { count: this.rows.length });
+      if (this.loading) {
+        message += ", " + _("loading more...");
+      } else if (this.hasMore) {
+        message += ", " + _("scroll down to load more");
+      }
+      if (this.sortColumn !== null) {
+        message += ". " + _("Sorting applies to the loaded rows");
+      }
+      this.status.text(message);
+    },
+
+    _loadMore: function () {
+      if (!this.options.endpoint || !this.request.query) {
+        return;
+      }
+      var request = this.request;
+      var data = new FormData();
+      data.set("query", request.query);
+      data.set("timeout", request.timeout || "");
+      Object.keys(request.params || {}).forEach(function (name) {
+        data.set("param." + name, request.params[name]);
+      });
+      data.set("offset", this.nextOffset);
+      data.set("limit", this.pageSize);
+      // The CSRF token of the page, as CKAN's API client sends it
+      var headers = {};
+      var csrfField = $("meta[name=csrf_field_name]").attr("content");
+      if (csrfField) {
+        headers["X-CSRFToken"] = $("meta[name=" + csrfField + "]").attr("content");
+      }
+      this.loading = true;
+      this._renderStatus();
+
+      fetch(this.options.endpoint, { method: "POST", body: data, headers: headers, credentials: "same-origin" })
+        .then(function (response) {
+          return response.json();
+        })
+        .then(this._onPage)
+        .catch(this._onError);
+    },
+
+    _onPage: function (page) {
+      this.loading = false;
+      if (page.error) {
+        this._onError(page.error);
+        return;
+      }
+      this.loaded = this.loaded.concat(page.rows);
+      this.nextOffset += page.rows.length;
+      this.hasMore = page.has_more && page.rows.length > 0;
+      this._applySort();
+      this._render();
+    },
+
+    _onError: function (error) {
+      if (error && typeof error === "object" && !(error instanceof Error)) {
+        // Validation errors, by field
+        error = Object.values(error).join("; ");
+      }
+      this.loading = false;
+      this.hasMore = false;
+      this.status.text(_("Error loading more rows: %(error)s", { error: error }));
+      if (this.options.debug) {
+        console.error(error);
+      }
+    },
+
+    _onScroll: function () {
+      this.header.scrollLeft(this.viewport.scrollLeft());
+      if (!this.frame) {
+        this.frame = window.requestAnimationFrame(
+          function () {
+            this.frame = null;
+            this._render();
+          }.bind(this)
+        );
+      }
+    },
+
+    _compare: function (a, b) {
+      // Nulls last, numbers as numbers, everything else as text
+      if (a === null || a === undefined) {
+        return b === null || b === undefined ? 0 : 1;
+      }
+      if (b === null || b === undefined) {
+        return -1;
+      }
+      if (typeof a === "number" && typeof b === "number") {
+        return a - b;
+      }
+      return String(this._cellText(a)).localeCompare(String(this._cellText(b)), undefined, { numeric: true });
+    },
+
+    _applySort: function () {
+      if (this.sortColumn === null) {
+        this.rows = this.loaded.slice();
+        return;
+      }
+      var column = this.sortColumn;
+      var direction = this.sortDirection;
+      var compare = this._compare.bind(this);
+      this.rows = this.loaded.slice().sort(function (a, b) {
+        var result = compare(a[column], b[column]);
+        // Nulls stay last in both directions
+        return a[column] === null || b[column] === null ? result : result * direction;
+      });
+    },
+
+    /* Ascending, descending, then back to the query order */
+    _onSort: function (event) {
+      if (this.resizing) {
+        return;
+      }
+      var column = $(event.currentTarget).data("column");
+      if (this.sortColumn !== column) {
+        this.sortColumn = column;
+        this.sortDirection = 1;
+      } else if (this.sortDirection === 1) {
+        this.sortDirection = -1;
+      } else {
+        this.sortColumn = null;
+      }
+      this.headerRow.find(".dbquery-grid-sort").text("");
+      if (this.sortColumn !== null) {
+        this.headerRow
+          .children()
+          .eq(this.sortColumn)
+          .find(".dbquery-grid-sort")
+          .text(this.sortDirection === 1 ? " ▲" : " ▼");
+      }
+      this._applySort();
+      this._render();
+    },
+
+    _onResizeStart: function (event) {
+      event.preventDefault();
+      event.stopPropagation();
+      this.resizing = {
+        column: $(event.currentTarget).data("column"),
+        x: event.pageX,
+        width: this.widths[$(event.currentTarget).data("column")],
+      };
+      $(document).on("mousemove", this._onResize).on("mouseup", this._onResizeEnd);
+    },
+
+    _onResize: function (event) {
+      var resizing = this.resizing;
+      this.widths[resizing.column] = Math.max(
+        this.options.minColumnWidth,
+        resizing.width + event.pageX - resizing.x
+      );
+      this._render();
+    },
+
+    _onResizeEnd: function () {
+      $(document).off("mousemove", this._onResize).off("mouseup", this._onResizeEnd);
+      // The click that ends a resize must not sort the column
+      window.setTimeout(
+        function () {
+          this.resizing = null;
+        }.bind(this),
+        0
+      );
+    },
   };
 });
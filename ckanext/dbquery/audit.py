@@ -0,0 +1,219 @@
+"""
+Writer for the executed queries audit table.
+
+Records are put on an in-process queue and a background thread writes them
+in batches with a single multi-row INSERT, when the batch is full or after
+a flush interval, and at shutdown, when the thread writes the batch it is
+collecting before stopping. When a batch fails its records are written one
+by one, so only the bad ones are lost. Writes use their own connection, so they
+never touch the request's session. With ``ckanext.dbquery.audit_mode = sync``
+each record is written right away, which is what the tests use.
+"""
+import atexit
+import datetime
+import logging
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy import bindparam, select
+
+from ckan import model
+from ckan.model.types import make_uuid
+from ckan.plugins import toolkit
+
+from ckanext.dbquery import partitions, sql
+from ckanext.dbquery.model import DBQueryExecuted
+
+
+log = logging.getLogger(__name__)
+
+# Put on the queue to stop the writer thread
+_STOP = object()
+
+
+def _prepare(values):
+    """ Build a full audit row, multi-row INSERTs need the same keys in every row """
+    record = {column.name: None for column in DBQueryExecuted.__table__.columns}
+    record.update(values)
+    record['id'] = record['id'] or make_uuid()
+    record['timestamp'] = record['timestamp'] or datetime.datetime.utcnow()
+    record['status'] = record['status'] or 'ok'
+    return record
+
+
+def write_records(records):
+    """ Insert audit rows with a single multi-row INSERT """
+    partitions.ensure_current_partitions()
+    # Fingerprinted here, in the writer thread, instead of in the request
+    for record in records:
+        record['fingerprint'] = record['fingerprint'] or sql.fingerprint(record['query'])
+    engine = model.meta.engine
+    with engine.begin() as conn:
+        conn.execute(DBQueryExecuted.__table__.insert().values(records))
+
+
+class AuditWriter(object):
+
+    def __init__(self, batch_size=100, flush_interval=5, queue_size=10000, start_thread=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.start_thread = start_thread
+        # Records lost because the queue was full or the INSERT failed
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._pid = None
+
+    def record(self, values):
+        """ Queue an audit record, never blocks """
+        if self.start_thread:
+            self._ensure_thread()
+        try:
+            self._queue.put_nowait(_prepare(values))
+        except queue.Full:
+            self._drop(1, 'the audit queue is full')
+
+    def flush(self):
+        """ Write all the queued records now """
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                continue
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def close(self, timeout=10):
+        """
+        Stop the background thread, letting it write the batch it is
+        collecting, and write the records left in the queue. Called at exit.
+        """
+        thread = self._thread
+        if thread and thread.is_alive() and self._pid == os.getpid():
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+                thread.join(timeout)
+            except queue.Full:
+                pass
+            if thread.is_alive():
+                log.warning('The audit writer thread did not stop in time')
+        self.flush()
+
+    def _ensure_thread(self):
+        # After a fork (e.g. uWSGI workers) the parent's thread doesn't exist in the child
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.queue_size)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='dbquery-audit', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    # Write the batch being collected before stopping
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            write_records(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self._drop(1, f'the INSERT failed: {e}')
+                return
+            # One bad record fails the whole INSERT, only lose that one
+            log.warning(f'Writing {len(batch)} audit records one by one, the batch INSERT failed: {e}')
+            for record in batch:
+                self._write([record])
+
+    def _drop(self, count, reason):
+        with self._lock:
+            self.dropped += count
+        log.warning(f'Dropped {count} audit records ({self.dropped} in total), {reason}')
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """ The audit writer of this process, created from the config on first use """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = AuditWriter(
+                batch_size=toolkit.config.get('ckanext.dbquery.audit_batch_size'),
+                flush_interval=toolkit.config.get('ckanext.dbquery.audit_flush_interval'),
+                queue_size=toolkit.config.get('ckanext.dbquery.audit_queue_size'),
+            )
+            atexit.register(_writer.close)
+    return _writer
+
+
+def record(**values):
+    """ Save an executed query in the audit table """
+    if toolkit.config.get('ckanext.dbquery.audit_mode') == 'sync':
+        try:
+            write_records([_prepare(values)])
+        except Exception as e:
+            log.error(f'Error saving the audit record for {values.get("query")}: {e}')
+        return
+    get_writer().record(values)
+
+
+def backfill_fingerprints(batch_size=1000):
+    """
+    Fingerprint the audit records saved before fingerprints were added,
+    `batch_size` records per transaction. Returns the number of records.
+    """
+    table = DBQueryExecuted.__table__
+    engine = model.meta.engine
+    update = table.update().where(
+        table.c.id == bindparam('_id'), table.c.timestamp == bindparam('_timestamp'),
+    ).values(fingerprint=bindparam('_fingerprint'))
+    done = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select([table.c.id, table.c.timestamp, table.c.query])
+                .where(table.c.fingerprint.is_(None))
+                .limit(batch_size)
+            ).fetchall()
+            if rows:
+                conn.execute(update, [
+                    {'_id': row.id, '_timestamp': row.timestamp, '_fingerprint': sql.fingerprint(row.query)}
+                    for row in rows
+                ])
+        done += len(rows)
+        if len(rows) < batch_size:
+            return done
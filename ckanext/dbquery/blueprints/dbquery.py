@@ -1,13 +1,54 @@
+import itertools
 import logging
-from flask import Blueprint
+from flask import Blueprint, Response, jsonify, make_response
 from ckan.plugins import toolkit
+from ckanext.dbquery import admission, arrow, audit, serialize, sql, timing
+from ckanext.dbquery.export import CONTENT_TYPES, generate_export
 
 
 log = logging.getLogger(__name__)
 dbquery_bp = Blueprint('dbquery', __name__, url_prefix='/ckan-admin/db-query')
 
+# Prefix of the form fields with the values of the query parameters
+PARAM_PREFIX = 'param.'
+
+
+def _form_params(values):
+    """ Query parameters from the `param.<name>` form fields """
+    return {
+        key[len(PARAM_PREFIX):]: value
+        for key, value in values.items()
+        if key.startswith(PARAM_PREFIX)
+    }
+
+
+def _grid_data(result, request):
+    """
+    First page of a SELECT query result in the `rows` format for the
+    results grid, where the next page starts and the `request` (query,
+    params and timeout) that produced it, so the next pages come from the
+    same query even if the form is edited. None for scripts, query plans
+    and other statements, whose next pages would run them again.
+    """
+    if not result or result.get('kind') != sql.SELECT or not result.get('colnames'):
+        return None
+    return {
+        'colnames': result['colnames'],
+        'rows': result['rows'],
+        'offset': result.get('offset') or 0,
+        'limit': result.get('limit'),
+        'has_more': result.get('has_more', False),
+        'request': request,
+    }
+
+
+def _action_timings(result):
+    """ The phases of an action result timings, its total is timed by the view """
+    return {name: duration for name, duration in (result or {}).get('timings', {}).items() if name != 'total'}
+
 
 @dbquery_bp.route('/', methods=['GET', 'POST'])
+@timing.profiled
 def index():
     """
     Run a custom query on the database
@@ -21,15 +62,30 @@ def index():
     result = None
     error_message = None
     request = toolkit.request
+    params = _form_params(request.form)
+    timer = timing.Timer()
 
     # Process form submission
     if request.method == 'POST':
         form = request.form
         query = form.get('query')
         if query:
-            data_dict = {'query': query}
+            data_dict = {
+                'query': query,
+                'offset': form.get('offset'),
+                'timeout': form.get('timeout'),
+                'async': form.get('async'),
+                'explain': form.get('explain'),
+                'params': params,
+                # Positional rows, records lose the columns with the same name
+                'format': serialize.ROWS,
+            }
             try:
-                result = toolkit.get_action('query_database')(None, data_dict)
+                with timer.phase('action'):
+                    result = toolkit.get_action('query_database')(None, data_dict)
+                timer.update(_action_timings(result))
+                if result.get('job_id'):
+                    return toolkit.redirect_to('dbquery.job', id=result['job_id'])
             except toolkit.ValidationError as e:
                 # Extract a user-friendly message from the error dict or fallback to string
                 error_message = f'Query validation error: {e}'
@@ -44,14 +100,217 @@ def index():
     extra_vars = {
         'result': result,
         'query': query,
+        'timeout': request.form.get('timeout', ''),
+        'explain': request.form.get('explain', ''),
+        'params': params,
+        'param_names': sql.bind_names(query),
+        'grid': _grid_data(result, {'query': query, 'params': params, 'timeout': request.form.get('timeout', '')}),
         'error_message': error_message,
+        'running': toolkit.get_action('dbquery_running_list')({}, {}),
+        'pools': toolkit.get_action('dbquery_pool_stats')({}, {}),
+        'slots': toolkit.get_action('dbquery_slot_usage')({}, {}) if any(admission.limits()) else None,
+        'saved_queries': toolkit.get_action('dbquery_saved_list')({}, {}),
     }
     log.info(f'dbquery index finished: {query}, error: {error_message}')
 
-    return toolkit.render('dbquery/index.html', extra_vars=extra_vars)
+    with timer.phase('render'):
+        body = toolkit.render('dbquery/index.html', extra_vars=extra_vars)
+    return timing.set_server_timing(make_response(body), timer)
+
+
+@dbquery_bp.route('/rows', methods=['POST'])
+def rows():
+    """
+    A page of the results of a query as JSON, in the compact `rows`
+    format, for the lazy loading of the results grid
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    form = toolkit.request.form
+    statements = sql.split_statements(form.get('query'))
+    # Every page runs the query again, only a read can be paged
+    if len(statements) != 1 or not sql.is_select(statements[0]):
+        return jsonify({'error': 'Only the results of a single SELECT query can be paged'}), 400
+    data_dict = {
+        'query': statements[0],
+        'offset': form.get('offset'),
+        'limit': form.get('limit'),
+        'timeout': form.get('timeout'),
+        'params': _form_params(form),
+        'format': serialize.ROWS,
+    }
+    try:
+        result = toolkit.get_action('query_database')(None, data_dict)
+    except toolkit.ValidationError as e:
+        return jsonify({'error': e.error_summary}), 400
+
+    return jsonify({
+        key: result.get(key)
+        for key in ('colnames', 'rows', 'offset', 'limit', 'has_more', 'truncated', 'message')
+    })
+
+
+@dbquery_bp.route('/export.<fmt>', methods=['POST'])
+def export(fmt):
+    """
+    Stream the results of a query as a file download
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+    if fmt not in CONTENT_TYPES:
+        return toolkit.abort(404)
+    if fmt in arrow.FORMATS and not arrow.available():
+        return toolkit.abort(400, 'Arrow and Parquet exports need pyarrow installed')
+
+    query = toolkit.request.form.get('query')
+    if not query:
+        return toolkit.abort(400, 'Missing query')
+    statements = sql.split_statements(query)
+    # The statement is sent whole in DECLARE ... CURSOR FOR, any other
+    # statement after it would run too
+    if len(statements) != 1 or not sql.is_select(statements[0]):
+        return toolkit.abort(400, 'Only a single SELECT query can be exported')
+    query = statements[0]
+
+    try:
+        slot = admission.acquire(toolkit.c.userobj.id)
+    except toolkit.ValidationError as e:
+        return toolkit.abort(503, e.error_dict['query'][0])
+
+    chunk_size = toolkit.config.get('ckanext.dbquery.export_chunk_size')
+    timeout = toolkit.config.get('ckanext.dbquery.statement_timeout')
+    chunks = generate_export(
+        query, fmt, chunk_size, params=_form_params(toolkit.request.form),
+        timeout=timeout, user_id=toolkit.c.userobj.id,
+    )
+    try:
+        # Run the statement now so errors are reported before streaming starts
+        first_chunk = next(chunks)
+    except Exception as e:
+        slot.release()
+        log.critical(f"Error exporting query {query}: {e}")
+        return toolkit.abort(400, f'Invalid Query: {e}')
+
+    audit.record(query=query, user_id=toolkit.c.userobj.id)
+
+    headers = {'Content-Disposition': f'attachment; filename="dbquery.{fmt}"'}
+    # The slot is held until the whole file is streamed
+    return Response(
+        admission.hold(slot, itertools.chain([first_chunk], chunks)),
+        content_type=CONTENT_TYPES[fmt],
+        headers=headers,
+    )
+
+
+@dbquery_bp.route('/cancel/<id>', methods=['POST'])
+def cancel(id):
+    """
+    Cancel a running query
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    try:
+        toolkit.get_action('dbquery_cancel')(None, {'id': id})
+        toolkit.h.flash_success(toolkit._('Cancel request sent'))
+    except toolkit.ObjectNotFound:
+        toolkit.h.flash_error(toolkit._('The query is no longer running'))
+
+    return toolkit.redirect_to('dbquery.index')
+
+
+@dbquery_bp.route('/activity', methods=['GET'])
+def activity():
+    """
+    Show the live activity of the database
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    extra_vars = {
+        'activity': toolkit.get_action('dbquery_activity')(None, {}),
+        'refresh': toolkit.request.args.get('refresh', '5'),
+    }
+    return toolkit.render('dbquery/activity.html', extra_vars=extra_vars)
+
+
+@dbquery_bp.route('/activity.json', methods=['GET'])
+def activity_json():
+    """
+    Backends, blocking chains and transactions for the auto-refresh of the
+    activity page, without the table stats
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    return jsonify(toolkit.get_action('dbquery_activity')(None, {'tables': False}))
+
+
+@dbquery_bp.route('/schema.json', methods=['GET'])
+def schema_json():
+    """
+    Catalog of the database schema for the schema browser and the
+    autocomplete of the query editor
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    refresh = toolkit.asbool(toolkit.request.args.get('refresh'))
+    return jsonify(toolkit.get_action('dbquery_schema')(None, {'refresh': refresh}))
+
+
+@dbquery_bp.route('/activity/<int:pid>/cancel', methods=['POST'])
+def cancel_backend(pid):
+    """
+    Cancel the statement of a backend, or terminate it
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    terminate = toolkit.asbool(toolkit.request.form.get('terminate'))
+    try:
+        result = toolkit.get_action('dbquery_cancel')(None, {'pid': pid, 'terminate': terminate})
+    except toolkit.ValidationError as e:
+        toolkit.h.flash_error(e.error_dict['pid'][0])
+        return toolkit.redirect_to('dbquery.activity')
+    if not result['cancelled']:
+        toolkit.h.flash_error(toolkit._('Backend {pid} is no longer running').format(pid=pid))
+    elif terminate:
+        toolkit.h.flash_success(toolkit._('Backend {pid} terminated').format(pid=pid))
+    else:
+        toolkit.h.flash_success(toolkit._('Cancel request sent to backend {pid}').format(pid=pid))
+
+    return toolkit.redirect_to('dbquery.activity')
+
+
+@dbquery_bp.route('/job/<id>', methods=['GET'])
+def job(id):
+    """
+    Show the status and the results of a query sent to the background jobs queue
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    try:
+        job = toolkit.get_action('dbquery_job_status')(None, {'id': id})
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Job not found'))
+
+    result = None
+    if job['status'] == 'finished':
+        result = toolkit.get_action('dbquery_job_result')(None, {'id': id})
+
+    extra_vars = {
+        'job': job,
+        'result': result,
+        'refresh': 3,
+    }
+    return toolkit.render('dbquery/job.html', extra_vars=extra_vars)
 
 
 @dbquery_bp.route('/history', methods=['GET'])
+@timing.profiled
 def history():
     """
     Show executed queries
@@ -63,21 +322,178 @@ def history():
     # Get filter parameters
     # We need a list of user id + names that ran queiries in the past
     user_filter = toolkit.get_action('dbquery_executor_users_list')({}, {})
-    f_user = toolkit.request.args.get('user', '')
-    f_date_filter = toolkit.request.args.get('date', '')
+    args = toolkit.request.args
+    filter_names = ('q', 'fingerprint', 'user', 'date', 'from', 'to', 'status', 'min_duration', 'max_duration')
+    filters = {name: args[name] for name in filter_names if args.get(name)}
+    f_sort = args.get('sort', '')
+    page_size = toolkit.config.get('ckanext.dbquery.history_page_size')
 
-    filters = {}
-    if f_user:
-        filters['user'] = f_user
-    if f_date_filter:
-        filters['date'] = f_date_filter
+    list_params = dict(filters, sort=f_sort, before=args.get('before'), limit=page_size + 1)
+    timer = timing.Timer()
+    try:
+        with timer.phase('list'):
+            queries = toolkit.get_action('dbquery_executed_list')({}, list_params)
+        with timer.phase('stats'):
+            stats = toolkit.get_action('dbquery_executed_stats')({}, filters)
+    except toolkit.ValidationError as e:
+        return toolkit.abort(400, str(e))
 
-    queries = toolkit.get_action('dbquery_executed_list')({}, filters)
+    # We asked for one extra query to know if there is an older page
+    next_cursor = None
+    if len(queries) > page_size:
+        queries = queries[:page_size]
+        if f_sort != 'duration':
+            next_cursor = queries[-1]['cursor']
 
     vars = {
         'queries': queries,
-        'user_filter': f_user,
-        'date_filter': f_date_filter,
+        'stats': stats,
+        'filters': filters,
+        'user_filter': filters.get('user', ''),
+        'date_filter': filters.get('date', ''),
+        'status_filter': filters.get('status', ''),
+        'min_duration_filter': filters.get('min_duration', ''),
+        'max_duration_filter': filters.get('max_duration', ''),
+        'sort': f_sort,
+        'next_cursor': next_cursor,
+        'is_first_page': not args.get('before'),
         'users': user_filter,
     }
-    return toolkit.render('dbquery/history.html', extra_vars=vars)
+    with timer.phase('render'):
+        body = toolkit.render('dbquery/history.html', extra_vars=vars)
+    return timing.set_server_timing(make_response(body), timer)
+
+
+@dbquery_bp.route('/workload', methods=['GET'])
+@timing.profiled
+def workload():
+    """
+    Show the executed queries aggregated by fingerprint
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    args = toolkit.request.args
+    filter_names = ('user', 'status', 'days', 'sort')
+    filters = {name: args[name] for name in filter_names if args.get(name)}
+    timer = timing.Timer()
+    try:
+        with timer.phase('stats'):
+            fingerprints = toolkit.get_action('dbquery_fingerprint_stats')({}, filters)
+        users = toolkit.get_action('dbquery_executor_users_list')({}, {})
+    except toolkit.ValidationError as e:
+        return toolkit.abort(400, str(e))
+
+    vars = {
+        'fingerprints': fingerprints,
+        'filters': filters,
+        'sort': filters.get('sort', 'total'),
+        'days': filters.get('days', 30),
+        'users': users,
+    }
+    with timer.phase('render'):
+        body = toolkit.render('dbquery/workload.html', extra_vars=vars)
+    return timing.set_server_timing(make_response(body), timer)
+
+
+def _saved_data_dict(form):
+    return {
+        'name': form.get('name'),
+        'query': form.get('query'),
+        'refresh_interval': form.get('refresh_interval'),
+    }
+
+
+@dbquery_bp.route('/saved', methods=['GET', 'POST'])
+def saved_list():
+    """
+    List the saved queries and save new ones
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    errors = {}
+    form = toolkit.request.form
+    if toolkit.request.method == 'POST':
+        try:
+            saved = toolkit.get_action('dbquery_saved_create')(None, _saved_data_dict(form))
+            toolkit.h.flash_success(toolkit._('Query saved'))
+            return toolkit.redirect_to('dbquery.saved_show', id=saved['id'])
+        except toolkit.ValidationError as e:
+            errors = e.error_dict
+
+    extra_vars = {
+        'saved_queries': toolkit.get_action('dbquery_saved_list')(None, {}),
+        'data': form,
+        'errors': errors,
+    }
+    return toolkit.render('dbquery/saved_list.html', extra_vars=extra_vars)
+
+
+@dbquery_bp.route('/saved/<id>', methods=['GET', 'POST'])
+def saved_show(id):
+    """
+    Show the latest snapshot of a saved query and update it
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    errors = {}
+    if toolkit.request.method == 'POST':
+        data_dict = dict(_saved_data_dict(toolkit.request.form), id=id)
+        try:
+            toolkit.get_action('dbquery_saved_update')(None, data_dict)
+            toolkit.h.flash_success(toolkit._('Saved query updated'))
+            return toolkit.redirect_to('dbquery.saved_show', id=id)
+        except toolkit.ObjectNotFound:
+            return toolkit.abort(404, toolkit._('Saved query not found'))
+        except toolkit.ValidationError as e:
+            errors = e.error_dict
+
+    try:
+        saved = toolkit.get_action('dbquery_saved_show')(None, {'id': id})
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Saved query not found'))
+
+    extra_vars = {
+        'saved': saved,
+        'result': saved['snapshot'],
+        'errors': errors,
+    }
+    return toolkit.render('dbquery/saved.html', extra_vars=extra_vars)
+
+
+@dbquery_bp.route('/saved/<id>/refresh', methods=['POST'])
+def saved_refresh(id):
+    """
+    Refresh the snapshot of a saved query now
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    try:
+        saved = toolkit.get_action('dbquery_saved_refresh')(None, {'id': id})
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Saved query not found'))
+
+    if saved['snapshot_status'] == 'ok':
+        toolkit.h.flash_success(toolkit._('Snapshot refreshed'))
+    else:
+        toolkit.h.flash_error(toolkit._('The query failed: {error}').format(error=saved['snapshot_error']))
+    return toolkit.redirect_to('dbquery.saved_show', id=id)
+
+
+@dbquery_bp.route('/saved/<id>/delete', methods=['POST'])
+def saved_delete(id):
+    """
+    Delete a saved query
+    """
+    if not toolkit.c.userobj or not toolkit.c.userobj.sysadmin:
+        return toolkit.abort(403)
+
+    try:
+        toolkit.get_action('dbquery_saved_delete')(None, {'id': id})
+        toolkit.h.flash_success(toolkit._('Saved query deleted'))
+    except toolkit.ObjectNotFound:
+        toolkit.h.flash_error(toolkit._('Saved query not found'))
+    return toolkit.redirect_to('dbquery.saved_list')
@@ -0,0 +1,59 @@
+"""
+In-process cache for the results of read-only queries.
+Entries expire after a TTL and the least recently used ones are evicted
+when the cache goes over its memory budget. Each CKAN worker process
+keeps its own cache.
+"""
+import collections
+import threading
+import time
+
+
+class ResultCache(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (value, size in bytes, time stored), least recently used first
+        self._entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key, ttl):
+        """ Return a (value, age in seconds) tuple, or None if there is no fresh entry """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, _, stored = entry
+            age = time.monotonic() - stored
+            if age > ttl:
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value, age
+
+    def set(self, key, value, size, max_bytes):
+        """ Store a value, evicting least recently used entries to stay under `max_bytes` """
+        if size > max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            while self._entries and self.size + size > max_bytes:
+                self._pop(next(iter(self._entries)))
+            self._entries[key] = (value, size, time.monotonic())
+            self.size += size
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+result_cache = ResultCache()
@@ -0,0 +1,84 @@
+import sys
+
+import click
+
+from ckan.plugins import toolkit
+
+from ckanext.dbquery import audit, partitions
+from ckanext.dbquery.jobs import refresh_due_queries
+
+
+@click.group(short_help='DBQuery commands')
+def dbquery():
+    pass
+
+
+@dbquery.command()
+@click.option('--all', 'refresh_all', is_flag=True, help='Refresh all the saved queries, not only the due ones')
+def refresh(refresh_all):
+    """
+    Refresh the snapshots of the saved queries whose refresh interval has
+    passed. Run it periodically, e.g. every minute from cron.
+    """
+    refreshed = refresh_due_queries(refresh_all=refresh_all)
+    for saved in refreshed:
+        message = f'{saved.name}: {saved.snapshot_status} ({saved.snapshot_duration} ms)'
+        if saved.snapshot_error:
+            message += f' {saved.snapshot_error}'
+        click.echo(message)
+    click.secho(f'{len(refreshed)} saved queries refreshed', fg='green')
+
+
+@dbquery.command(name='partitions')
+@click.option('--months-ahead', type=int, default=None, help='Months after the current one to create partitions for')
+def create_partitions(months_ahead):
+    """
+    Create the monthly partitions of the audit table for the current month
+    and the next ones. They are also created when audit records are written.
+    """
+    created = partitions.ensure_partitions(months_ahead=months_ahead)
+    for name in created:
+        click.echo(f'{name}: created')
+    click.secho(f'{len(created)} partitions created', fg='green')
+
+
+@dbquery.command()
+@click.option('--retention-months', type=int, default=None,
+              help='Months of records to keep (default: ckanext.dbquery.retention_months)')
+@click.option('--archive-dir', type=click.Path(exists=True, file_okay=False, writable=True),
+              help='Save each expired partition as a gzipped CSV file in this directory first')
+@click.option('--detach-only', is_flag=True, help='Keep the expired partitions as plain tables instead of dropping them')
+@click.option('--dry-run', is_flag=True, help='Only list the expired partitions')
+def purge(retention_months, archive_dir, detach_only, dry_run):
+    """
+    Remove the audit records older than the retention period by detaching
+    and dropping their monthly partitions. Run it periodically, e.g. daily
+    from cron.
+    """
+    if retention_months is None:
+        retention_months = toolkit.config.get('ckanext.dbquery.retention_months')
+    try:
+        done = partitions.purge(
+            retention_months, archive_dir=archive_dir, drop=not detach_only, dry_run=dry_run,
+        )
+    except toolkit.ValidationError as e:
+        click.secho(f'Error: {e.error_summary}', fg='red')
+        sys.exit(1)
+    for name, action in done:
+        click.echo(f'{name}: {action}')
+    click.secho(f'Audit records older than {retention_months} months purged', fg='green')
+
+
+@dbquery.command()
+@click.option('--batch-size', type=int, default=1000, help='Records updated per transaction')
+def fingerprint(batch_size):
+    """
+    Fingerprint the audit records saved before upgrading, so they are
+    included in the workload page. New records are fingerprinted when saved.
+    """
+    count = audit.backfill_fingerprints(batch_size=batch_size)
+    click.secho(f'{count} audit records fingerprinted', fg='green')
+
+
+def get_commands():
+    return [dbquery]
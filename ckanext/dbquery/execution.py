@@ -0,0 +1,215 @@
+import collections
+import contextlib
+import logging
+import sys
+import threading
+
+import sqlalchemy
+from sqlalchemy.sql.expression import text
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckanext.dbquery import prepared, registry, sql
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+_read_engine = None
+# The configured URL the read engine was built from, its rendered URL can differ
+_read_engine_url = None
+_read_engine_lock = threading.Lock()
+
+
+def get_read_engine():
+    """
+    Engine for read-only statements, with its own connection pool.
+    Connects to ``ckanext.dbquery.read_url`` (e.g. a read replica) or
+    returns None if it isn't set.
+    """
+    global _read_engine, _read_engine_url
+    url = toolkit.config.get('ckanext.dbquery.read_url')
+    if not url:
+        return None
+    with _read_engine_lock:
+        if _read_engine is None or _read_engine_url != url:
+            if _read_engine is not None:
+                _read_engine.dispose()
+            _read_engine = sqlalchemy.create_engine(
+                url,
+                pool_size=toolkit.config.get('ckanext.dbquery.read_pool_size'),
+                max_overflow=toolkit.config.get('ckanext.dbquery.read_max_overflow'),
+                pool_timeout=toolkit.config.get('ckanext.dbquery.read_pool_timeout'),
+                pool_pre_ping=True,
+            )
+            _read_engine_url = url
+        return _read_engine
+
+
+def get_engine(read_only=False):
+    """ The engine to run a statement: the read engine if configured, otherwise CKAN's one """
+    return (read_only and get_read_engine()) or model.meta.engine
+
+
+def pool_stats(engine):
+    """ Connection usage of an engine's pool """
+    pool = engine.pool
+    stats = {'status': pool.status()}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
+
+
+def _backend_pid(conn):
+    """ PID of the PostgreSQL backend serving this connection, cached per DBAPI connection """
+    info = conn.connection.info
+    if 'dbquery_pid' not in info:
+        info['dbquery_pid'] = conn.execute(text('SELECT pg_backend_pid()')).scalar()
+    return info['dbquery_pid']
+
+
+@contextlib.contextmanager
+def connect(query, timeout=None, user_id=None, rollback=False, read_only=False, read_only_transaction=False):
+    """
+    Open a connection with a transaction to run `query` (a statement or a script).
+    `timeout` (milliseconds) sets `statement_timeout` for this transaction only.
+    With `rollback` the transaction is rolled back instead of committed.
+    `read_only` statements run on the read engine, when configured, and
+    `read_only_transaction` runs them under SET TRANSACTION READ ONLY.
+    While it runs, the query is listed in the running statements registry
+    so it can be cancelled.
+    """
+    engine = get_engine(read_only)
+    with engine.connect() as conn, conn.begin() as transaction:
+        if read_only_transaction:
+            # Must run before any other statement of the transaction
+            conn.execute(text('SET TRANSACTION READ ONLY'))
+        if timeout:
+            conn.execute(
+                text("SELECT set_config('statement_timeout', :timeout, true)"),
+                timeout=str(timeout),
+            )
+        entry_id = registry.register(_backend_pid(conn), user_id, query, read_only=engine is not model.meta.engine)
+        try:
+            yield conn
+        finally:
+            registry.unregister(entry_id)
+        if rollback:
+            transaction.rollback()
+
+
+def run(conn, statement, stream=False, chunk_size=DEFAULT_CHUNK_SIZE, params=None, prepare=True):
+    """
+    Run a statement on a connection. With `stream` the statement runs on
+    a server-side (named) cursor and rows are pulled from PostgreSQL at most
+    `chunk_size` at a time, so memory usage does not depend on the size of
+    the result. Only SELECT statements can be streamed.
+
+    `params` are the values of the statement's `:name` bind parameters, the
+    ones it doesn't use are ignored. With `prepare`, statements with
+    parameters run as prepared statements, cached per connection, when
+    ``ckanext.dbquery.prepared_cache_size`` is not 0. Prepared statements
+    can't run on a server-side cursor (DECLARE doesn't take EXECUTE), so
+    streamed statements are never prepared.
+    """
+    names = sql.bind_names(statement) if params else []
+    values = {name: params[name] for name in names if name in params}
+    cache_size = toolkit.config.get('ckanext.dbquery.prepared_cache_size')
+    # With missing values, let text() raise its error below
+    if prepare and not stream and values and len(values) == len(names) and cache_size and sql.is_preparable(statement):
+        result = prepared.execute(conn, statement, names, values, cache_size)
+        if result is not None:
+            return result
+
+    statement = text(statement)
+    if values:
+        statement = statement.bindparams(**values)
+    if stream:
+        statement = statement.execution_options(
+            stream_results=True,
+            max_row_buffer=chunk_size,
+        )
+    return conn.execute(statement)
+
+
+@contextlib.contextmanager
+def execute(query, stream=False, chunk_size=DEFAULT_CHUNK_SIZE, params=None, prepare=True, **kwargs):
+    """
+    Execute a statement in its own transaction and yield the SQLAlchemy result.
+    See connect() and run() for the arguments.
+    """
+    with connect(query, **kwargs) as conn:
+        yield run(conn, query, stream=stream, chunk_size=chunk_size, params=params, prepare=prepare)
+
+
+def cancel(pid, read_only=False, terminate=False):
+    """
+    Cancel the statement running on a PostgreSQL backend of the primary or
+    the read engine, or with `terminate` close the backend's connection
+    """
+    engine = get_engine(read_only)
+    function = 'pg_terminate_backend' if terminate else 'pg_cancel_backend'
+    return engine.execute(text(f'SELECT {function}(:pid)'), pid=pid).scalar()
+
+
+def iter_chunks(result, chunk_size):
+    """ Yield lists of at most `chunk_size` rows until the result is exhausted """
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+Page = collections.namedtuple('Page', ['rows', 'has_more', 'size', 'capped'])
+
+
+def fetch_page(result, offset, limit, chunk_size=DEFAULT_CHUNK_SIZE, max_bytes=0):
+    """
+    Skip `offset` rows and return the next `limit` ones, fetched in chunks
+    of `chunk_size` rows. Only one extra row is read to know if there are
+    more rows, the rest of the result is never fetched.
+
+    With `max_bytes`, fetching stops before the approximate size of the
+    returned rows goes over it. Returns a Page with the rows, if there are
+    more rows, their size and if they were `capped` by `max_bytes`.
+    """
+    skipped = 0
+    while skipped < offset:
+        chunk = result.fetchmany(min(chunk_size, offset - skipped))
+        if not chunk:
+            return Page([], False, 0, False)
+        skipped += len(chunk)
+
+    rows = []
+    size = 0
+    while len(rows) <= limit:
+        chunk = result.fetchmany(min(chunk_size, limit + 1 - len(rows)))
+        for row in chunk:
+            if len(rows) == limit:
+                # The extra row, only tells there are more
+                return Page(rows, True, size, False)
+            row_bytes = row_size(row)
+            if max_bytes and size + row_bytes > max_bytes:
+                return Page(rows, True, size, True)
+            rows.append(row)
+            size += row_bytes
+        if len(chunk) < chunk_size:
+            break
+    return Page(rows, False, size, False)
+
+
+def row_size(row):
+    """ Approximate size in bytes of the values of a result row """
+    return sum(sys.getsizeof(value) for value in row)
+
+
+def error_status(error):
+    """ Audit status for a failed statement: timeout, cancelled or error """
+    orig = getattr(error, 'orig', None)
+    # query_canceled, raised both by statement_timeout and pg_cancel_backend
+    if getattr(orig, 'pgcode', None) == '57014':
+        return 'timeout' if 'statement timeout' in str(orig) else 'cancelled'
+    return 'error'
@@ -0,0 +1,96 @@
+import json
+
+from ckanext.dbquery import execution, sql
+
+
+EXPLAIN_MODES = ('plain', 'analyze', 'buffers')
+# Number of nodes flagged as the most expensive of a plan
+EXPENSIVE_NODES = 3
+
+
+def explain_statement(query, mode):
+    """ Build the EXPLAIN (FORMAT JSON) statement for a query """
+    options = ['FORMAT JSON']
+    if mode in ('analyze', 'buffers'):
+        options.append('ANALYZE')
+    if mode == 'buffers':
+        options.append('BUFFERS')
+    return f"EXPLAIN ({', '.join(options)}) {query}"
+
+
+def explain(query, mode, timeout=None, user_id=None, params=None):
+    """
+    Run EXPLAIN on a query and return its parsed plan.
+    The statement always runs in a transaction that is rolled back, so
+    ANALYZE on data-modifying statements doesn't change any data.
+    `params` are the values of the query's `:name` bind parameters.
+    """
+    statement = explain_statement(query, mode)
+    # Only plain SELECTs can be explained on the read engine, ANALYZE runs the statement
+    read_only = sql.is_select(query)
+    with execution.execute(
+        statement, params=params, timeout=timeout, user_id=user_id, rollback=True, read_only=read_only
+    ) as result:
+        plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return parse_plan(plan)
+
+
+def _parse_node(plan):
+    loops = plan.get('Actual Loops') or 1
+    children = [_parse_node(child) for child in plan.get('Plans', [])]
+    analyzed = 'Actual Total Time' in plan
+    node = {
+        'node_type': plan['Node Type'],
+        'relation': plan.get('Relation Name'),
+        'alias': plan.get('Alias'),
+        'index': plan.get('Index Name'),
+        'startup_cost': plan.get('Startup Cost'),
+        'total_cost': plan.get('Total Cost'),
+        'estimated_rows': plan.get('Plan Rows'),
+        # Rows are reported per loop, like the estimate
+        'actual_rows': plan.get('Actual Rows'),
+        'loops': plan.get('Actual Loops'),
+        'total_time': plan['Actual Total Time'] * loops if analyzed else None,
+        'shared_hit_blocks': plan.get('Shared Hit Blocks'),
+        'shared_read_blocks': plan.get('Shared Read Blocks'),
+        'children': children,
+        'expensive': False,
+    }
+    # Cost and time spent in this node, without its children
+    node['exclusive_cost'] = max(0, node['total_cost'] - sum(child['total_cost'] for child in children))
+    if analyzed:
+        node['exclusive_time'] = max(0, node['total_time'] - sum(child['total_time'] or 0 for child in children))
+    else:
+        node['exclusive_time'] = None
+    return node
+
+
+def _walk(node):
+    yield node
+    for child in node['children']:
+        yield from _walk(child)
+
+
+def parse_plan(plan):
+    """
+    Turn the output of EXPLAIN (FORMAT JSON) into a tree of nodes with
+    estimated vs actual rows, timing and buffers. The nodes with the
+    highest exclusive time (or cost, without ANALYZE) are flagged as `expensive`.
+    """
+    root = plan[0]
+    tree = _parse_node(root['Plan'])
+    analyzed = tree['total_time'] is not None
+    metric = 'exclusive_time' if analyzed else 'exclusive_cost'
+
+    nodes = sorted(_walk(tree), key=lambda node: node[metric], reverse=True)
+    for node in nodes[:EXPENSIVE_NODES]:
+        if node[metric] > 0:
+            node['expensive'] = True
+
+    return {
+        'plan': tree,
+        'planning_time': root.get('Planning Time'),
+        'execution_time': root.get('Execution Time'),
+    }
@@ -0,0 +1,64 @@
+import csv
+import io
+import json
+
+from ckanext.dbquery import arrow, execution
+
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def _csv_header(colnames):
+    return _csv_rows(colnames, [colnames])
+
+
+def _csv_rows(colnames, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def _ndjson_header(colnames):
+    return ''
+
+
+def _ndjson_rows(colnames, rows):
+    return ''.join(
+        json.dumps(dict(zip(colnames, row)), default=str) + '\n'
+        for row in rows
+    )
+
+
+_WRITERS = {
+    'csv': (_csv_header, _csv_rows),
+    'ndjson': (_ndjson_header, _ndjson_rows),
+}
+
+
+def generate_export(query, fmt, chunk_size, params=None, timeout=None, user_id=None):
+    """
+    Generator with the query results serialized as `fmt`.
+    The first chunk is produced right after the statement is executed,
+    so callers can call next() once to surface query errors before
+    the response starts. `params` are the values of the query's `:name`
+    bind parameters. They are never prepared, so the rows are always
+    read from a server-side cursor. The statement runs in a READ ONLY
+    transaction.
+    """
+    with execution.execute(
+        query, stream=True, params=params, prepare=False, read_only=True, chunk_size=chunk_size,
+        timeout=timeout, user_id=user_id, read_only_transaction=True,
+    ) as result:
+        if fmt in arrow.FORMATS:
+            yield from arrow.generate(result, fmt, chunk_size)
+            return
+        write_header, write_rows = _WRITERS[fmt]
+        colnames = list(result.keys())
+        yield write_header(colnames)
+        for rows in execution.iter_chunks(result, chunk_size):
+            yield write_rows(colnames, rows)
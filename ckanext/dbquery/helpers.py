@@ -0,0 +1,12 @@
+from ckanext.dbquery import search
+
+
+def dbquery_highlight(text, q):
+    """ Highlight the matches of a history search in a query """
+    return search.highlight(text, q)
+
+
+def get_helpers():
+    return {
+        'dbquery_highlight': dbquery_highlight,
+    }
@@ -0,0 +1,145 @@
+import datetime
+import json
+import logging
+import time
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.dbquery.model import DBQueryJob, DBQuerySaved
+
+
+log = logging.getLogger(__name__)
+
+# Share of ckanext.dbquery.job_timeout a job's statement can run for
+JOB_TIMEOUT_FRACTION = 0.9
+
+
+def _job_timeout(data_dict):
+    """
+    The statement timeout (ms) of a query job: the requested one, capped
+    below ``ckanext.dbquery.job_timeout`` so the query is cancelled by
+    PostgreSQL before the worker kills the job
+    """
+    limit = int(toolkit.config.get('ckanext.dbquery.job_timeout') * 1000 * JOB_TIMEOUT_FRACTION)
+    timeout = data_dict.get('timeout')
+    if timeout in (None, ''):
+        timeout = toolkit.config.get('ckanext.dbquery.statement_timeout')
+    try:
+        timeout = int(timeout)
+    except (TypeError, ValueError):
+        # Reported by query_database
+        return timeout
+    return min(timeout, limit) if timeout > 0 else limit
+
+
+def run_query_job(job_id, data_dict):
+    """
+    Background job: run a query with query_database and store
+    the response (or the error) in its DBQueryJob record
+    """
+    job = DBQueryJob.get(job_id)
+    if not job:
+        log.error(f'DBQuery job {job_id} not found')
+        return
+
+    job.status = DBQueryJob.STATUS_RUNNING
+    job.save()
+
+    data_dict = dict(data_dict, timeout=_job_timeout(data_dict))
+    user = model.User.get(job.user_id)
+    try:
+        if not user:
+            raise toolkit.ValidationError({'user_id': [f'User {job.user_id} not found']})
+        context = {'ignore_auth': True, 'user': user.name, 'auth_user_obj': user}
+        result = toolkit.get_action('query_database')(context, data_dict)
+    except toolkit.ValidationError as e:
+        job.status = DBQueryJob.STATUS_FAILED
+        job.error = str(e.error_dict.get('query', e.error_dict))
+    except Exception as e:
+        # Including the worker's timeout, the job must not stay running
+        log.exception(f'DBQuery job {job_id} failed')
+        model.Session.rollback()
+        job.status = DBQueryJob.STATUS_FAILED
+        job.error = f'{type(e).__name__}: {e}'
+    else:
+        job.status = DBQueryJob.STATUS_FINISHED
+        job.result = json.dumps(result, default=str)
+
+    job.finished = datetime.datetime.utcnow()
+    job.save()
+    log.info(f'DBQuery job {job_id} {job.status}')
+
+
+def refresh_saved_query(saved_id, timeout=None):
+    """
+    Run a saved query with query_database, as its owner, and store the
+    response as its snapshot. If the query fails, the previous snapshot
+    is kept and the error is recorded. `timeout` is the statement timeout
+    in milliseconds (default: ``ckanext.dbquery.statement_timeout``).
+    """
+    saved = DBQuerySaved.get(saved_id)
+    if not saved:
+        log.error(f'Saved query {saved_id} not found')
+        return None
+
+    data_dict = {
+        'query': saved.query,
+        'limit': toolkit.config.get('ckanext.dbquery.max_rows'),
+        # Snapshots are always taken from fresh results
+        'cache': False,
+        'timeout': timeout,
+    }
+    started = time.perf_counter()
+    user = model.User.get(saved.owner_id)
+    try:
+        if not user:
+            raise toolkit.ValidationError({'owner_id': [f'User {saved.owner_id} not found']})
+        context = {'ignore_auth': True, 'user': user.name, 'auth_user_obj': user}
+        result = toolkit.get_action('query_database')(context, data_dict)
+    except toolkit.ValidationError as e:
+        saved.snapshot_status = DBQuerySaved.STATUS_ERROR
+        saved.snapshot_error = str(e.error_dict.get('query', e.error_dict))
+    except Exception as e:
+        # E.g. a lost connection, recorded like a query error
+        log.exception(f'Saved query {saved_id} refresh failed')
+        model.Session.rollback()
+        saved.snapshot_status = DBQuerySaved.STATUS_ERROR
+        saved.snapshot_error = f'{type(e).__name__}: {e}'
+    else:
+        saved.snapshot = json.dumps(result, default=str)
+        saved.snapshot_taken = datetime.datetime.utcnow()
+        saved.snapshot_status = DBQuerySaved.STATUS_OK
+        saved.snapshot_error = None
+    saved.snapshot_duration = round((time.perf_counter() - started) * 1000, 3)
+    saved.save()
+    log.info(f'Saved query {saved.name} refreshed: {saved.snapshot_status}')
+    return saved
+
+
+def refresh_saved_query_job(saved_id):
+    """
+    Background job: refresh a saved query, with its statement timeout
+    below ``ckanext.dbquery.job_timeout``
+    """
+    refresh_saved_query(saved_id, timeout=_job_timeout({}))
+
+
+def refresh_due_queries(refresh_all=False):
+    """
+    Refresh the saved queries whose refresh interval has passed (or all of
+    them). A refresh that can't even record its error doesn't stop the rest.
+    """
+    saved_queries = model.Session.query(DBQuerySaved).order_by(DBQuerySaved.name)
+    if not refresh_all:
+        saved_queries = saved_queries.filter(DBQuerySaved.refresh_interval > 0)
+    now = datetime.datetime.utcnow()
+    due = [saved.id for saved in saved_queries.all() if refresh_all or saved.is_due(now)]
+    refreshed = []
+    for saved_id in due:
+        try:
+            refreshed.append(refresh_saved_query(saved_id))
+        except Exception:
+            log.exception(f'Saved query {saved_id} could not be refreshed')
+            model.Session.rollback()
+    return refreshed
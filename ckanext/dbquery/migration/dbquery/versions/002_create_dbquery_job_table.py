@@ -0,0 +1,35 @@
+"""Create DBQueryJob table
+
+Revision ID: 002
+Revises: 001
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from ckan.model.types import make_uuid
+
+# revision identifiers, used by Alembic.
+revision = '002'
+down_revision = '001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'dbquery_job',
+        sa.Column('id', sa.UnicodeText, primary_key=True, default=make_uuid),
+        sa.Column('query', sa.UnicodeText, nullable=False),
+        sa.Column('user_id', sa.UnicodeText, nullable=False),
+        sa.Column('status', sa.UnicodeText, nullable=False),
+        sa.Column('result', sa.UnicodeText),
+        sa.Column('error', sa.UnicodeText),
+        sa.Column('created', sa.DateTime, server_default=sa.func.current_timestamp()),
+        sa.Column('finished', sa.DateTime),
+    )
+
+
+def downgrade():
+    op.drop_table('dbquery_job')
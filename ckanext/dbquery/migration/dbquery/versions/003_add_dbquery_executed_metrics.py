@@ -0,0 +1,32 @@
+"""Add execution metrics to DBQueryExecuted
+
+Revision ID: 003
+Revises: 002
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '003'
+down_revision = '002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Durations are stored in milliseconds
+    op.add_column('dbquery_executed', sa.Column('duration_execute', sa.Float))
+    op.add_column('dbquery_executed', sa.Column('duration_fetch', sa.Float))
+    op.add_column('dbquery_executed', sa.Column('duration_total', sa.Float))
+    op.add_column('dbquery_executed', sa.Column('row_count', sa.Integer))
+    op.add_column('dbquery_executed', sa.Column('result_bytes', sa.BigInteger))
+    op.add_column('dbquery_executed', sa.Column('status', sa.UnicodeText, server_default='ok'))
+    op.add_column('dbquery_executed', sa.Column('error', sa.UnicodeText))
+
+
+def downgrade():
+    for column in ('duration_execute', 'duration_fetch', 'duration_total',
+                   'row_count', 'result_bytes', 'status', 'error'):
+        op.drop_column('dbquery_executed', column)
@@ -0,0 +1,35 @@
+"""Add timestamp indexes to DBQueryExecuted
+
+Revision ID: 004
+Revises: 003
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '004'
+down_revision = '003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # `id` breaks ties between queries with the same timestamp
+    # so the indexes also serve the keyset pagination of the history
+    op.create_index(
+        'idx_dbquery_executed_timestamp',
+        'dbquery_executed',
+        [sa.text('"timestamp" DESC'), sa.text('id DESC')],
+    )
+    op.create_index(
+        'idx_dbquery_executed_user_timestamp',
+        'dbquery_executed',
+        ['user_id', sa.text('"timestamp" DESC'), sa.text('id DESC')],
+    )
+
+
+def downgrade():
+    op.drop_index('idx_dbquery_executed_user_timestamp', 'dbquery_executed')
+    op.drop_index('idx_dbquery_executed_timestamp', 'dbquery_executed')
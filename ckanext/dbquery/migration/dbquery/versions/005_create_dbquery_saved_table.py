@@ -0,0 +1,39 @@
+"""Create DBQuerySaved table
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from ckan.model.types import make_uuid
+
+# revision identifiers, used by Alembic.
+revision = '005'
+down_revision = '004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'dbquery_saved',
+        sa.Column('id', sa.UnicodeText, primary_key=True, default=make_uuid),
+        sa.Column('name', sa.UnicodeText, nullable=False, unique=True),
+        sa.Column('query', sa.UnicodeText, nullable=False),
+        sa.Column('owner_id', sa.UnicodeText, nullable=False),
+        sa.Column('refresh_interval', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('created', sa.DateTime, server_default=sa.func.current_timestamp()),
+        sa.Column('modified', sa.DateTime, server_default=sa.func.current_timestamp()),
+        sa.Column('snapshot', sa.UnicodeText),
+        sa.Column('snapshot_taken', sa.DateTime),
+        sa.Column('snapshot_duration', sa.Float),
+        sa.Column('snapshot_status', sa.UnicodeText),
+        sa.Column('snapshot_error', sa.UnicodeText),
+    )
+
+
+def downgrade():
+    op.drop_table('dbquery_saved')
@@ -0,0 +1,107 @@
+"""Partition DBQueryExecuted by month
+
+Revision ID: 006
+Revises: 005
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+import datetime
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '006'
+down_revision = '005'
+branch_labels = None
+depends_on = None
+
+# Partitions created ahead of the current month
+MONTHS_AHEAD = 3
+
+COLUMNS = (
+    'id, query, user_id, "timestamp", duration_execute, duration_fetch, '
+    'duration_total, row_count, result_bytes, status, error'
+)
+COLUMN_DEFINITIONS = """
+    id text NOT NULL,
+    query text NOT NULL,
+    user_id text NOT NULL,
+    "timestamp" timestamp without time zone NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    duration_execute double precision,
+    duration_fetch double precision,
+    duration_total double precision,
+    row_count integer,
+    result_bytes bigint,
+    status text DEFAULT 'ok',
+    error text
+"""
+
+
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def _create_indexes():
+    # Created on the partitioned table, so every partition gets them
+    op.execute('CREATE INDEX idx_dbquery_executed_timestamp ON dbquery_executed ("timestamp" DESC, id DESC)')
+    op.execute(
+        'CREATE INDEX idx_dbquery_executed_user_timestamp '
+        'ON dbquery_executed (user_id, "timestamp" DESC, id DESC)'
+    )
+
+
+def _rename_table(old, new):
+    op.execute(f'ALTER TABLE {old} RENAME TO {new}')
+    op.execute(f'ALTER INDEX IF EXISTS idx_{old}_timestamp RENAME TO idx_{new}_timestamp')
+    op.execute(f'ALTER INDEX IF EXISTS idx_{old}_user_timestamp RENAME TO idx_{new}_user_timestamp')
+    op.execute(f'ALTER INDEX IF EXISTS {old}_pkey RENAME TO {new}_pkey')
+
+
+def upgrade():
+    conn = op.get_bind()
+    _rename_table('dbquery_executed', 'dbquery_executed_unpartitioned')
+
+    # The partition key must be part of the primary key
+    op.execute(f"""
+        CREATE TABLE dbquery_executed ({COLUMN_DEFINITIONS},
+            PRIMARY KEY (id, "timestamp")
+        ) PARTITION BY RANGE ("timestamp")
+    """)
+    op.execute('CREATE TABLE dbquery_executed_default PARTITION OF dbquery_executed DEFAULT')
+
+    # A partition for every month with records, up to a few months ahead
+    today = datetime.datetime.utcnow().date()
+    first = conn.execute('SELECT min("timestamp") FROM dbquery_executed_unpartitioned').scalar()
+    month = datetime.date((first or today).year, (first or today).month, 1)
+    last = _add_months(datetime.date(today.year, today.month, 1), MONTHS_AHEAD)
+    while month <= last:
+        op.execute(
+            f'CREATE TABLE dbquery_executed_p{month.year:04d}{month.month:02d} PARTITION OF dbquery_executed '
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')"
+        )
+        month = _add_months(month, 1)
+
+    op.execute(f"""
+        INSERT INTO dbquery_executed ({COLUMNS})
+        SELECT id, query, user_id, COALESCE("timestamp", now() AT TIME ZONE 'utc'), duration_execute,
+            duration_fetch, duration_total, row_count, result_bytes, status, error
+        FROM dbquery_executed_unpartitioned
+    """)
+    op.execute('DROP TABLE dbquery_executed_unpartitioned')
+    _create_indexes()
+
+
+def downgrade():
+    _rename_table('dbquery_executed', 'dbquery_executed_partitioned')
+    op.execute(f'CREATE TABLE dbquery_executed ({COLUMN_DEFINITIONS}, PRIMARY KEY (id))')
+    # Ids were only unique with their timestamp, keep the newest record of each
+    op.execute(f"""
+        INSERT INTO dbquery_executed ({COLUMNS})
+        SELECT DISTINCT ON (id) {COLUMNS}
+        FROM dbquery_executed_partitioned
+        ORDER BY id, "timestamp" DESC
+    """)
+    # Drops the partitions too, the ones detached by `ckan dbquery purge` are kept
+    op.execute('DROP TABLE dbquery_executed_partitioned')
+    _create_indexes()
@@ -0,0 +1,29 @@
+"""Add a trigram index on the query of DBQueryExecuted
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '007'
+down_revision = '006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # pg_trgm is a trusted extension (PostgreSQL 13+), the database owner can create it
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # Created on the partitioned table, so every partition gets its own index
+    op.execute(
+        'CREATE INDEX idx_dbquery_executed_query_trgm '
+        'ON dbquery_executed USING gin (query gin_trgm_ops)'
+    )
+
+
+def downgrade():
+    # The extension is left in place, other tables may use it
+    op.execute('DROP INDEX IF EXISTS idx_dbquery_executed_query_trgm')
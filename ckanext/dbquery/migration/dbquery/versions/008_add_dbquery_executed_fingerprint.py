@@ -0,0 +1,30 @@
+"""Add the query fingerprint to DBQueryExecuted
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '008'
+down_revision = '007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('dbquery_executed', sa.Column('fingerprint', sa.UnicodeText))
+    # Groups by fingerprint in a time window with an index only scan,
+    # existing records are fingerprinted by `ckan dbquery fingerprint`
+    op.execute(
+        'CREATE INDEX idx_dbquery_executed_fingerprint '
+        'ON dbquery_executed (fingerprint, "timestamp") INCLUDE (duration_total, row_count)'
+    )
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS idx_dbquery_executed_fingerprint')
+    op.drop_column('dbquery_executed', 'fingerprint')
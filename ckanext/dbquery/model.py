@@ -1,4 +1,5 @@
 import datetime
+import json
 
 from sqlalchemy import Column, types
 
@@ -7,25 +8,58 @@ from ckan.plugins import toolkit
 
 from ckan.model.types import make_uuid
 
+from ckanext.dbquery import sql
+
+
+def _default_fingerprint(context):
+    return sql.fingerprint(context.get_current_parameters().get('query'))
+
 
 class DBQueryExecuted(toolkit.BaseModel):
     """Model for storing executed queries by users."""
 
     __tablename__ = 'dbquery_executed'
 
+    # The table is partitioned by month (see partitions.py) and its primary
+    # key is (id, timestamp), ids are still unique in practice
     id = Column(types.UnicodeText, primary_key=True, default=make_uuid)
     query = Column(types.UnicodeText, nullable=False)
     user_id = Column(types.UnicodeText, nullable=False)
     timestamp = Column(types.DateTime, default=datetime.datetime.utcnow)
+    # Execution metrics, durations in milliseconds
+    duration_execute = Column(types.Float)
+    duration_fetch = Column(types.Float)
+    duration_total = Column(types.Float)
+    row_count = Column(types.Integer)
+    result_bytes = Column(types.BigInteger)
+    # ok, error, timeout or cancelled
+    status = Column(types.UnicodeText, default='ok')
+    error = Column(types.UnicodeText)
+    # Hash of the query with its constants replaced, see sql.fingerprint()
+    fingerprint = Column(types.UnicodeText, default=_default_fingerprint)
 
     def dictize(self):
         return {
             'id': self.id,
             'query': self.query,
+            'fingerprint': self.fingerprint,
             'user_id': self.user_id,
             'timestamp': self.timestamp.isoformat(),
+            'duration_execute': self.duration_execute,
+            'duration_fetch': self.duration_fetch,
+            'duration_total': self.duration_total,
+            'row_count': self.row_count,
+            'result_bytes': self.result_bytes,
+            'status': self.status,
+            'error': self.error,
+            'cursor': self.cursor,
         }
 
+    @property
+    def cursor(self):
+        """ Keyset pagination cursor for the queries older than this one """
+        return f'{self.timestamp.isoformat()},{self.id}'
+
     def save(self):
         model.Session.add(self)
         model.Session.commit()
@@ -44,3 +78,126 @@ class DBQueryExecuted(toolkit.BaseModel):
             query = query.filter_by(timestamp=date)
         query = query.order_by(DBQueryExecuted.timestamp.desc())
         return query.limit(limit).all()
+
+
+class DBQueryJob(toolkit.BaseModel):
+    """Model for queries executed as background jobs and their results."""
+
+    __tablename__ = 'dbquery_job'
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_FINISHED = 'finished'
+    STATUS_FAILED = 'failed'
+
+    id = Column(types.UnicodeText, primary_key=True, default=make_uuid)
+    query = Column(types.UnicodeText, nullable=False)
+    user_id = Column(types.UnicodeText, nullable=False)
+    status = Column(types.UnicodeText, nullable=False, default=STATUS_QUEUED)
+    # JSON encoded query_database response
+    result = Column(types.UnicodeText)
+    error = Column(types.UnicodeText)
+    created = Column(types.DateTime, default=datetime.datetime.utcnow)
+    finished = Column(types.DateTime)
+
+    def dictize(self):
+        return {
+            'id': self.id,
+            'query': self.query,
+            'user_id': self.user_id,
+            'status': self.status,
+            'error': self.error,
+            'created': self.created.isoformat(),
+            'finished': self.finished.isoformat() if self.finished else None,
+        }
+
+    def get_result(self):
+        return json.loads(self.result) if self.result else None
+
+    def save(self):
+        model.Session.add(self)
+        model.Session.commit()
+        model.Session.refresh(self)
+        return self
+
+    @classmethod
+    def get(cls, job_id):
+        return model.Session.query(cls).get(job_id)
+
+
+class DBQuerySaved(toolkit.BaseModel):
+    """Model for named queries, refreshed into snapshots of their results."""
+
+    __tablename__ = 'dbquery_saved'
+
+    STATUS_OK = 'ok'
+    STATUS_ERROR = 'error'
+
+    id = Column(types.UnicodeText, primary_key=True, default=make_uuid)
+    name = Column(types.UnicodeText, nullable=False, unique=True)
+    query = Column(types.UnicodeText, nullable=False)
+    owner_id = Column(types.UnicodeText, nullable=False)
+    # Minutes between automatic refreshes, 0 to refresh only on demand
+    refresh_interval = Column(types.Integer, nullable=False, default=0)
+    created = Column(types.DateTime, default=datetime.datetime.utcnow)
+    modified = Column(types.DateTime, default=datetime.datetime.utcnow)
+    # JSON encoded query_database response of the last refresh
+    snapshot = Column(types.UnicodeText)
+    snapshot_taken = Column(types.DateTime)
+    snapshot_duration = Column(types.Float)
+    snapshot_status = Column(types.UnicodeText)
+    snapshot_error = Column(types.UnicodeText)
+
+    def dictize(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'query': self.query,
+            'owner_id': self.owner_id,
+            'refresh_interval': self.refresh_interval,
+            'created': self.created.isoformat(),
+            'modified': self.modified.isoformat(),
+            'snapshot_taken': self.snapshot_taken.isoformat() if self.snapshot_taken else None,
+            'snapshot_age': self.snapshot_age,
+            'snapshot_duration': self.snapshot_duration,
+            'snapshot_status': self.snapshot_status,
+            'snapshot_error': self.snapshot_error,
+            'due': self.is_due(),
+        }
+
+    @property
+    def snapshot_age(self):
+        """ Seconds since the last refresh, None if it was never refreshed """
+        if not self.snapshot_taken:
+            return None
+        return round((datetime.datetime.utcnow() - self.snapshot_taken).total_seconds(), 3)
+
+    def is_due(self, now=None):
+        """ Check if the automatic refresh interval has passed since the last refresh """
+        if not self.refresh_interval:
+            return False
+        if not self.snapshot_taken:
+            return True
+        now = now or datetime.datetime.utcnow()
+        return now - self.snapshot_taken >= datetime.timedelta(minutes=self.refresh_interval)
+
+    def get_snapshot(self):
+        return json.loads(self.snapshot) if self.snapshot else None
+
+    def save(self):
+        model.Session.add(self)
+        model.Session.commit()
+        model.Session.refresh(self)
+        return self
+
+    def delete(self):
+        model.Session.delete(self)
+        model.Session.commit()
+
+    @classmethod
+    def get(cls, saved_id):
+        return model.Session.query(cls).get(saved_id)
+
+    @classmethod
+    def get_by_name(cls, name):
+        return model.Session.query(cls).filter(cls.name == name).first()
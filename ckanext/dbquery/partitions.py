@@ -0,0 +1,206 @@
+"""
+Monthly partitions of the `dbquery_executed` audit table.
+
+The table is range-partitioned by `timestamp`, with one partition per month
+named `dbquery_executed_pYYYYMM` and a default partition for the rows out
+of any month partition. Partitions are created ahead of time, so rows never
+land in the default partition in normal operation, and old ones are purged
+by detaching and dropping them, which is instant and leaves nothing to vacuum.
+"""
+import datetime
+import gzip
+import logging
+import os
+import re
+import time
+
+from sqlalchemy.sql.expression import text
+
+from ckan import model
+from ckan.plugins import toolkit
+
+
+log = logging.getLogger(__name__)
+
+PARENT = 'dbquery_executed'
+DEFAULT_PARTITION = 'dbquery_executed_default'
+_PARTITION_NAME = re.compile(r'^dbquery_executed_p(\d{4})(\d{2})$')
+# Rows deleted per statement when purging the default partition
+DELETE_BATCH_SIZE = 10000
+
+# Month up to which the partitions are known to exist, in this process
+_ensured_until = None
+
+
+def month_start(day):
+    """ First day of the month of a date """
+    return datetime.date(day.year, day.month, 1)
+
+
+def add_months(month, months):
+    """ First day of the month `months` after (or before, if negative) `month` """
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{PARENT}_p{month.year:04d}{month.month:02d}'
+
+
+def partition_month(name):
+    """ Month of a partition from its name, None for other tables """
+    match = _PARTITION_NAME.match(name)
+    return datetime.date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def list_partitions(conn):
+    """ Names of the partitions of the audit table """
+    return conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :parent ORDER BY c.relname"
+    ), parent=PARENT).scalars().all()
+
+
+def is_partitioned(conn):
+    return bool(conn.execute(
+        text("SELECT 1 FROM pg_partitioned_table t JOIN pg_class c ON c.oid = t.partrelid WHERE c.relname = :parent"),
+        parent=PARENT,
+    ).scalar())
+
+
+def ensure_partitions(months_ahead=None, today=None, since=None):
+    """
+    Create the partitions of the current month and the next `months_ahead`
+    ones (``ckanext.dbquery.partition_months_ahead``) that don't exist yet,
+    and of the past months from the one of `since`, e.g. before loading old
+    records. Returns the names of the created partitions.
+    """
+    global _ensured_until
+    if months_ahead is None:
+        months_ahead = toolkit.config.get('ckanext.dbquery.partition_months_ahead')
+    current = month_start(today or datetime.datetime.utcnow().date())
+    last = add_months(current, months_ahead)
+
+    created = []
+    with model.meta.engine.begin() as conn:
+        if not is_partitioned(conn):
+            return created
+        existing = set(list_partitions(conn))
+        month = min(month_start(since), current) if since else current
+        while month <= last:
+            name = partition_name(month)
+            if name not in existing:
+                conn.execute(text(
+                    f'CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT} '
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+                ))
+                created.append(name)
+            month = add_months(month, 1)
+    if created:
+        log.info(f'Audit table partitions created: {", ".join(created)}')
+    _ensured_until = last
+    return created
+
+
+def ensure_current_partitions():
+    """
+    Make sure the partition of the current month exists before writing audit
+    records. Only checks the database once per month and process.
+    """
+    current = month_start(datetime.datetime.utcnow().date())
+    if _ensured_until is not None and _ensured_until >= current:
+        return
+    try:
+        ensure_partitions()
+    except Exception as e:
+        # The records still go to the default partition
+        log.error(f'Error creating the audit table partitions: {e}')
+
+
+def expired_partitions(conn, retention_months, today=None):
+    """ Names of the month partitions older than the retention, oldest first """
+    cutoff = add_months(month_start(today or datetime.datetime.utcnow().date()), -retention_months)
+    return [
+        name for name in list_partitions(conn)
+        if partition_month(name) and partition_month(name) < cutoff
+    ]
+
+
+def archive_partition(conn, name, directory):
+    """ Copy a partition to a gzipped CSV file (with a header line) and return its path """
+    path = os.path.join(directory, f'{name}.csv.gz')
+    cursor = conn.connection.cursor()
+    with gzip.open(path, 'wb') as archive:
+        cursor.copy_expert(f'COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)', archive)
+    cursor.close()
+    return path
+
+
+def _with_lock_timeout(engine, statement, lock_timeout, retries=3):
+    """
+    Run a DDL statement that locks the audit table with a lock_timeout, so it
+    gives up instead of queueing behind long queries (and blocking every
+    request behind it), and retry it a few times.
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("SELECT set_config('lock_timeout', :timeout, true)"), timeout=str(lock_timeout))
+                conn.execute(text(statement))
+            return
+        except Exception as e:
+            # lock_not_available
+            if getattr(getattr(e, 'orig', None), 'pgcode', None) != '55P03' or attempt == retries:
+                raise
+            log.warning(f'Lock timeout running "{statement}", attempt {attempt} of {retries}')
+            time.sleep(attempt)
+
+
+def purge(retention_months, archive_dir=None, drop=True, dry_run=False, today=None):
+    """
+    Remove the audit records older than `retention_months` months.
+
+    Expired month partitions are archived to `archive_dir` (if given), then
+    detached and, with `drop`, dropped. Detached partitions are kept as
+    plain tables otherwise. Expired rows of the default partition are deleted
+    in batches. Returns a list of (partition, action) tuples.
+    """
+    engine = model.meta.engine
+    lock_timeout = toolkit.config.get('ckanext.dbquery.purge_lock_timeout')
+    done = []
+    with engine.connect() as conn:
+        if not is_partitioned(conn):
+            raise toolkit.ValidationError({'dbquery_executed': ['The audit table is not partitioned, run the migrations']})
+        expired = expired_partitions(conn, retention_months, today=today)
+
+    for name in expired:
+        if dry_run:
+            done.append((name, 'expired'))
+            continue
+        if archive_dir:
+            with engine.connect() as conn:
+                path = archive_partition(conn, name, archive_dir)
+            done.append((name, f'archived to {path}'))
+        _with_lock_timeout(engine, f'ALTER TABLE {PARENT} DETACH PARTITION {name}', lock_timeout)
+        done.append((name, 'detached'))
+        if drop:
+            # The table is no longer part of the audit table, dropping it doesn't lock it
+            _with_lock_timeout(engine, f'DROP TABLE {name}', lock_timeout)
+            done.append((name, 'dropped'))
+
+    cutoff = add_months(month_start(today or datetime.datetime.utcnow().date()), -retention_months)
+    deleted = 0
+    while not dry_run:
+        with engine.begin() as conn:
+            count = conn.execute(text(
+                f'DELETE FROM {DEFAULT_PARTITION} WHERE ctid IN '
+                f'(SELECT ctid FROM {DEFAULT_PARTITION} WHERE "timestamp" < :cutoff LIMIT {DELETE_BATCH_SIZE})'
+            ), cutoff=cutoff).rowcount
+        deleted += count
+        if count < DELETE_BATCH_SIZE:
+            break
+    if deleted:
+        done.append((DEFAULT_PARTITION, f'{deleted} rows deleted'))
+    return done
@@ -3,16 +3,19 @@ import logging
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 from ckanext.dbquery.blueprints.dbquery import dbquery_bp
-from ckanext.dbquery import actions, auth
+from ckanext.dbquery import actions, auth, cli, helpers
 
 log = logging.getLogger(__name__)
 
 
+@toolkit.blanket.config_declarations
 class DbqueryPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IBlueprint)
+    plugins.implements(plugins.IClick)
+    plugins.implements(plugins.ITemplateHelpers)
 
     # IConfigurer
 
@@ -25,12 +28,38 @@ class DbqueryPlugin(plugins.SingletonPlugin):
     def get_blueprint(self):
         return [dbquery_bp]
 
+    # ITemplateHelpers
+
+    def get_helpers(self):
+        return helpers.get_helpers()
+
+    # IClick
+
+    def get_commands(self):
+        return cli.get_commands()
+
     # IActions
     def get_actions(self):
         return {
             "query_database": actions.query_database,
             "dbquery_executed_list": actions.dbquery_executed_list,
+            "dbquery_executed_stats": actions.dbquery_executed_stats,
+            "dbquery_fingerprint_stats": actions.dbquery_fingerprint_stats,
             "dbquery_executor_users_list": actions.dbquery_executor_users_list,
+            "dbquery_running_list": actions.dbquery_running_list,
+            "dbquery_cancel": actions.dbquery_cancel,
+            "dbquery_activity": actions.dbquery_activity,
+            "dbquery_schema": actions.dbquery_schema,
+            "dbquery_slot_usage": actions.dbquery_slot_usage,
+            "dbquery_job_status": actions.dbquery_job_status,
+            "dbquery_job_result": actions.dbquery_job_result,
+            "dbquery_pool_stats": actions.dbquery_pool_stats,
+            "dbquery_saved_create": actions.dbquery_saved_create,
+            "dbquery_saved_update": actions.dbquery_saved_update,
+            "dbquery_saved_delete": actions.dbquery_saved_delete,
+            "dbquery_saved_list": actions.dbquery_saved_list,
+            "dbquery_saved_show": actions.dbquery_saved_show,
+            "dbquery_saved_refresh": actions.dbquery_saved_refresh,
         }
 
     # IAuthFunctions
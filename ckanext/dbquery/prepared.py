@@ -0,0 +1,106 @@
+import collections
+import hashlib
+import logging
+
+from sqlalchemy.sql.expression import text
+
+from ckanext.dbquery import sql
+
+
+log = logging.getLogger(__name__)
+
+# Key of the prepared statements cache in the DBAPI connection info
+_INFO_KEY = 'dbquery_prepared'
+# Statements whose EXECUTE failed, deallocated on the next use of the connection
+_STALE_KEY = 'dbquery_prepared_stale'
+
+
+def statement_name(positional):
+    """ Name of the prepared statement for a statement shape """
+    return 'dbquery_' + hashlib.md5(positional.encode('utf-8')).hexdigest()[:16]
+
+
+def _cache(conn):
+    """
+    Prepared statements of a connection, oldest used first. Prepared
+    statements live as long as the PostgreSQL session, so the cache is
+    kept with the DBAPI connection and survives pool checkouts.
+    """
+    return conn.connection.info.setdefault(_INFO_KEY, collections.OrderedDict())
+
+
+def _deallocate(conn, name):
+    conn.execution_options(no_parameters=True).exec_driver_sql(f'DEALLOCATE {name}')
+
+
+def _deallocate_stale(conn):
+    """
+    Deallocate the statements dropped from the cache after a failed EXECUTE.
+    It can't be done right away: the failure aborts the transaction.
+    """
+    stale = conn.connection.info.get(_STALE_KEY)
+    while stale:
+        _deallocate(conn, stale.pop())
+
+
+def _prepare(conn, name, positional):
+    """ PREPARE a statement. Returns False if PostgreSQL can't prepare it """
+    # A savepoint, so a failed PREPARE doesn't abort the transaction
+    savepoint = conn.begin_nested()
+    try:
+        # Sent as is: the statement has no bind parameters left
+        conn.execution_options(no_parameters=True).exec_driver_sql(f'PREPARE {name} AS {positional}')
+    except Exception as e:
+        log.debug(f'Statement can not be prepared, running it without PREPARE: {e}')
+        savepoint.rollback()
+        return False
+    savepoint.commit()
+    return True
+
+
+def execute(conn, statement, names, params, cache_size):
+    """
+    Run a statement with `:name` bind parameters as a server-side prepared
+    statement, so PostgreSQL plans each statement shape once per session
+    instead of on every execution.
+
+    Up to `cache_size` prepared statements are kept per connection, the least
+    recently used ones are deallocated, and so are the ones whose EXECUTE
+    fails. Returns None if the statement can't be
+    prepared (e.g. the type of a parameter can't be inferred), the caller must
+    then run it with the values inlined.
+    """
+    _deallocate_stale(conn)
+    positional = sql.to_positional(statement, names)
+    cache = _cache(conn)
+    if positional in cache:
+        cache.move_to_end(positional)
+        name = cache[positional]
+    else:
+        name = statement_name(positional)
+        if not _prepare(conn, name, positional):
+            # Remember it, not to try again on every execution
+            name = None
+        cache[positional] = name
+        while len(cache) > cache_size:
+            _, old_name = cache.popitem(last=False)
+            if old_name:
+                _deallocate(conn, old_name)
+    if not name:
+        return None
+
+    placeholders = ', '.join(f':p{i}' for i in range(len(names)))
+    values = {f'p{i}': params[param] for i, param in enumerate(names)}
+    try:
+        return conn.execute(text(f'EXECUTE {name} ({placeholders})').bindparams(**values))
+    except Exception:
+        # E.g. "cached plan must not change result type" after DDL on its
+        # tables: prepare it again next time instead of failing on every call
+        del cache[positional]
+        conn.connection.info.setdefault(_STALE_KEY, []).append(name)
+        raise
+
+
+def prepared_statements(conn):
+    """ Names of the statements prepared on a connection """
+    return [name for name in _cache(conn).values() if name]
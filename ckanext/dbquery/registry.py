@@ -0,0 +1,48 @@
+"""
+In-process registry of the statements currently executed by this extension.
+Each CKAN worker process keeps its own registry.
+"""
+import datetime
+import threading
+
+from ckan.model.types import make_uuid
+
+
+_lock = threading.Lock()
+_running = {}
+
+
+def register(pid, user_id, query, read_only=False):
+    """
+    Register a running statement and return its registry id.
+    `read_only` tells the statement runs on the read engine.
+    """
+    entry_id = make_uuid()
+    with _lock:
+        _running[entry_id] = {
+            'id': entry_id,
+            'pid': pid,
+            'user_id': user_id,
+            'started': datetime.datetime.utcnow(),
+            'query': query,
+            'read_only': read_only,
+        }
+    return entry_id
+
+
+def unregister(entry_id):
+    with _lock:
+        _running.pop(entry_id, None)
+
+
+def get(entry_id):
+    with _lock:
+        entry = _running.get(entry_id)
+        return dict(entry) if entry else None
+
+
+def running():
+    """ Return the running statements, oldest first """
+    with _lock:
+        entries = [dict(entry) for entry in _running.values()]
+    return sorted(entries, key=lambda entry: entry['started'])
@@ -0,0 +1,151 @@
+"""
+Catalog of the database schema for the query editor: the tables and views
+with their columns, types, indexes and row estimates, read from pg_catalog.
+
+The catalog is built with three queries, in one snapshot, and kept in
+process for ``ckanext.dbquery.schema_cache_ttl`` seconds. DDL run through
+this extension clears it at once in the process that ran it, other
+processes see the change when their copy expires.
+"""
+import datetime
+import threading
+import time
+
+from sqlalchemy.sql.expression import text
+
+
+# The relations of the system schemas and the partitions of partitioned
+# tables (e.g. the monthly ones of the audit table) are left out
+_RELATIONS_FILTER = """
+    c.relkind IN ('r', 'p', 'v', 'm', 'f')
+    AND NOT c.relispartition
+    AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+    AND n.nspname NOT LIKE 'pg\\_toast%'
+    AND n.nspname NOT LIKE 'pg\\_temp\\_%'
+"""
+
+_TABLES = text(f"""
+    SELECT
+        c.oid,
+        n.nspname AS schema,
+        c.relname AS name,
+        c.relkind AS kind,
+        c.reltuples::bigint AS row_estimate,
+        obj_description(c.oid, 'pg_class') AS comment
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE {_RELATIONS_FILTER}
+    ORDER BY n.nspname, c.relname
+""")
+
+_COLUMNS = text(f"""
+    SELECT
+        a.attrelid AS oid,
+        a.attname AS name,
+        format_type(a.atttypid, a.atttypmod) AS type,
+        NOT a.attnotnull AS nullable,
+        pg_get_expr(d.adbin, d.adrelid) AS default
+    FROM pg_attribute a
+    JOIN pg_class c ON c.oid = a.attrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+    WHERE a.attnum > 0 AND NOT a.attisdropped AND {_RELATIONS_FILTER}
+    ORDER BY a.attrelid, a.attnum
+""")
+
+_INDEXES = text(f"""
+    SELECT
+        x.indrelid AS oid,
+        i.relname AS name,
+        x.indisprimary AS primary,
+        x.indisunique AS unique,
+        pg_get_indexdef(x.indexrelid) AS definition
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_class c ON c.oid = x.indrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE {_RELATIONS_FILTER}
+    ORDER BY x.indrelid, NOT x.indisprimary, i.relname
+""")
+
+KINDS = {
+    'r': 'table',
+    'p': 'partitioned table',
+    'v': 'view',
+    'm': 'materialized view',
+    'f': 'foreign table',
+}
+
+
+def introspect(conn):
+    """
+    The tables of the database, each one with its `columns` (name, type,
+    nullable, default) and `indexes` (name, primary, unique, definition).
+    `row_estimate` is the planner's estimate (pg_class.reltuples), None for
+    the tables that were never vacuumed or analyzed. Run it in a REPEATABLE
+    READ transaction for a consistent catalog.
+    """
+    tables = {}
+    for row in conn.execute(_TABLES).mappings():
+        table = dict(row)
+        oid = table.pop('oid')
+        table['kind'] = KINDS[table['kind']]
+        # -1 until the first VACUUM or ANALYZE (0 before PostgreSQL 14)
+        if table['row_estimate'] is not None and table['row_estimate'] < 0:
+            table['row_estimate'] = None
+        table['columns'] = []
+        table['indexes'] = []
+        tables[oid] = table
+    # Outside a snapshot, tables can be created between the queries
+    for row in conn.execute(_COLUMNS).mappings():
+        column = dict(row)
+        table = tables.get(column.pop('oid'))
+        if table is not None:
+            table['columns'].append(column)
+    for row in conn.execute(_INDEXES).mappings():
+        index = dict(row)
+        table = tables.get(index.pop('oid'))
+        if table is not None:
+            table['indexes'].append(index)
+    return list(tables.values())
+
+
+class SchemaCache(object):
+    """ The catalog of the schema, built at most once per TTL """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (catalog, time stored)
+        self._entry = None
+        # Changed by every invalidation, so a catalog read while DDL runs isn't kept
+        self._generation = 0
+
+    def get(self, load, ttl):
+        """
+        Return a (catalog, age in seconds) tuple, calling `load` to build the
+        catalog if there is no fresh one (the age is None then). Concurrent requests wait for the
+        one building it instead of introspecting the database again.
+        """
+        with self._lock:
+            entry = self._entry
+            if entry is not None:
+                catalog, stored = entry
+                age = time.monotonic() - stored
+                if age <= ttl:
+                    return catalog, age
+            generation = self._generation
+            catalog = {
+                'tables': load(),
+                'generated': datetime.datetime.utcnow().isoformat(),
+            }
+            if ttl > 0 and generation == self._generation:
+                self._entry = (catalog, time.monotonic())
+            return catalog, None
+
+    def invalidate(self):
+        # Without the lock, not to wait for a catalog being built
+        self._generation += 1
+        self._entry = None
+
+
+schema_cache = SchemaCache()
@@ -0,0 +1,46 @@
+"""
+Substring search over the query history, served by the trigram (pg_trgm)
+GIN index on `dbquery_executed.query`.
+"""
+import re
+
+from markupsafe import Markup, escape
+
+
+# pg_trgm can only use the index for terms with at least one trigram
+MIN_TERM_LENGTH = 3
+MAX_TERMS = 10
+
+
+def terms(q):
+    """ Search terms of a `q` string: the words it has, without duplicates """
+    found = []
+    for term in (q or '').split():
+        if term.lower() not in [t.lower() for t in found]:
+            found.append(term)
+    return found[:MAX_TERMS]
+
+
+def like_pattern(term):
+    """ ILIKE pattern matching `term` anywhere, with its wildcards escaped """
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def highlight(text, q):
+    """ HTML-escaped `text` with the matches of the `q` terms in <mark> tags """
+    text = text or ''
+    words = terms(q)
+    if not words:
+        return escape(text)
+    # Longest terms first, so a term inside another one doesn't split its match
+    words.sort(key=len, reverse=True)
+    pattern = re.compile('|'.join(re.escape(word) for word in words), re.IGNORECASE)
+    parts = []
+    position = 0
+    for match in pattern.finditer(text):
+        parts.append(escape(text[position:match.start()]))
+        parts.append(Markup('<mark>%s</mark>') % match.group())
+        position = match.end()
+    parts.append(escape(text[position:]))
+    return Markup('').join(parts)
@@ -0,0 +1,114 @@
+import datetime
+import decimal
+import uuid
+
+
+# Shapes of the rows in the query_database response
+RECORDS = 'records'
+ROWS = 'rows'
+COLUMNS = 'columns'
+FORMATS = (RECORDS, ROWS, COLUMNS)
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+def _bytea(value):
+    # PostgreSQL's hex format for bytea
+    return '\\x' + bytes(value).hex()
+
+
+def _array(value):
+    return [_convert(item) for item in value]
+
+
+def _convert(value):
+    converter = _converter(type(value))
+    return converter(value) if converter else value
+
+
+# JSON-safe conversion by Python type, types not listed are kept as they are
+_CONVERTERS = {
+    decimal.Decimal: str,
+    uuid.UUID: str,
+    datetime.datetime: _isoformat,
+    datetime.date: _isoformat,
+    datetime.time: _isoformat,
+    datetime.timedelta: str,
+    bytes: _bytea,
+    memoryview: _bytea,
+    list: _array,
+}
+
+
+def _converter(value_type):
+    """ JSON-safe converter for a Python type, None if the values can be kept as they are """
+    return _CONVERTERS.get(value_type)
+
+
+def _checked(value_type, converter):
+    """ Converter for the values of a type, converting any other value by its own type """
+    def convert(value):
+        return converter(value) if type(value) is value_type else _convert(value)
+    return convert
+
+
+def column_converters(rows, width):
+    """
+    A converter (or None) per column, chosen from the first non-null value.
+    PostgreSQL columns have a single type, so the converter is looked up once
+    per column instead of once per value. json and jsonb columns can mix
+    arrays, objects and scalars though, so columns whose first value is an
+    array convert every value by its own type, and values of another type
+    than the first one are never given its converter.
+    """
+    converters = []
+    for i in range(width):
+        sample = next((row[i] for row in rows if row[i] is not None), None)
+        converter = _converter(type(sample))
+        if converter is _array:
+            converter = _convert
+        elif converter:
+            converter = _checked(type(sample), converter)
+        converters.append(converter)
+    return converters
+
+
+def to_columns(rows, width):
+    """ One list of JSON-safe values per column """
+    columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in range(width)]
+    for i, converter in enumerate(column_converters(rows, width)):
+        if converter:
+            columns[i] = [None if value is None else converter(value) for value in columns[i]]
+    return columns
+
+
+def to_rows(rows, width):
+    """ One list of JSON-safe values per row """
+    if not any(column_converters(rows, width)):
+        return [list(row) for row in rows]
+    return [list(row) for row in zip(*to_columns(rows, width))]
+
+
+def shape(colnames, rows, fmt=RECORDS):
+    """
+    Build the rows of a response in the requested format:
+    `records` (a dict per row, values as returned by the database),
+    `rows` (a list per row) or `columns` (a list per column, under the
+    `columns` key). `rows` and `columns` don't repeat the column names on
+    every row and their values are JSON-safe: Decimal, UUID and timedelta
+    values as strings, dates and times in ISO 8601 and bytea as hex.
+    """
+    if fmt == COLUMNS:
+        return {'columns': to_columns(rows, len(colnames))}
+    if fmt == ROWS:
+        return {'rows': to_rows(rows, len(colnames))}
+    return {'rows': [dict(zip(colnames, row)) for row in rows]}
+
+
+def count(data):
+    """ Number of rows of a result built by shape() """
+    if 'columns' in data:
+        return len(data['columns'][0]) if data['columns'] else 0
+    return len(data['rows'])
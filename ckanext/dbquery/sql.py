@@ -0,0 +1,196 @@
+import hashlib
+import re
+
+
+# Leading whitespace, line comments and block comments before the first keyword
+_LEADING_NOISE = re.compile(r'^(\s+|--[^\n]*(\n|$)|/\*.*?\*/)+', re.DOTALL)
+# Comments, literals, quoted identifiers and statement separators.
+# The leftmost match wins, so a ';' or '--' inside a literal is part of the literal.
+_TOKEN = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<dollar>\$(?P<tag>[A-Za-z_][A-Za-z_0-9]*|)\$.*?\$(?P=tag)\$)
+  | (?P<string>(?<!\w)[Ee]'(?:[^'\\]|\\.|'')*'|'(?:[^']|'')*')
+  | (?P<ident>"(?:[^"]|"")*")
+  | (?P<semicolon>;)
+""", re.DOTALL | re.VERBOSE)
+
+# Bind parameters as parsed by SQLAlchemy's text(): `:name`, but not `::type` casts
+_BIND_PARAM = re.compile(r'(?<![:\w\\]):(\w+)(?!:)')
+
+# Numeric constants, not part of an identifier or a $n placeholder
+_NUMBER = re.compile(r'(?<![\w$.])(\d+\.?\d*|\.\d+)(e[+-]?\d+)?(?![\w.])', re.IGNORECASE)
+# $n placeholders, already normalized `?` are kept
+_POSITIONAL = re.compile(r'\$\d+')
+# Lists of placeholders, e.g. the values of an IN list
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(\s*,\s*\?)+\s*\)')
+# Whitespace around operators and punctuation, which doesn't change a statement
+_SPACED_PUNCTUATION = re.compile(r'\s*([^\w\s])\s*')
+
+SELECT = 'select'
+DML = 'dml'
+DDL = 'ddl'
+UTILITY = 'utility'
+
+_DML_KEYWORDS = ('insert', 'update', 'delete', 'merge', 'copy')
+# Statements that can be PREPAREd
+_PREPARABLE_KEYWORDS = ('select', 'with', 'values', 'table', 'insert', 'update', 'delete', 'merge')
+_DDL_KEYWORDS = ('create', 'alter', 'drop', 'truncate', 'comment', 'grant', 'revoke', 'security')
+
+
+def first_keyword(query):
+    """ Return the first SQL keyword of a statement, lowercased """
+    stripped = _LEADING_NOISE.sub('', query or '').lstrip('(')
+    match = re.match(r'[A-Za-z]+', stripped)
+    return match.group(0).lower() if match else ''
+
+
+def mask(statement):
+    """ Remove comments and replace literals with empty strings, keeping quoted identifiers """
+    def replace(match):
+        kind = match.lastgroup
+        if kind == 'comment':
+            return ' '
+        if kind in ('string', 'dollar'):
+            return "''"
+        return match.group(0)
+    return _TOKEN.sub(replace, statement or '')
+
+
+def split_statements(script):
+    """ Split a script on the semicolons that are not inside literals or comments """
+    statements = []
+    start = 0
+    for match in _TOKEN.finditer(script or ''):
+        if match.lastgroup == 'semicolon':
+            statements.append(script[start:match.start()])
+            start = match.end()
+    statements.append((script or '')[start:])
+    # Drop empty statements and the ones with only comments
+    return [statement.strip() for statement in statements if mask(statement).strip()]
+
+
+def _map_code(statement, function):
+    """ Apply a function to the parts of a statement outside literals, quoted identifiers and comments """
+    parts = []
+    position = 0
+    for match in _TOKEN.finditer(statement):
+        parts.append(function(statement[position:match.start()]))
+        parts.append(match.group(0))
+        position = match.end()
+    parts.append(function(statement[position:]))
+    return ''.join(parts)
+
+
+def bind_names(statement):
+    """ Names of the `:name` bind parameters of a statement, in order of appearance """
+    names = []
+
+    def collect(code):
+        for name in _BIND_PARAM.findall(code):
+            if name not in names:
+                names.append(name)
+        return code
+
+    _map_code(statement or '', collect)
+    return names
+
+
+def to_positional(statement, names):
+    """ Replace the `:name` bind parameters with PostgreSQL's `$n` placeholders """
+    positions = {name: i + 1 for i, name in enumerate(names)}
+
+    def replace(code):
+        return _BIND_PARAM.sub(lambda match: f'${positions[match.group(1)]}', code)
+
+    return _map_code(statement, replace)
+
+
+def is_preparable(statement):
+    """ Check if a statement can be run with PREPARE / EXECUTE """
+    return classify(statement) in (SELECT, DML) and first_keyword(mask(statement)) in _PREPARABLE_KEYWORDS
+
+
+def classify(statement):
+    """
+    Classify a statement as `select` (SELECT, VALUES, TABLE and read-only CTEs),
+    `dml` (INSERT, UPDATE, DELETE, MERGE, COPY and data-modifying CTEs),
+    `ddl` (CREATE, ALTER, DROP, ... and SELECT INTO) or `utility` (everything else:
+    SET, SHOW, VACUUM, EXPLAIN, transaction control...)
+    """
+    masked = mask(statement)
+    keyword = first_keyword(masked)
+    if keyword == 'select' and re.search(r'\binto\b', masked, re.IGNORECASE):
+        # SELECT ... INTO new_table
+        return DDL
+    if keyword == 'with':
+        modifying = re.search(r'\b(insert|update|delete|merge)\b', masked, re.IGNORECASE)
+        return DML if modifying else SELECT
+    if keyword in ('select', 'values', 'table'):
+        return SELECT
+    if keyword in _DML_KEYWORDS:
+        return DML
+    if keyword in _DDL_KEYWORDS:
+        return DDL
+    return UTILITY
+
+
+def is_select(query):
+    """ Check if a statement only reads rows and can run on a server-side cursor """
+    return classify(query) == SELECT
+
+
+def normalize(query):
+    """
+    Key of a query for the result cache: comments removed and whitespace
+    collapsed outside literals and quoted identifiers, without the trailing
+    semicolon. Removed comments leave a space, so the line a `--` comment
+    ends is never joined to it.
+    """
+    uncommented = _TOKEN.sub(lambda match: ' ' if match.lastgroup == 'comment' else match.group(0), query or '')
+    collapsed = _map_code(uncommented, lambda code: re.sub(r'\s+', ' ', code))
+    return collapsed.strip().rstrip(';').rstrip()
+
+
+def fingerprint_text(statement):
+    """
+    Normalized text of a statement to group the ones that differ only in
+    their constants: comments removed, string and numeric literals and bind
+    parameters replaced by `?`, lists of them collapsed to `(...)`,
+    keywords and identifiers lowercased (but not quoted identifiers) and
+    whitespace folded.
+    """
+    def replace(match):
+        kind = match.lastgroup
+        if kind == 'comment':
+            return ' '
+        if kind in ('string', 'dollar'):
+            return '?'
+        return match.group(0)
+
+    def code(part):
+        part = _BIND_PARAM.sub('?', part.lower())
+        part = _POSITIONAL.sub('?', part)
+        return _NUMBER.sub('?', part)
+
+    parts = []
+    position = 0
+    for match in _TOKEN.finditer(statement or ''):
+        parts.append(code(statement[position:match.start()]))
+        parts.append(replace(match))
+        position = match.end()
+    parts.append(code((statement or '')[position:]))
+    text = ''.join(parts)
+
+    # Quoted identifiers don't have whitespace worth folding, literals are gone
+    text = re.sub(r'\s+', ' ', text)
+    text = _PLACEHOLDER_LIST.sub('(...)', text)
+    return text.strip().rstrip(';').strip()
+
+
+def fingerprint(statement):
+    """
+    Hash (md5 as hex) of the fingerprint text of a statement, without the
+    whitespace around operators so `id=1` and `id = 1` get the same one
+    """
+    compact = _map_code(fingerprint_text(statement), lambda code: _SPACED_PUNCTUATION.sub(r'\1', code))
+    return hashlib.md5(compact.encode('utf-8')).hexdigest()
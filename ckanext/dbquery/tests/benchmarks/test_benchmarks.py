@@ -0,0 +1,232 @@
+"""
+Benchmarks of the query pipeline: execution and fetch (query_database),
+JSON serialization, template rendering and the history over a large
+audit table. They run against the test database seeded with synthetic
+tables, and only with the DBQUERY_BENCHMARK environment variable set,
+see the README.
+"""
+import datetime
+import json
+import os
+import tracemalloc
+
+import pytest
+from ckan import model
+from ckan.tests import helpers
+from ckan.plugins import toolkit
+
+from ckanext.dbquery import audit, execution, partitions, serialize
+from ckanext.dbquery.model import DBQueryExecuted
+
+
+# Largest result size benchmarked, lower it for quicker runs
+MAX_ROWS = int(os.environ.get('DBQUERY_BENCHMARK_MAX_ROWS', 1000000))
+SIZES = [size for size in (10, 1000, 100000, 1000000) if size <= MAX_ROWS]
+# HTML tables beyond this size are not realistic
+RENDER_SIZES = [size for size in SIZES if size <= 100000]
+# Rows in the audit table for the history benchmarks
+AUDIT_ROWS = int(os.environ.get('DBQUERY_BENCHMARK_AUDIT_ROWS', 1000000))
+
+# 2 columns
+NARROW_TABLE = 'dbquery_bench_narrow'
+# 20 columns of the usual types
+WIDE_TABLE = 'dbquery_bench_wide'
+TABLES = [NARROW_TABLE, WIDE_TABLE]
+
+_WIDE_COLUMNS = ', '.join([
+    'n AS id',
+    "md5(n::text) AS name",
+    "'Synthetic dataset number ' || n AS title",
+    "repeat('lorem ipsum ', 5) AS notes",
+    "n % 3 = 0 AS private",
+    'n * 7 AS views',
+    'CAST(n / 7.0 AS numeric(12, 2)) AS amount',
+    'n / 3.0::float8 AS ratio',
+    "timestamp '2024-01-01' + n * interval '1 minute' AS created",
+    "timestamptz '2024-01-01' + n * interval '1 hour' AS modified",
+    "date '2024-01-01' + n % 365 AS day",
+    "md5((n * 2)::text)::uuid AS owner",
+    "json_build_object('n', n, 'tags', json_build_array('a', 'b')) AS extras",
+    "ARRAY[n, n + 1, n + 2] AS numbers",
+    "'active' AS state",
+    "'dataset' AS type",
+    "n % 100 AS bucket",
+    "'https://example.com/' || n AS url",
+    "decode(md5(n::text), 'hex') AS checksum",
+    'n::bigint * 1000 AS size',
+])
+
+pytestmark = [
+    pytest.mark.skipif(not os.environ.get('DBQUERY_BENCHMARK'), reason='Set DBQUERY_BENCHMARK=1 to run the benchmarks'),
+    pytest.mark.ckan_config('ckanext.dbquery.max_rows', MAX_ROWS + 1),
+    # The wide 100k and 1M row results are over the default byte limit
+    pytest.mark.ckan_config('ckanext.dbquery.max_result_bytes', 0),
+    pytest.mark.usefixtures('bench_db'),
+]
+
+
+def _peak_memory(function, *args, **kwargs):
+    """ Peak memory allocated by Python while running a function, in bytes """
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _measure(benchmark, function, *args, rounds=5, **kwargs):
+    """
+    Benchmark a function and save its peak memory with the results.
+    Memory is measured in a separate run, tracemalloc slows the timed ones down.
+    """
+    benchmark.extra_info['peak_memory'] = _peak_memory(function, *args, **kwargs)
+    return benchmark.pedantic(function, args=args, kwargs=kwargs, rounds=rounds, iterations=1, warmup_rounds=1)
+
+
+def _rounds(size):
+    return 3 if size >= 100000 else 10
+
+
+def _fetch(table, size):
+    """ Column names and rows of the first `size` rows of a table """
+    with execution.execute(f'SELECT * FROM {table} ORDER BY id LIMIT {size}') as result:
+        return list(result.keys()), result.fetchall()
+
+
+@pytest.fixture(scope='session')
+def bench_db():
+    """ A clean database with the synthetic tables and a large audit table """
+    from ckan.cli.db import _run_migrations
+
+    helpers.reset_db()
+    _run_migrations('dbquery')
+    # Month partitions for all the seeded audit records, as in a long running
+    # site, so the history benchmarks measure partition pruning
+    oldest = datetime.datetime.utcnow() - datetime.timedelta(seconds=30 * AUDIT_ROWS)
+    partitions.ensure_partitions(since=oldest.date())
+    max_rows = max(SIZES)
+    with model.meta.engine.begin() as conn:
+        conn.execute(f'DROP TABLE IF EXISTS {NARROW_TABLE}, {WIDE_TABLE}')
+        conn.execute(
+            f'CREATE TABLE {NARROW_TABLE} AS '
+            f'SELECT n AS id, n * 2 AS value FROM generate_series(1, {max_rows}) AS n'
+        )
+        conn.execute(f'CREATE TABLE {WIDE_TABLE} AS SELECT {_WIDE_COLUMNS} FROM generate_series(1, {max_rows}) AS n')
+        # Audit records of 50 users, one every 30 seconds
+        conn.execute(
+            "INSERT INTO dbquery_executed "
+            "(id, query, user_id, timestamp, duration_total, row_count, status) "
+            "SELECT md5(n::text), 'SELECT ' || n, 'user-' || n % 50, "
+            "now() - n * interval '30 seconds', random() * 1000, n % 1000, "
+            "CASE WHEN n % 50 = 0 THEN 'error' ELSE 'ok' END "
+            f"FROM generate_series(1, {AUDIT_ROWS}) AS n"
+        )
+        conn.execute(f'ANALYZE {NARROW_TABLE}, {WIDE_TABLE}, dbquery_executed')
+    yield
+    with model.meta.engine.begin() as conn:
+        conn.execute(f'DROP TABLE {NARROW_TABLE}, {WIDE_TABLE}')
+        conn.execute('TRUNCATE dbquery_executed')
+
+
+@pytest.mark.parametrize('table', TABLES)
+@pytest.mark.parametrize('size', SIZES)
+def test_query_database(benchmark, sysadmin, table, size):
+    """ Execute, fetch and build the response of query_database """
+    context = {'user': sysadmin['name'], 'ignore_auth': False}
+    data_dict = {'query': f'SELECT * FROM {table} ORDER BY id', 'limit': size, 'cache': False}
+
+    result = _measure(benchmark, helpers.call_action, 'query_database', context, rounds=_rounds(size), **data_dict)
+
+    assert len(result['rows']) == size
+
+
+@pytest.mark.parametrize('fmt', serialize.FORMATS)
+@pytest.mark.parametrize('table', TABLES)
+@pytest.mark.parametrize('size', SIZES)
+def test_json_serialization(benchmark, table, size, fmt):
+    """ Shape the rows in each response format and encode them as JSON """
+    colnames, rows = _fetch(table, size)
+
+    def serialize_rows():
+        return json.dumps(serialize.shape(colnames, rows, fmt), default=str)
+
+    payload = _measure(benchmark, serialize_rows, rounds=_rounds(size))
+    benchmark.extra_info['payload_bytes'] = len(payload)
+
+
+@pytest.mark.parametrize('table', TABLES)
+@pytest.mark.parametrize('size', RENDER_SIZES)
+def test_results_table_rendering(benchmark, app, table, size):
+    """ Render the results table of the query page """
+    colnames, rows = _fetch(table, size)
+    result = dict(serialize.shape(colnames, rows), colnames=colnames)
+
+    with app.flask_app.test_request_context():
+        html = _measure(
+            benchmark, toolkit.render_snippet, 'dbquery/snippets/results_table.html',
+            result=result, rounds=_rounds(size),
+        )
+    benchmark.extra_info['html_bytes'] = len(html)
+
+
+@pytest.mark.parametrize('size', [size for size in RENDER_SIZES if size <= 1000])
+def test_index_page(benchmark, app, sysadmin, ckan_config, monkeypatch, size):
+    """ The whole query page request: action, audit record and rendering """
+    monkeypatch.setitem(ckan_config, 'ckanext.dbquery.page_size', size)
+    headers = {'Authorization': sysadmin['token']}
+    data = {'query': f'SELECT * FROM {WIDE_TABLE} ORDER BY id'}
+
+    response = _measure(benchmark, app.post, '/ckan-admin/db-query/', headers=headers, data=data)
+
+    assert response.status_code == 200
+
+
+def _history_cursor():
+    """ Keyset cursor in the middle of the audit table """
+    middle = model.Session.query(DBQueryExecuted).order_by(
+        DBQueryExecuted.timestamp.desc(), DBQueryExecuted.id.desc()
+    ).offset(AUDIT_ROWS // 2).first()
+    return middle.cursor
+
+
+@pytest.mark.parametrize('case', ['first_page', 'deep_page', 'user', 'date_range', 'status', 'duration_sort'])
+def test_executed_list(benchmark, sysadmin, case):
+    """ dbquery_executed_list over the large audit table """
+    context = {'user': sysadmin['name'], 'ignore_auth': False}
+    last_week = (datetime.date.today() - datetime.timedelta(days=7)).isoformat()
+    data_dict = {
+        'first_page': {},
+        'deep_page': {'before': _history_cursor()},
+        'user': {'user': 'user-7'},
+        'date_range': {'from': last_week, 'to': last_week},
+        'status': {'status': 'error'},
+        'duration_sort': {'sort': 'duration'},
+    }[case]
+
+    result = _measure(benchmark, helpers.call_action, 'dbquery_executed_list', context, rounds=10, **data_dict)
+
+    assert len(result) == toolkit.config.get('ckanext.dbquery.history_page_size')
+
+
+def test_executed_stats(benchmark, sysadmin):
+    """ Daily latency percentiles over the large audit table """
+    context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+    _measure(benchmark, helpers.call_action, 'dbquery_executed_stats', context, rounds=5, days=365)
+
+
+@pytest.mark.parametrize('batch_size', [1, 100])
+def test_audit_write(benchmark, sysadmin, batch_size):
+    """ Write audit records one by one with the ORM or in a multi-row INSERT """
+    def write():
+        if batch_size == 1:
+            DBQueryExecuted(query='SELECT 1', user_id=sysadmin['id'], duration_total=1.0).save()
+        else:
+            audit.write_records([
+                audit._prepare({'query': 'SELECT 1', 'user_id': sysadmin['id'], 'duration_total': 1.0})
+                for _ in range(batch_size)
+            ])
+
+    _measure(benchmark, write, rounds=20)
+    benchmark.extra_info['records'] = batch_size
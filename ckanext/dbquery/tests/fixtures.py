@@ -1,11 +1,16 @@
 import pytest
+from unittest import mock
+from ckan.plugins import toolkit
 from ckan.tests import factories
 
 
 @pytest.fixture
 def clean_db(reset_db, migrate_db_for):
+    from ckanext.dbquery.cache import result_cache
+
     reset_db()
     migrate_db_for('dbquery')
+    result_cache.invalidate()
 
 
 @pytest.fixture(autouse=True)
@@ -38,3 +43,13 @@ def mock_executed_queries(sysadmin):
         q.save()
 
     return queries
+
+
+@pytest.fixture
+def sync_jobs(monkeypatch):
+    """ Run background jobs synchronously instead of sending them to Redis """
+    def enqueue_job(fn, args=None, kwargs=None, **_):
+        fn(*(args or []), **(kwargs or {}))
+        return mock.Mock()
+
+    monkeypatch.setattr(toolkit, 'enqueue_job', enqueue_job)
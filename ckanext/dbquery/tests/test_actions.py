@@ -1,7 +1,11 @@
+import datetime
+import decimal
+
 import pytest
 from ckan.tests import helpers
 from ckan.plugins import toolkit
-from ckanext.dbquery.model import DBQueryExecuted
+from ckanext.dbquery import execution, jobs
+from ckanext.dbquery.model import DBQueryExecuted, DBQueryJob
 
 
 @pytest.mark.usefixtures("clean_db")
@@ -41,6 +45,16 @@ class TestQueryDatabaseAction:
         assert saved_query is not None
         assert saved_query.query == data_dict['query']
 
+    def test_query_database_missing_query(self, sysadmin):
+        """Test that the query is required and nothing is audited without it."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            helpers.call_action('query_database', context)
+
+        assert 'query' in e.value.error_dict
+        assert helpers.model.Session.query(DBQueryExecuted).count() == 0
+
     def test_query_database_invalid_query(self, sysadmin):
         """Test handling of invalid SQL queries."""
         context = {
@@ -85,3 +99,596 @@ class TestQueryDatabaseAction:
         # Check order (newest first)
         timestamps = [item['timestamp'] for item in result]
         assert timestamps[0] >= timestamps[1]
+
+    def test_dbquery_executor_users_list(self, sysadmin, normal_user, mock_executed_queries):
+        """Test that only the users that ran queries are listed, once each."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        result = helpers.call_action('dbquery_executor_users_list', context)
+
+        assert result == [{'id': sysadmin['id'], 'name': sysadmin['name']}]
+
+    def test_query_database_pagination(self, sysadmin):
+        """Test that only the requested page is returned."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        data_dict = {
+            'query': 'SELECT n FROM generate_series(1, 25) AS n ORDER BY n',
+            'limit': 10,
+            'offset': 10,
+        }
+
+        result = helpers.call_action('query_database', context, **data_dict)
+
+        assert [row['n'] for row in result['rows']] == list(range(11, 21))
+        assert result['has_more'] is True
+        assert result['truncated'] is False
+
+    @pytest.mark.ckan_config('ckanext.dbquery.max_rows', 15)
+    def test_query_database_truncated(self, sysadmin):
+        """Test that results are truncated at the configured row cap."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        data_dict = {
+            'query': 'SELECT n FROM generate_series(1, 25) AS n ORDER BY n',
+            'limit': 10,
+            'offset': 10,
+        }
+
+        result = helpers.call_action('query_database', context, **data_dict)
+
+        assert [row['n'] for row in result['rows']] == list(range(11, 16))
+        assert result['has_more'] is False
+        assert result['truncated'] is True
+
+    def test_query_database_invalid_offset(self, sysadmin):
+        """Test that paging parameters are validated."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('query_database', context, query='SELECT 1', offset='abc')
+
+    def test_query_database_offset_only_for_select(self, sysadmin):
+        """Test that writes can't be paged, the next page would run them again."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            helpers.call_action(
+                'query_database', context, query='UPDATE "user" SET about = about RETURNING id', offset=1,
+            )
+
+        assert 'offset' in e.value.error_dict
+
+    def test_query_database_returning_not_paged(self, sysadmin):
+        """Test that the rows returned by a write are truncated instead of paged."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        result = helpers.call_action(
+            'query_database', context, query='UPDATE "user" SET about = about RETURNING id', limit=1,
+        )
+
+        assert len(result['rows']) == 1
+        assert result['kind'] == 'dml'
+        assert result['has_more'] is False
+        assert result['truncated'] is True
+
+    def test_query_database_timeout(self, sysadmin):
+        """Test that statements running longer than the timeout are cancelled."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        data_dict = {
+            'query': 'SELECT pg_sleep(5)',
+            'timeout': 100,
+        }
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            helpers.call_action('query_database', context, **data_dict)
+
+        assert 'statement timeout' in e.value.error_dict['query']
+
+    def test_dbquery_running_list(self, sysadmin):
+        """Test that statements are only listed while they run."""
+        from ckanext.dbquery import execution
+
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with execution.execute('SELECT 1', user_id=sysadmin['id']):
+            running = helpers.call_action('dbquery_running_list', context)
+            assert [entry['query'] for entry in running] == ['SELECT 1']
+            assert running[0]['user_id'] == sysadmin['id']
+            assert running[0]['pid'] > 0
+
+        assert helpers.call_action('dbquery_running_list', context) == []
+
+    def test_dbquery_cancel_not_running(self, sysadmin):
+        """Test that cancelling an unknown statement fails."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ObjectNotFound):
+            helpers.call_action('dbquery_cancel', context, id='not-a-query')
+
+    def test_dbquery_activity(self, sysadmin):
+        """Test that the activity lists other backends and their open transactions."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        with helpers.model.meta.engine.connect() as conn:
+            transaction = conn.begin()
+            pid = conn.execute('SELECT pg_backend_pid()').scalar()
+            conn.execute('SELECT 1')
+
+            result = helpers.call_action('dbquery_activity', context)
+            transaction.rollback()
+
+        backend = next(backend for backend in result['backends'] if backend['pid'] == pid)
+        assert backend['state'] == 'idle in transaction'
+        assert pid in [backend['pid'] for backend in result['transactions']]
+        assert 'tables' in result
+        assert 'tables' not in helpers.call_action('dbquery_activity', context, tables=False)
+
+    def test_dbquery_schema(self, sysadmin):
+        """Test that the schema catalog has the tables with their columns and indexes."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        result = helpers.call_action('dbquery_schema', context, schema='public', refresh=True)
+        cached = helpers.call_action('dbquery_schema', context)
+
+        package = next(table for table in result['tables'] if table['name'] == 'package')
+        assert package['schema'] == 'public'
+        assert package['kind'] == 'table'
+        assert 'row_estimate' in package
+        column = next(column for column in package['columns'] if column['name'] == 'id')
+        assert column['type'] == 'text'
+        assert column['nullable'] is False
+        assert any(index['primary'] for index in package['indexes'])
+        assert all(table['schema'] == 'public' for table in result['tables'])
+        # The partitions of the audit table are left out
+        assert 'dbquery_executed' in [table['name'] for table in result['tables']]
+        assert not any(table['name'].startswith('dbquery_executed_') for table in result['tables'])
+        assert result['cached'] is False
+        assert cached['cached'] is True
+
+    @pytest.mark.ckan_config('ckanext.dbquery.schema_cache_ttl', 3600)
+    def test_dbquery_schema_ddl_invalidation(self, sysadmin):
+        """Test that DDL run with query_database clears the schema catalog."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        helpers.call_action('dbquery_schema', context)
+        helpers.call_action('query_database', context, query='CREATE TABLE dbquery_schema_test (value int)')
+        try:
+            result = helpers.call_action('dbquery_schema', context)
+        finally:
+            helpers.call_action('query_database', context, query='DROP TABLE dbquery_schema_test')
+
+        assert result['cached'] is False
+        table = next(table for table in result['tables'] if table['name'] == 'dbquery_schema_test')
+        assert [column['name'] for column in table['columns']] == ['value']
+        assert 'dbquery_schema_test' not in [
+            table['name'] for table in helpers.call_action('dbquery_schema', context)['tables']
+        ]
+
+    def test_dbquery_cancel_unknown_backend(self, sysadmin):
+        """Test that only the backends of the database can be cancelled."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        pids = [backend['pid'] for backend in helpers.call_action('dbquery_activity', context, tables=False)['backends']]
+
+        with pytest.raises(toolkit.ValidationError, match='not a backend'):
+            helpers.call_action('dbquery_cancel', context, pid=max(pids + [0]) + 100000)
+
+    def test_dbquery_cancel_terminate_backend(self, sysadmin):
+        """Test terminating a backend by its pid."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        engine = helpers.model.meta.engine
+        conn = engine.connect()
+        pid = conn.execute('SELECT pg_backend_pid()').scalar()
+
+        result = helpers.call_action('dbquery_cancel', context, pid=pid, terminate=True)
+
+        assert result == {'pid': pid, 'cancelled': True, 'terminated': True}
+        conn.invalidate()
+        conn.close()
+
+    def test_query_database_async(self, sysadmin, sync_jobs):
+        """Test that async queries run as background jobs and store their results."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        data_dict = {
+            'query': 'SELECT n FROM generate_series(1, 3) AS n',
+            'async': True,
+        }
+
+        queued = helpers.call_action('query_database', context, **data_dict)
+        assert queued['status'] == 'queued'
+
+        status = helpers.call_action('dbquery_job_status', context, id=queued['job_id'])
+        assert status['status'] == 'finished'
+
+        result = helpers.call_action('dbquery_job_result', context, id=queued['job_id'])
+        assert [row['n'] for row in result['rows']] == [1, 2, 3]
+
+    def test_query_database_async_error(self, sysadmin, sync_jobs):
+        """Test that failed background queries report their error."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        data_dict = {
+            'query': 'SELECT * FROM non_existent_table',
+            'async': True,
+        }
+
+        queued = helpers.call_action('query_database', context, **data_dict)
+
+        status = helpers.call_action('dbquery_job_status', context, id=queued['job_id'])
+        assert status['status'] == 'failed'
+        assert 'non_existent_table' in status['error']
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('dbquery_job_result', context, id=queued['job_id'])
+
+    def test_query_job_unexpected_error(self, sysadmin, monkeypatch):
+        """Test that jobs failing with any error are marked as failed."""
+        job = DBQueryJob(query='SELECT 1', user_id=sysadmin['id']).save()
+
+        def query_database(context, data_dict):
+            raise RuntimeError('worker stopped')
+
+        monkeypatch.setattr(jobs.toolkit, 'get_action', lambda name: query_database)
+        jobs.run_query_job(job.id, {'query': 'SELECT 1'})
+
+        job = DBQueryJob.get(job.id)
+        assert job.status == DBQueryJob.STATUS_FAILED
+        assert 'worker stopped' in job.error
+
+    def test_query_job_deleted_user(self):
+        """Test that jobs of users that no longer exist fail."""
+        job = DBQueryJob(query='SELECT 1', user_id='deleted-user').save()
+
+        jobs.run_query_job(job.id, {'query': 'SELECT 1'})
+
+        job = DBQueryJob.get(job.id)
+        assert job.status == DBQueryJob.STATUS_FAILED
+        assert 'deleted-user' in job.error
+
+    @pytest.mark.ckan_config('ckanext.dbquery.job_timeout', 10)
+    @pytest.mark.ckan_config('ckanext.dbquery.statement_timeout', 0)
+    def test_query_job_statement_timeout(self):
+        """Test that job statements time out before the worker kills the job."""
+        assert jobs._job_timeout({}) == 9000
+        assert jobs._job_timeout({'timeout': '0'}) == 9000
+        assert jobs._job_timeout({'timeout': 60000}) == 9000
+        assert jobs._job_timeout({'timeout': 1000}) == 1000
+
+    @pytest.mark.ckan_config('ckanext.dbquery.cache_ttl', 60)
+    def test_query_database_cache(self, sysadmin):
+        """Test that repeated SELECT queries are served from the cache."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        query = 'SELECT random() AS value'
+
+        first = helpers.call_action('query_database', context, query=query)
+        second = helpers.call_action('query_database', context, query=' SELECT  random() AS value; ')
+        bypass = helpers.call_action('query_database', context, query=query, cache=False)
+
+        assert first['cached'] is False
+        assert second['cached'] is True
+        assert second['cache_age'] >= 0
+        assert second['rows'] == first['rows']
+        assert bypass['cached'] is False
+        assert bypass['rows'] != first['rows']
+
+    @pytest.mark.ckan_config('ckanext.dbquery.cache_ttl', 60)
+    def test_query_database_cache_invalidation(self, sysadmin):
+        """Test that statements that don't return rows clear the cache."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        query = 'SELECT random() AS value'
+
+        helpers.call_action('query_database', context, query=query)
+        helpers.call_action('query_database', context, query='UPDATE package SET name = name WHERE false')
+        result = helpers.call_action('query_database', context, query=query)
+
+        assert result['cached'] is False
+
+    def test_query_database_explain(self, sysadmin):
+        """Test that explain returns the parsed plan tree."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        data_dict = {
+            'query': 'SELECT n FROM generate_series(1, 10000) AS n ORDER BY n DESC',
+            'explain': 'analyze',
+        }
+
+        result = helpers.call_action('query_database', context, **data_dict)
+
+        plan = result['plan']
+        assert plan['node_type'] == 'Sort'
+        assert plan['children'][0]['node_type'] == 'Function Scan'
+        assert plan['actual_rows'] == 10000
+        assert result['execution_time'] is not None
+        assert any(node['expensive'] for node in [plan] + plan['children'])
+
+    def test_query_database_explain_analyze_rolls_back(self, sysadmin):
+        """Test that EXPLAIN ANALYZE of data-modifying statements doesn't change data."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        helpers.call_action(
+            'query_database', context,
+            query="INSERT INTO dbquery_executed (id, query, user_id) VALUES ('explained', 'x', 'x')",
+            explain='analyze',
+        )
+
+        assert helpers.model.Session.query(DBQueryExecuted).get('explained') is None
+
+    def test_query_database_explain_invalid_mode(self, sysadmin):
+        """Test that unknown explain modes are rejected."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('query_database', context, query='SELECT 1', explain='verbose')
+
+    def test_query_database_records_metrics(self, sysadmin):
+        """Test that the execution metrics are saved with the executed query."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        helpers.call_action('query_database', context, query='SELECT n FROM generate_series(1, 3) AS n')
+
+        saved_query = helpers.model.Session.query(DBQueryExecuted).first()
+        assert saved_query.status == 'ok'
+        assert saved_query.row_count == 3
+        assert saved_query.result_bytes > 0
+        assert saved_query.duration_total >= saved_query.duration_execute >= 0
+        assert saved_query.duration_fetch >= 0
+
+    def test_query_database_records_failed_queries(self, sysadmin):
+        """Test that failed queries are saved with their status and error."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('query_database', context, query='SELECT pg_sleep(5)', timeout=100)
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('query_database', context, query='SELECT * FROM non_existent_table')
+
+        saved = helpers.model.Session.query(DBQueryExecuted).order_by(DBQueryExecuted.timestamp).all()
+        assert [q.status for q in saved] == ['timeout', 'error']
+        assert 'non_existent_table' in saved[1].error
+
+    def test_dbquery_executed_list_sort_by_duration(self, sysadmin):
+        """Test that executed queries can be filtered and sorted by duration."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        DBQueryExecuted(query='fast', user_id=sysadmin['id'], duration_total=5).save()
+        DBQueryExecuted(query='slow', user_id=sysadmin['id'], duration_total=500).save()
+        DBQueryExecuted(query='medium', user_id=sysadmin['id'], duration_total=50).save()
+
+        result = helpers.call_action('dbquery_executed_list', context, sort='duration', min_duration=10)
+
+        assert [item['query'] for item in result] == ['slow', 'medium']
+
+    def test_dbquery_executed_stats(self, sysadmin):
+        """Test the daily latency percentiles."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        for duration in range(1, 101):
+            DBQueryExecuted(query='SELECT 1', user_id=sysadmin['id'], duration_total=duration).save()
+
+        result = helpers.call_action('dbquery_executed_stats', context)
+
+        assert len(result) == 1
+        assert result[0]['count'] == 100
+        assert result[0]['p50'] == pytest.approx(50.5)
+        assert result[0]['p95'] == pytest.approx(95.05)
+        assert result[0]['max'] == 100
+
+    def test_dbquery_executed_list_keyset_pagination(self, sysadmin):
+        """Test paging through the executed queries with the `before` cursor."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        now = datetime.datetime.utcnow()
+        for i in range(5):
+            DBQueryExecuted(
+                query=f'SELECT {i}', user_id=sysadmin['id'],
+                timestamp=now - datetime.timedelta(minutes=i),
+            ).save()
+
+        first_page = helpers.call_action('dbquery_executed_list', context, limit=2)
+        second_page = helpers.call_action(
+            'dbquery_executed_list', context, limit=2, before=first_page[-1]['cursor'])
+        last_page = helpers.call_action(
+            'dbquery_executed_list', context, limit=2, before=second_page[-1]['cursor'])
+
+        assert [q['query'] for q in first_page] == ['SELECT 0', 'SELECT 1']
+        assert [q['query'] for q in second_page] == ['SELECT 2', 'SELECT 3']
+        assert [q['query'] for q in last_page] == ['SELECT 4']
+
+    def test_dbquery_executed_list_date_range(self, sysadmin):
+        """Test filtering the executed queries by date range."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        for day in (1, 2, 3):
+            DBQueryExecuted(
+                query=f'SELECT {day}', user_id=sysadmin['id'],
+                timestamp=datetime.datetime(2025, 3, day, 23, 59),
+            ).save()
+
+        result = helpers.call_action('dbquery_executed_list', context, **{'from': '2025-03-02', 'to': '2025-03-03'})
+
+        assert [q['query'] for q in result] == ['SELECT 3', 'SELECT 2']
+
+    def test_dbquery_executed_list_search(self, sysadmin):
+        """Test searching the executed queries by substrings, with LIKE wildcards taken literally."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        for query in ('SELECT * FROM resource_view', 'SELECT * FROM resourceXview', 'select id from RESOURCE_VIEW'):
+            DBQueryExecuted(query=query, user_id=sysadmin['id']).save()
+
+        result = helpers.call_action('dbquery_executed_list', context, q='resource_view select')
+        assert sorted(q['query'] for q in result) == ['SELECT * FROM resource_view', 'select id from RESOURCE_VIEW']
+
+        result = helpers.call_action('dbquery_executed_list', context, q='resource_view id')
+        assert [q['query'] for q in result] == ['select id from RESOURCE_VIEW']
+
+    def test_dbquery_executed_list_search_too_short(self, sysadmin):
+        """Test that searches only with terms the trigram index can't serve are rejected."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('dbquery_executed_list', context, q='id a')
+
+    def test_dbquery_fingerprint_stats(self, sysadmin):
+        """Test that executed queries are aggregated by fingerprint."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        for i, duration in enumerate((10, 20, 30)):
+            DBQueryExecuted(
+                query=f'SELECT * FROM package WHERE id = {i}', user_id=sysadmin['id'],
+                duration_total=duration, row_count=1,
+            ).save()
+        DBQueryExecuted(query='SELECT 1', user_id=sysadmin['id'], duration_total=5, row_count=1).save()
+
+        result = helpers.call_action('dbquery_fingerprint_stats', context)
+
+        assert [item['calls'] for item in result] == [3, 1]
+        assert result[0]['query'] == 'select * from package where id = ?'
+        assert result[0]['total'] == 60
+        assert result[0]['mean'] == pytest.approx(20)
+        assert result[0]['rows'] == 3
+
+        executions = helpers.call_action('dbquery_executed_list', context, fingerprint=result[0]['fingerprint'])
+        assert len(executions) == 3
+
+    def test_dbquery_executed_list_invalid_cursor(self, sysadmin):
+        """Test that malformed cursors are rejected."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('dbquery_executed_list', context, before='not-a-cursor')
+
+    def test_query_database_read_engine(self, sysadmin, ckan_config, monkeypatch):
+        """Test that SELECT queries use the read engine and other statements CKAN's one."""
+        # The test database stands in for the read replica
+        monkeypatch.setitem(ckan_config, 'ckanext.dbquery.read_url', ckan_config['sqlalchemy.url'])
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        helpers.call_action('query_database', context, query='SELECT 1')
+        stats = helpers.call_action('dbquery_pool_stats', context)
+        assert stats['read']['checkedin'] == 1
+
+        helpers.call_action('query_database', context, query='UPDATE package SET name = name WHERE false')
+        stats = helpers.call_action('dbquery_pool_stats', context)
+        assert stats['read']['checkedin'] == 1
+
+    def test_read_engine_reused(self, ckan_config, monkeypatch):
+        """Test that the read engine and its pool are built once for the configured URL."""
+        monkeypatch.setitem(ckan_config, 'ckanext.dbquery.read_url', ckan_config['sqlalchemy.url'])
+
+        assert execution.get_read_engine() is execution.get_read_engine()
+
+    def test_dbquery_pool_stats_without_read_engine(self, sysadmin):
+        """Test the pool stats when there is no read engine."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        stats = helpers.call_action('dbquery_pool_stats', context)
+
+        assert 'status' in stats['primary']
+        assert stats['read'] is None
+
+    def test_query_database_script(self, sysadmin):
+        """Test that scripts run in a single transaction with a result per statement."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        query = (
+            "CREATE TEMP TABLE dbquery_script (n int) ON COMMIT DROP;"
+            "INSERT INTO dbquery_script SELECT generate_series(1, 3);"
+            "SELECT n FROM dbquery_script ORDER BY n"
+        )
+        result = helpers.call_action('query_database', context, query=query)
+
+        assert [s['kind'] for s in result['statements']] == ['ddl', 'dml', 'select']
+        assert result['statements'][1]['rowcount'] == 3
+        assert result['read_only'] is False
+        assert [row['n'] for row in result['rows']] == [1, 2, 3]
+
+    def test_query_database_read_only_script(self, sysadmin):
+        """Test that read-only scripts run in a READ ONLY transaction."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        query = "SELECT 1 AS one; SELECT current_setting('transaction_read_only') AS read_only"
+        result = helpers.call_action('query_database', context, query=query)
+
+        assert result['read_only'] is True
+        assert result['rows'] == [{'read_only': 'on'}]
+
+    def test_query_database_script_rolls_back_on_error(self, sysadmin):
+        """Test that a failing statement rolls back the whole script."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        query = (
+            "INSERT INTO dbquery_executed (id, query, user_id) VALUES ('script', 'x', 'x');"
+            "SELECT * FROM non_existent_table"
+        )
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('query_database', context, query=query)
+
+        assert helpers.model.Session.query(DBQueryExecuted).get('script') is None
+
+    def test_query_database_params(self, sysadmin):
+        """Test that params are bound to the :name placeholders."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        query = "SELECT :name AS name, n FROM generate_series(1, 5) AS n WHERE n > CAST(:min AS int) ORDER BY n"
+        result = helpers.call_action('query_database', context, query=query, params={'name': 'x', 'min': 3})
+
+        assert result['rows'] == [{'name': 'x', 'n': 4}, {'name': 'x', 'n': 5}]
+
+    def test_query_database_missing_param(self, sysadmin):
+        """Test that a placeholder without a value is a validation error."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            helpers.call_action('query_database', context, query='SELECT :missing AS value')
+        assert 'missing' in e.value.error_dict['query']
+
+    def test_query_database_invalid_params(self, sysadmin):
+        """Test that params must be a dictionary."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            helpers.call_action('query_database', context, query='SELECT 1', params=['x'])
+        assert 'params' in e.value.error_dict
+
+    @pytest.mark.parametrize('fmt,expected', [
+        ('records', {'rows': [{'n': 1, 'amount': decimal.Decimal('0.5')}, {'n': 2, 'amount': decimal.Decimal('1.0')}]}),
+        ('rows', {'rows': [[1, '0.5'], [2, '1.0']]}),
+        ('columns', {'columns': [[1, 2], ['0.5', '1.0']]}),
+    ])
+    def test_query_database_format(self, sysadmin, fmt, expected):
+        """Test the shapes of the rows in the response."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        query = "SELECT n, CAST(n / 2.0 AS numeric(3, 1)) AS amount FROM generate_series(1, 2) AS n"
+        result = helpers.call_action('query_database', context, query=query, format=fmt)
+
+        assert result['colnames'] == ['n', 'amount']
+        for key, value in expected.items():
+            assert result[key] == value
+
+    def test_query_database_invalid_format(self, sysadmin):
+        """Test that unknown formats are rejected."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            helpers.call_action('query_database', context, query='SELECT 1', format='xml')
+        assert 'format' in e.value.error_dict
+
+    @pytest.mark.ckan_config('ckanext.dbquery.max_result_bytes', 10000)
+    def test_query_database_max_result_bytes(self, sysadmin):
+        """Test that fetching stops before the rows go over the byte limit."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        query = "SELECT n, repeat('x', 1000) AS text FROM generate_series(1, 100) AS n"
+
+        result = helpers.call_action('query_database', context, query=query, limit=100)
+
+        assert 0 < len(result['rows']) < 100
+        assert result['truncated'] is True
+        assert result['bytes_capped'] is True
+        assert result['has_more'] is False
+        assert result['result_bytes'] <= 10000
+        assert '10000 bytes' in result['message']
+
+    def test_query_database_timings(self, sysadmin):
+        """Test that the response has the duration of each phase."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        result = helpers.call_action('query_database', context, query='SELECT 1 AS one')
+
+        assert set(result['timings']) == {'queue', 'execute', 'fetch', 'serialize', 'audit', 'total'}
+        assert result['timings']['total'] >= result['timings']['execute']
@@ -0,0 +1,31 @@
+from ckanext.dbquery import activity
+
+
+def _backend(pid, blocked_by=(), xact_age=None):
+    return {'pid': pid, 'blocked_by': list(blocked_by), 'xact_age': xact_age}
+
+
+def test_blocking_chains():
+    """Test that chains go from the backend holding the lock to each waiting one."""
+    backends = [_backend(1), _backend(2, [1]), _backend(3, [2]), _backend(4)]
+
+    chains = activity.blocking_chains(backends)
+
+    assert chains == [
+        {'pid': 2, 'root': 1, 'chain': [1, 2]},
+        {'pid': 3, 'root': 1, 'chain': [1, 2, 3]},
+    ]
+
+
+def test_blocking_chains_cycle():
+    """Test that deadlocked backends don't loop forever."""
+    chains = activity.blocking_chains([_backend(1, [2]), _backend(2, [1])])
+
+    assert [chain['chain'] for chain in chains] == [[2, 1], [1, 2]]
+
+
+def test_longest_transactions():
+    """Test that only backends in a transaction are listed, oldest first."""
+    backends = [_backend(1, xact_age=5.0), _backend(2), _backend(3, xact_age=60.0)]
+
+    assert [backend['pid'] for backend in activity.longest_transactions(backends)] == [3, 1]
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+from sqlalchemy.sql.expression import text
+from ckan import model
+from ckan.tests import helpers
+from ckan.plugins import toolkit
+
+from ckanext.dbquery import admission
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestAdmission:
+
+    def test_no_limits(self):
+        """Test that no slot is taken when there are no limits."""
+        slot = admission.acquire('some-user')
+        assert slot.conn is None
+        slot.release()
+
+    @pytest.mark.ckan_config('ckanext.dbquery.max_concurrent', 2)
+    @pytest.mark.ckan_config('ckanext.dbquery.max_concurrent_per_user', 1)
+    def test_slots_are_counted_and_released(self):
+        """Test that slots show up in the usage until they are released."""
+        with admission.acquire('user-a'), admission.acquire('user-b'):
+            usage = admission.usage('user-a')
+            assert usage['used'] == 2
+            assert usage['user_used'] == 1
+            assert usage['queued'] == 0
+            with pytest.raises(toolkit.ValidationError, match='2 of 2 query slots in use'):
+                admission.acquire('user-c', timeout=0)
+
+        assert admission.usage('user-a')['used'] == 0
+        admission.acquire('user-c', timeout=0).release()
+
+    @pytest.mark.ckan_config('ckanext.dbquery.max_concurrent', 1)
+    def test_slots_are_held_outside_ckan_pool(self):
+        """Test that the slot connections don't come from CKAN's pool."""
+        checked_out = model.meta.engine.pool.checkedout()
+        with admission.acquire('user-a') as slot:
+            assert slot.conn.engine is admission.get_lock_engine()
+            assert model.meta.engine.pool.checkedout() == checked_out
+
+    @pytest.mark.ckan_config('ckanext.dbquery.max_concurrent', 1)
+    @pytest.mark.ckan_config('ckanext.dbquery.max_queued', 1)
+    def test_queue_is_bounded(self):
+        """Test that requests are rejected at once when the queue is full."""
+        with admission.acquire('user-a'), admission.get_lock_engine().connect() as waiter:
+            # Another request waiting for a slot
+            waiter.execute(text('SELECT pg_advisory_lock_shared(:key, 0)'), key=admission.QUEUE_KEY)
+            started = time.monotonic()
+            with pytest.raises(toolkit.ValidationError, match='1 queued'):
+                admission.acquire('user-b', timeout=10)
+            assert time.monotonic() - started < 5
+            waiter.execute(text('SELECT pg_advisory_unlock_shared(:key, 0)'), key=admission.QUEUE_KEY)
+
+    @pytest.mark.ckan_config('ckanext.dbquery.max_concurrent_per_user', 1)
+    @pytest.mark.ckan_config('ckanext.dbquery.queue_timeout', 0)
+    def test_query_database_rejected_when_busy(self, sysadmin):
+        """Test that queries are rejected when the user has no free slot."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        with admission.acquire(sysadmin['id']):
+            with pytest.raises(toolkit.ValidationError, match='maximum per user'):
+                helpers.call_action('query_database', context, query='SELECT 1')
+            usage = helpers.call_action('dbquery_slot_usage', context)
+            assert usage['user_used'] == 1
+
+        result = helpers.call_action('query_database', context, query='SELECT 1 AS one')
+        assert result['rows'] == [{'one': 1}]
+        assert 'queue' in result['timings']
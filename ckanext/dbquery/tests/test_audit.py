@@ -0,0 +1,76 @@
+import time
+
+import pytest
+from ckan.tests import helpers
+from ckanext.dbquery.audit import AuditWriter
+from ckanext.dbquery.model import DBQueryExecuted
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestAuditWriter:
+
+    def test_flush_writes_batches(self, sysadmin):
+        """Test that queued records are written when the writer is flushed."""
+        writer = AuditWriter(batch_size=2, start_thread=False)
+        for i in range(3):
+            writer.record({'query': f'SELECT {i}', 'user_id': sysadmin['id'], 'row_count': 1})
+
+        assert helpers.model.Session.query(DBQueryExecuted).count() == 0
+        writer.flush()
+
+        saved = helpers.model.Session.query(DBQueryExecuted).all()
+        assert sorted(q.query for q in saved) == ['SELECT 0', 'SELECT 1', 'SELECT 2']
+        assert all(q.status == 'ok' for q in saved)
+        assert writer.dropped == 0
+
+    def test_full_queue_drops_records(self, sysadmin):
+        """Test that records are dropped and counted when the queue is full."""
+        writer = AuditWriter(queue_size=2, start_thread=False)
+        for i in range(3):
+            writer.record({'query': f'SELECT {i}', 'user_id': sysadmin['id']})
+
+        writer.flush()
+
+        assert writer.dropped == 1
+        assert helpers.model.Session.query(DBQueryExecuted).count() == 2
+
+    def test_background_thread(self, sysadmin):
+        """Test that the background thread writes the queued records."""
+        writer = AuditWriter(batch_size=1, flush_interval=0)
+        writer.record({'query': 'SELECT 1', 'user_id': sysadmin['id']})
+
+        # Wait up to 5 seconds for the background write
+        for _ in range(50):
+            if helpers.model.Session.query(DBQueryExecuted).count():
+                break
+            time.sleep(0.1)
+
+        assert helpers.model.Session.query(DBQueryExecuted).count() == 1
+
+    def test_close_writes_pending_batch(self, sysadmin):
+        """Test that closing the writer saves the batch the thread is still collecting."""
+        writer = AuditWriter(batch_size=10, flush_interval=60)
+        for i in range(3):
+            writer.record({'query': f'SELECT {i}', 'user_id': sysadmin['id']})
+        # Let the thread take the records off the queue
+        time.sleep(0.5)
+
+        writer.close()
+
+        assert not writer._thread.is_alive()
+        assert helpers.model.Session.query(DBQueryExecuted).count() == 3
+        assert writer.dropped == 0
+
+    def test_failed_batch_keeps_valid_records(self, sysadmin):
+        """Test that a record the INSERT rejects doesn't take its batch with it."""
+        writer = AuditWriter(batch_size=10, start_thread=False)
+        writer.record({'query': 'SELECT 1', 'user_id': sysadmin['id']})
+        # Violates NOT NULL
+        writer.record({'query': None, 'user_id': sysadmin['id']})
+        writer.record({'query': 'SELECT 2', 'user_id': sysadmin['id']})
+
+        writer.flush()
+
+        saved = helpers.model.Session.query(DBQueryExecuted).all()
+        assert sorted(q.query for q in saved) == ['SELECT 1', 'SELECT 2']
+        assert writer.dropped == 1
@@ -1,5 +1,9 @@
+import json
+
 import pytest
 from bs4 import BeautifulSoup
+from ckan.tests import helpers
+from ckanext.dbquery.model import DBQueryExecuted
 
 
 @pytest.mark.usefixtures("clean_db")
@@ -37,6 +41,95 @@ class TestDBQueryBlueprints:
         assert soup.find('table', class_='table') is not None
         assert soup.find('th', text='id') is not None
 
+    def test_index_server_timing(self, app, sysadmin):
+        """Test that the query page reports its phases in the Server-Timing header."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.post('/ckan-admin/db-query/', headers=headers, data={'query': 'SELECT 1 AS one'})
+
+        phases = {phase.split(';')[0] for phase in response.headers['Server-Timing'].split(', ')}
+        assert phases == {'action', 'queue', 'execute', 'fetch', 'serialize', 'audit', 'render'}
+
+    def test_index_results_grid(self, app, sysadmin):
+        """Test that single query results get the grid module with their first page."""
+        headers = {"Authorization": sysadmin['token']}
+        query = 'SELECT n FROM generate_series(1, :last) AS n'
+        response = app.post('/ckan-admin/db-query/', headers=headers, data={
+            'query': query, 'param.last': '3', 'timeout': '1000',
+        })
+
+        soup = BeautifulSoup(response.data, 'html.parser')
+        grid = soup.find('div', attrs={'data-module': 'dbquery-module'})
+        assert json.loads(grid['data-module-grid']) == {
+            'colnames': ['n'], 'rows': [[1], [2], [3]], 'offset': 0, 'limit': 100, 'has_more': False,
+            # The next pages are requested with the query that was run, not the form
+            'request': {'query': query, 'params': {'last': '3'}, 'timeout': '1000'},
+        }
+
+    def test_index_results_grid_duplicate_columns(self, app, sysadmin):
+        """Test that columns with the same name keep their own values in the grid."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.post('/ckan-admin/db-query/', headers=headers, data={'query': 'SELECT 1 AS id, 2 AS id'})
+
+        soup = BeautifulSoup(response.data, 'html.parser')
+        grid = soup.find('div', attrs={'data-module': 'dbquery-module'})
+        assert json.loads(grid['data-module-grid'])['rows'] == [[1, 2]]
+        assert [td.text for td in soup.find('table', class_='table').find_all('td')] == ['1', '2']
+
+    def test_index_no_grid_for_writes(self, app, sysadmin):
+        """Test that the rows returned by a write don't get the lazy loading grid."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.post('/ckan-admin/db-query/', headers=headers, data={
+            'query': 'UPDATE "user" SET about = about RETURNING id',
+        })
+
+        soup = BeautifulSoup(response.data, 'html.parser')
+        assert soup.find('div', attrs={'data-module': 'dbquery-module'}) is None
+        assert soup.find('table', class_='table') is not None
+
+    def test_rows_page(self, app, sysadmin):
+        """Test the JSON endpoint that returns the next pages of the grid."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.post('/ckan-admin/db-query/rows', headers=headers, data={
+            'query': 'SELECT n FROM generate_series(1, 10) AS n', 'offset': 4, 'limit': 3,
+        })
+
+        assert response.status_code == 200
+        assert response.json['colnames'] == ['n']
+        assert response.json['rows'] == [[5], [6], [7]]
+        assert response.json['has_more'] is True
+
+    def test_rows_page_invalid_query(self, app, sysadmin):
+        """Test that query errors are returned as JSON."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.post('/ckan-admin/db-query/rows', headers=headers, data={'query': 'SELECT * FROM missing_table'})
+
+        assert response.status_code == 400
+        assert 'error' in response.json
+
+    def test_rows_page_rejects_writes(self, app, sysadmin):
+        """Test that only SELECT queries can be paged, every page would run a write again."""
+        headers = {"Authorization": sysadmin['token']}
+        for query in ('UPDATE "user" SET about = about RETURNING id', 'SELECT 1; DELETE FROM package'):
+            response = app.post('/ckan-admin/db-query/rows', headers=headers, data={'query': query, 'offset': 1})
+
+            assert response.status_code == 400
+            assert 'error' in response.json
+
+    def test_schema_json(self, app, sysadmin):
+        """Test the schema catalog endpoint of the query editor."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.get('/ckan-admin/db-query/schema.json?refresh=true', headers=headers)
+
+        assert response.status_code == 200
+        assert response.json['cached'] is False
+        assert 'package' in [table['name'] for table in response.json['tables']]
+
+    def test_schema_json_not_authorized(self, app, normal_user):
+        """Test that non-sysadmin users can't read the schema catalog."""
+        auth = {"Authorization": normal_user['token']}
+        response = app.get('/ckan-admin/db-query/schema.json', headers=auth)
+        assert response.status_code == 403
+
     def test_history_not_authorized(self, app, normal_user):
         """Test that non-sysadmin users can't access the history page."""
         # Try to access the history page
@@ -61,3 +154,122 @@ class TestDBQueryBlueprints:
         # Check for query rows
         rows = soup.find_all('tr')
         assert len(rows) > 2  # Header + at least two query rows
+
+    @pytest.mark.ckan_config('ckanext.dbquery.history_page_size', 1)
+    def test_history_max_duration(self, app, sysadmin):
+        """Test that the history filters by max duration and keeps it in the next page link."""
+        for duration in (10, 20, 500):
+            DBQueryExecuted(query=f'SELECT {duration}', user_id=sysadmin['id'], duration_total=duration).save()
+        headers = {"Authorization": sysadmin['token']}
+
+        response = app.get('/ckan-admin/db-query/history?max_duration=100', headers=headers)
+
+        soup = BeautifulSoup(response.data, 'html.parser')
+        assert soup.find('input', attrs={'name': 'max_duration'})['value'] == '100'
+        assert 'SELECT 500' not in response.body
+        next_page = soup.find('a', href=lambda href: href and 'before=' in href)
+        assert 'max_duration=100' in next_page['href']
+
+    def test_workload(self, app, mock_executed_queries, sysadmin):
+        """Test that the workload page lists the queries aggregated by fingerprint."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.get('/ckan-admin/db-query/workload', headers=headers)
+        assert response.status_code == 200
+
+        soup = BeautifulSoup(response.data, 'html.parser')
+        assert soup.find('table', class_='workload') is not None
+
+    def test_export_not_authorized(self, app, normal_user):
+        """Test that non-sysadmin users can't export query results."""
+        auth = {"Authorization": normal_user['token']}
+        response = app.post('/ckan-admin/db-query/export.csv', headers=auth, data={
+            'query': 'SELECT 1 AS one'
+        })
+        assert response.status_code == 403
+
+    def test_export_csv(self, app, sysadmin):
+        """Test that query results are streamed as CSV and the query is saved."""
+        headers = {"Authorization": sysadmin['token']}
+        query = 'SELECT n, n * 2 AS double FROM generate_series(1, 3) AS n'
+        response = app.post('/ckan-admin/db-query/export.csv', headers=headers, data={'query': query})
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith('text/csv')
+
+        lines = response.get_data(as_text=True).splitlines()
+        assert lines == ['n,double', '1,2', '2,4', '3,6']
+
+        saved_query = helpers.model.Session.query(DBQueryExecuted).first()
+        assert saved_query.query == query
+
+    def test_export_ndjson(self, app, sysadmin):
+        """Test that query results are streamed as one JSON object per line."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.post('/ckan-admin/db-query/export.ndjson', headers=headers, data={
+            'query': 'SELECT n FROM generate_series(1, 2) AS n'
+        })
+        assert response.status_code == 200
+
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line) for line in lines] == [{'n': 1}, {'n': 2}]
+
+    def test_export_arrow(self, app, sysadmin):
+        """Test that query results are streamed as an Arrow IPC stream with their types."""
+        pyarrow = pytest.importorskip('pyarrow')
+        headers = {"Authorization": sysadmin['token']}
+        response = app.post('/ckan-admin/db-query/export.arrow', headers=headers, data={
+            'query': (
+                "SELECT n, CAST(n / 3.0 AS numeric(6, 2)) AS amount, "
+                "CAST('2024-01-01' AS timestamptz) AS created, json_build_object('n', n) AS data "
+                "FROM generate_series(1, 3) AS n"
+            )
+        })
+        assert response.status_code == 200
+
+        table = pyarrow.ipc.open_stream(response.get_data()).read_all()
+        assert table.schema.field('n').type == pyarrow.int32()
+        assert table.schema.field('amount').type == pyarrow.decimal128(6, 2)
+        assert table.schema.field('created').type == pyarrow.timestamp('us', tz='UTC')
+        assert table.schema.field('data').type == pyarrow.string()
+        assert table.column('n').to_pylist() == [1, 2, 3]
+        assert json.loads(table.column('data')[0].as_py()) == {'n': 1}
+
+    def test_export_parquet(self, app, sysadmin):
+        """Test that query results are exported as a Parquet file."""
+        pyarrow = pytest.importorskip('pyarrow')
+        import pyarrow.parquet
+        headers = {"Authorization": sysadmin['token']}
+        response = app.post('/ckan-admin/db-query/export.parquet', headers=headers, data={
+            'query': 'SELECT n FROM generate_series(1, 2500) AS n'
+        })
+        assert response.status_code == 200
+
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(response.get_data()))
+        assert table.num_rows == 2500
+        assert table.column('n').to_pylist()[-1] == 2500
+
+    def test_export_rejects_non_select(self, app, sysadmin):
+        """Test that only SELECT queries can be exported."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.post('/ckan-admin/db-query/export.csv', headers=headers, data={
+            'query': 'DELETE FROM package'
+        })
+        assert response.status_code == 400
+
+    def test_export_rejects_scripts(self, app, sysadmin):
+        """Test that a SELECT followed by other statements can't be exported."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.post('/ckan-admin/db-query/export.csv', headers=headers, data={
+            'query': 'SELECT 1; CREATE TABLE dbquery_export_test (value int)'
+        })
+        assert response.status_code == 400
+
+        result = helpers.call_action('query_database', {'user': sysadmin['name'], 'ignore_auth': False}, query=(
+            "SELECT count(*) AS count FROM pg_class WHERE relname = 'dbquery_export_test'"
+        ))
+        assert result['rows'][0]['count'] == 0
+
+    def test_export_get_not_allowed(self, app, sysadmin):
+        """Test that exports can't be triggered by a link."""
+        headers = {"Authorization": sysadmin['token']}
+        response = app.get('/ckan-admin/db-query/export.csv?query=SELECT+1', headers=headers)
+        assert response.status_code == 405
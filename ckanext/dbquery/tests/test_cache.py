@@ -0,0 +1,33 @@
+from ckanext.dbquery.cache import ResultCache
+
+
+class TestResultCache:
+
+    def test_get_expired(self):
+        """Test that entries older than the TTL are not returned."""
+        cache = ResultCache()
+        cache.set('a', 1, size=10, max_bytes=100)
+
+        assert cache.get('a', ttl=60)[0] == 1
+        assert cache.get('a', ttl=-1) is None
+        assert len(cache) == 0
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entries are evicted first."""
+        cache = ResultCache()
+        cache.set('a', 1, size=40, max_bytes=100)
+        cache.set('b', 2, size=40, max_bytes=100)
+        cache.get('a', ttl=60)
+        cache.set('c', 3, size=40, max_bytes=100)
+
+        assert cache.get('b', ttl=60) is None
+        assert cache.get('a', ttl=60)[0] == 1
+        assert cache.get('c', ttl=60)[0] == 3
+        assert cache.size == 80
+
+    def test_entry_over_budget(self):
+        """Test that entries bigger than the memory budget are not stored."""
+        cache = ResultCache()
+        cache.set('a', 1, size=200, max_bytes=100)
+
+        assert cache.get('a', ttl=60) is None
@@ -0,0 +1,63 @@
+import datetime
+
+import pytest
+from ckan import model
+from ckanext.dbquery import partitions
+from ckanext.dbquery.model import DBQueryExecuted
+
+
+def test_month_arithmetic():
+    """Test the month helpers used to name and expire partitions."""
+    month = partitions.month_start(datetime.date(2024, 11, 17))
+    assert month == datetime.date(2024, 11, 1)
+    assert partitions.add_months(month, 2) == datetime.date(2025, 1, 1)
+    assert partitions.add_months(month, -11) == datetime.date(2023, 12, 1)
+    assert partitions.partition_name(month) == 'dbquery_executed_p202411'
+    assert partitions.partition_month('dbquery_executed_p202411') == month
+    assert partitions.partition_month('dbquery_executed_default') is None
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestPartitions:
+
+    def test_ensure_partitions(self):
+        """Test that the partitions of the current and next months are created once."""
+        created = partitions.ensure_partitions(months_ahead=2, today=datetime.date(2001, 5, 20))
+        assert created == ['dbquery_executed_p200105', 'dbquery_executed_p200106', 'dbquery_executed_p200107']
+        assert partitions.ensure_partitions(months_ahead=2, today=datetime.date(2001, 5, 20)) == []
+
+    def test_ensure_partitions_since(self):
+        """Test that the partitions of past months are created from the given start month."""
+        created = partitions.ensure_partitions(
+            months_ahead=0, today=datetime.date(2001, 5, 20), since=datetime.date(2001, 3, 31),
+        )
+        assert created == ['dbquery_executed_p200103', 'dbquery_executed_p200104', 'dbquery_executed_p200105']
+
+    def test_purge_drops_expired_partitions(self):
+        """Test that purge drops the partitions older than the retention and keeps the rest."""
+        partitions.ensure_partitions(months_ahead=1, today=datetime.date(2001, 1, 1))
+        for day in (datetime.datetime(2001, 1, 10), datetime.datetime(2001, 2, 10)):
+            DBQueryExecuted(query='SELECT 1', user_id='test', timestamp=day).save()
+        # Release the session locks on the audit table, detaching a partition waits for them
+        model.Session.close()
+
+        today = datetime.date(2001, 3, 15)
+        assert partitions.purge(1, dry_run=True, today=today) == [('dbquery_executed_p200101', 'expired')]
+        assert model.Session.query(DBQueryExecuted).count() == 2
+
+        done = partitions.purge(1, today=today)
+        assert done == [('dbquery_executed_p200101', 'detached'), ('dbquery_executed_p200101', 'dropped')]
+        model.Session.expire_all()
+        assert [row.timestamp for row in model.Session.query(DBQueryExecuted)] == [datetime.datetime(2001, 2, 10)]
+        with model.meta.engine.connect() as conn:
+            assert 'dbquery_executed_p200101' not in partitions.list_partitions(conn)
+
+    def test_purge_default_partition(self):
+        """Test that expired rows out of any month partition are deleted from the default partition."""
+        DBQueryExecuted(query='SELECT 1', user_id='test', timestamp=datetime.datetime(1990, 1, 1)).save()
+
+        done = partitions.purge(12, today=datetime.date(2001, 1, 1))
+
+        assert ('dbquery_executed_default', '1 rows deleted') in done
+        model.Session.expire_all()
+        assert model.Session.query(DBQueryExecuted).count() == 0
@@ -0,0 +1,81 @@
+import pytest
+from sqlalchemy.sql.expression import text
+
+from ckanext.dbquery import execution, prepared
+
+
+def _server_prepared(conn):
+    return conn.execute(text('SELECT name FROM pg_prepared_statements')).scalars().all()
+
+
+class TestPreparedStatements:
+
+    def test_statement_is_prepared_once(self):
+        """Test that repeated executions of a statement shape reuse its prepared statement."""
+        query = 'SELECT n FROM generate_series(1, 10) AS n WHERE n > :min'
+        with execution.connect(query) as conn:
+            first = execution.run(conn, query, params={'min': 8}).scalars().all()
+            second = execution.run(conn, query, params={'min': 9}).scalars().all()
+            names = prepared.prepared_statements(conn)
+            server_names = _server_prepared(conn)
+
+        assert first == [9, 10]
+        assert second == [10]
+        assert len(names) == 1
+        assert names[0] in server_names
+
+    @pytest.mark.ckan_config('ckanext.dbquery.prepared_cache_size', 1)
+    def test_least_recently_used_statement_is_deallocated(self):
+        """Test that the cache is bounded and deallocates the evicted statements."""
+        first = 'SELECT CAST(:value AS int) + 1'
+        second = 'SELECT CAST(:value AS int) + 2'
+        with execution.connect(first) as conn:
+            execution.run(conn, first, params={'value': 1})
+            evicted = prepared.prepared_statements(conn)[0]
+            assert execution.run(conn, second, params={'value': 1}).scalar() == 3
+            names = prepared.prepared_statements(conn)
+            server_names = _server_prepared(conn)
+
+        assert names == [prepared.statement_name(second.replace(':value', '$1'))]
+        assert evicted not in server_names
+
+    def test_unpreparable_statement_runs_inlined(self):
+        """Test that statements PostgreSQL can't prepare still run."""
+        # The type of $1 can't be inferred
+        query = 'SELECT :value AS value'
+        with execution.connect(query) as conn:
+            assert execution.run(conn, query, params={'value': 'x'}).scalar() == 'x'
+            assert prepared.prepared_statements(conn) == []
+
+    def test_streamed_statement_is_not_prepared(self):
+        """Test that streamed statements with parameters run on a server-side cursor."""
+        query = 'SELECT n FROM generate_series(1, 10) AS n WHERE n > :min'
+        with execution.connect(query) as conn:
+            result = execution.run(conn, query, stream=True, params={'min': 8})
+            rows = result.scalars().all()
+            names = prepared.prepared_statements(conn)
+
+        assert rows == [9, 10]
+        assert names == []
+
+    def test_failed_statement_is_deallocated(self):
+        """Test that a prepared statement is prepared again after its EXECUTE fails."""
+        query = 'SELECT * FROM dbquery_prepared_test WHERE value > :min'
+        # One connection, the prepared statements belong to its session
+        with execution.get_engine().connect() as conn:
+            with conn.begin():
+                conn.execute(text('CREATE TABLE dbquery_prepared_test (value int)'))
+            try:
+                with conn.begin():
+                    execution.run(conn, query, params={'min': 0})
+                    conn.execute(text('ALTER TABLE dbquery_prepared_test ADD COLUMN other int'))
+                # The cached plan returns a different row type now
+                with pytest.raises(Exception):
+                    with conn.begin():
+                        execution.run(conn, query, params={'min': 0})
+                with conn.begin():
+                    result = execution.run(conn, query, params={'min': 0})
+                    assert list(result.keys()) == ['value', 'other']
+            finally:
+                with conn.begin():
+                    conn.execute(text('DROP TABLE dbquery_prepared_test'))
@@ -0,0 +1,110 @@
+import datetime
+
+import pytest
+from ckan.tests import helpers
+from ckan.plugins import toolkit
+from ckanext.dbquery import jobs
+from ckanext.dbquery.jobs import refresh_due_queries
+from ckanext.dbquery.model import DBQuerySaved
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestSavedQueries:
+
+    def test_saved_query_not_authorized(self, normal_user):
+        """Test that non-sysadmin users can't save queries."""
+        context = {'user': normal_user['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_action('dbquery_saved_create', context, name='packages', query='SELECT 1')
+
+    def test_refresh_stores_snapshot(self, sysadmin):
+        """Test that a refresh stores the query results as the snapshot."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        saved = helpers.call_action(
+            'dbquery_saved_create', context, name='numbers', query='SELECT n FROM generate_series(1, 3) AS n'
+        )
+        assert saved['snapshot_taken'] is None
+        assert helpers.call_action('dbquery_saved_show', context, id=saved['id'])['snapshot'] is None
+
+        helpers.call_action('dbquery_saved_refresh', context, id=saved['id'])
+
+        shown = helpers.call_action('dbquery_saved_show', context, id=saved['id'])
+        assert shown['snapshot_status'] == 'ok'
+        assert shown['snapshot_age'] >= 0
+        assert [row['n'] for row in shown['snapshot']['rows']] == [1, 2, 3]
+
+    def test_failed_refresh_keeps_snapshot(self, sysadmin):
+        """Test that a failed refresh records the error and keeps the previous snapshot."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        saved = helpers.call_action('dbquery_saved_create', context, name='one', query='SELECT 1 AS one')
+        helpers.call_action('dbquery_saved_refresh', context, id=saved['id'])
+        # Break the query behind the API's back, an update would discard the snapshot
+        saved_obj = DBQuerySaved.get(saved['id'])
+        saved_obj.query = 'SELECT * FROM non_existent_table'
+        saved_obj.save()
+
+        refreshed = helpers.call_action('dbquery_saved_refresh', context, id=saved['id'])
+
+        assert refreshed['snapshot_status'] == 'error'
+        assert 'non_existent_table' in refreshed['snapshot_error']
+        assert refreshed['snapshot']['rows'] == [{'one': 1}]
+
+    def test_update_discards_snapshot(self, sysadmin):
+        """Test that changing the SQL of a saved query discards its snapshot."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        saved = helpers.call_action('dbquery_saved_create', context, name='one', query='SELECT 1 AS one')
+        helpers.call_action('dbquery_saved_refresh', context, id=saved['id'])
+
+        updated = helpers.call_action('dbquery_saved_update', context, id=saved['id'], query='SELECT 2 AS two')
+
+        assert updated['name'] == 'one'
+        assert updated['snapshot_taken'] is None
+
+    def test_duplicate_name(self, sysadmin):
+        """Test that saved query names are unique."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        helpers.call_action('dbquery_saved_create', context, name='one', query='SELECT 1')
+        with pytest.raises(toolkit.ValidationError) as e:
+            helpers.call_action('dbquery_saved_create', context, name='one', query='SELECT 2')
+        assert 'name' in e.value.error_dict
+
+    def test_refresh_due_queries(self, sysadmin):
+        """Test that only the queries whose interval has passed are refreshed."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        due = helpers.call_action('dbquery_saved_create', context, name='due', query='SELECT 1', refresh_interval=5)
+        fresh = helpers.call_action('dbquery_saved_create', context, name='fresh', query='SELECT 2', refresh_interval=5)
+        helpers.call_action('dbquery_saved_create', context, name='manual', query='SELECT 3')
+        fresh_obj = DBQuerySaved.get(fresh['id'])
+        fresh_obj.snapshot_taken = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        fresh_obj.save()
+
+        refreshed = refresh_due_queries()
+
+        assert [saved.id for saved in refreshed] == [due['id']]
+        assert len(refresh_due_queries(refresh_all=True)) == 3
+
+    def test_refresh_due_queries_unexpected_error(self, sysadmin, monkeypatch):
+        """Test that any error is recorded on its saved query and the others are still refreshed."""
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        failing = helpers.call_action('dbquery_saved_create', context, name='a', query='SELECT 1', refresh_interval=5)
+        working = helpers.call_action('dbquery_saved_create', context, name='b', query='SELECT 2', refresh_interval=5)
+        query_database = jobs.toolkit.get_action('query_database')
+
+        def flaky_query_database(context, data_dict):
+            if data_dict['query'] == 'SELECT 1':
+                raise RuntimeError('connection lost')
+            return query_database(context, data_dict)
+
+        monkeypatch.setattr(jobs.toolkit, 'get_action', lambda name: flaky_query_database)
+        refreshed = refresh_due_queries()
+
+        assert [saved.id for saved in refreshed] == [failing['id'], working['id']]
+        assert DBQuerySaved.get(failing['id']).snapshot_status == DBQuerySaved.STATUS_ERROR
+        assert 'connection lost' in DBQuerySaved.get(failing['id']).snapshot_error
+        assert DBQuerySaved.get(working['id']).snapshot_status == DBQuerySaved.STATUS_OK
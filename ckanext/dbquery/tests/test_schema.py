@@ -0,0 +1,93 @@
+from ckanext.dbquery import schema
+from ckanext.dbquery.schema import SchemaCache
+
+
+class _Result:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def mappings(self):
+        return self.rows
+
+
+class _Connection:
+    """ Returns the rows of the tables, columns and indexes queries in turn """
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def execute(self, statement):
+        return _Result(self.results.pop(0))
+
+
+def test_introspect_skips_unknown_relations():
+    """Test that columns and indexes of tables created after the tables query are left out."""
+    conn = _Connection(
+        [{'oid': 1, 'schema': 'public', 'name': 'package', 'kind': 'r', 'row_estimate': -1, 'comment': None}],
+        [
+            {'oid': 1, 'name': 'id', 'type': 'text', 'nullable': False, 'default': None},
+            {'oid': 2, 'name': 'id', 'type': 'integer', 'nullable': False, 'default': None},
+        ],
+        [{'oid': 2, 'name': 'new_pkey', 'primary': True, 'unique': True, 'definition': ''}],
+    )
+
+    tables = schema.introspect(conn)
+
+    assert [table['name'] for table in tables] == ['package']
+    assert tables[0]['kind'] == 'table'
+    assert tables[0]['row_estimate'] is None
+    assert [column['type'] for column in tables[0]['columns']] == ['text']
+    assert tables[0]['indexes'] == []
+
+
+class TestSchemaCache:
+
+    def test_get_cached(self):
+        """Test that the catalog is loaded once per TTL."""
+        cache = SchemaCache()
+        loads = []
+
+        def load():
+            loads.append(1)
+            return [{'name': 'package'}]
+
+        catalog, age = cache.get(load, ttl=60)
+        cached, cached_age = cache.get(load, ttl=60)
+
+        assert catalog['tables'] == [{'name': 'package'}]
+        assert age is None
+        assert cached is catalog
+        assert cached_age >= 0
+        assert len(loads) == 1
+
+    def test_get_expired(self):
+        """Test that expired catalogs are loaded again."""
+        cache = SchemaCache()
+        cache.get(lambda: ['old'], ttl=60)
+
+        catalog, age = cache.get(lambda: ['new'], ttl=-1)
+
+        assert catalog['tables'] == ['new']
+        assert age is None
+
+    def test_no_ttl(self):
+        """Test that the catalog isn't kept without a TTL."""
+        cache = SchemaCache()
+        cache.get(lambda: ['old'], ttl=0)
+
+        assert cache.get(lambda: ['new'], ttl=60)[0]['tables'] == ['new']
+
+    def test_invalidate(self):
+        """Test that invalidating drops the catalog, also the one being loaded."""
+        cache = SchemaCache()
+        cache.get(lambda: ['old'], ttl=60)
+        cache.invalidate()
+
+        def load():
+            # DDL running while the catalog is read
+            cache.invalidate()
+            return ['during']
+
+        assert cache.get(load, ttl=60)[0]['tables'] == ['during']
+        assert cache.get(lambda: ['new'], ttl=60)[0]['tables'] == ['new']
@@ -0,0 +1,24 @@
+from ckanext.dbquery import search
+
+
+def test_terms():
+    """Test that search terms are split on whitespace without case-insensitive duplicates."""
+    assert search.terms('  resource_view  SELECT select ') == ['resource_view', 'SELECT']
+    assert search.terms(None) == []
+
+
+def test_like_pattern_escapes_wildcards():
+    """Test that LIKE wildcards in a term are matched literally."""
+    assert search.like_pattern('100%_a\\b') == '%100\\%\\_a\\\\b%'
+
+
+def test_highlight():
+    """Test that matches are marked case-insensitively and the rest is HTML-escaped."""
+    result = search.highlight('SELECT * FROM package WHERE x < 1', 'select pack')
+    assert str(result) == '<mark>SELECT</mark> * FROM <mark>pack</mark>age WHERE x &lt; 1'
+
+
+def test_highlight_escapes_matches():
+    """Test that highlighted matches are HTML-escaped too."""
+    assert str(search.highlight('a <b> c', '<b>')) == 'a <mark>&lt;b&gt;</mark> c'
+    assert str(search.highlight('<b>', '')) == '&lt;b&gt;'
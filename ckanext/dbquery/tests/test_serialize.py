@@ -0,0 +1,66 @@
+import datetime
+import decimal
+import uuid
+
+import pytest
+
+from ckanext.dbquery import serialize
+
+
+COLNAMES = ['id', 'amount', 'created', 'data']
+ROWS = [
+    (uuid.UUID(int=1), decimal.Decimal('1.50'), datetime.datetime(2024, 1, 2, 3, 4, 5), b'\x01\xff'),
+    (None, None, None, None),
+]
+
+
+class TestShape:
+
+    def test_records(self):
+        """Test that records keep the values as returned by the database."""
+        assert serialize.shape(COLNAMES, ROWS, 'records') == {
+            'rows': [dict(zip(COLNAMES, ROWS[0])), dict.fromkeys(COLNAMES)],
+        }
+
+    def test_rows(self):
+        """Test that rows are lists of JSON-safe values."""
+        assert serialize.shape(COLNAMES, ROWS, 'rows') == {
+            'rows': [
+                ['00000000-0000-0000-0000-000000000001', '1.50', '2024-01-02T03:04:05', '\\x01ff'],
+                [None, None, None, None],
+            ],
+        }
+
+    def test_columns(self):
+        """Test that columns are lists of JSON-safe values."""
+        assert serialize.shape(COLNAMES, ROWS, 'columns') == {
+            'columns': [
+                ['00000000-0000-0000-0000-000000000001', None],
+                ['1.50', None],
+                ['2024-01-02T03:04:05', None],
+                ['\\x01ff', None],
+            ],
+        }
+
+    @pytest.mark.parametrize('fmt', serialize.FORMATS)
+    def test_empty_result(self, fmt):
+        """Test the shapes of a result without rows."""
+        data = serialize.shape(COLNAMES, [], fmt)
+        assert serialize.count(data) == 0
+
+    def test_arrays(self):
+        """Test that the items of arrays are converted too."""
+        rows = [([decimal.Decimal('2'), None],)]
+        assert serialize.shape(['values'], rows, 'rows') == {'rows': [[['2', None]]]}
+
+    def test_mixed_json(self):
+        """Test that json values of different types are each converted by their own type."""
+        rows = [([1, 2],), ({'a': 1, 'b': 2},), ('x',), ([decimal.Decimal('2')],)]
+        expected = [[[1, 2]], [{'a': 1, 'b': 2}], ['x'], [['2']]]
+        assert serialize.to_rows(rows, 1) == expected
+        assert serialize.to_columns(rows, 1) == [[row[0] for row in expected]]
+
+    def test_mixed_scalars(self):
+        """Test that the converter of the first value isn't applied to values of other types."""
+        rows = [(decimal.Decimal('1.5'),), ([1],), ('x',)]
+        assert serialize.to_rows(rows, 1) == [['1.5'], [[1]], ['x']]
@@ -0,0 +1,108 @@
+import pytest
+
+from ckanext.dbquery import sql
+
+
+class TestSplitStatements:
+
+    def test_split(self):
+        """Test that scripts are split on semicolons."""
+        script = "SELECT 1; UPDATE package SET name = name;\n-- comment only;\n"
+        assert sql.split_statements(script) == ['SELECT 1', 'UPDATE package SET name = name']
+
+    def test_semicolons_in_literals_and_comments(self):
+        """Test that semicolons inside literals, identifiers and comments don't split."""
+        script = """SELECT 'a;b', "c;d" /* e; */ FROM t; DO $fn$ BEGIN; END $fn$"""
+        assert sql.split_statements(script) == [
+            """SELECT 'a;b', "c;d" /* e; */ FROM t""",
+            'DO $fn$ BEGIN; END $fn$',
+        ]
+
+
+class TestClassify:
+
+    @pytest.mark.parametrize('statement,kind', [
+        ('SELECT * FROM package', 'select'),
+        ('  -- comment\n(SELECT 1)', 'select'),
+        ('WITH p AS (SELECT 1) SELECT * FROM p', 'select'),
+        ('VALUES (1), (2)', 'select'),
+        ("SELECT 'delete into' FROM package", 'select'),
+        ('WITH d AS (DELETE FROM package RETURNING id) SELECT * FROM d', 'dml'),
+        ('INSERT INTO package (id) VALUES (1)', 'dml'),
+        ('update package set name = name', 'dml'),
+        ('SELECT * INTO package_copy FROM package', 'ddl'),
+        ('CREATE INDEX idx ON package (name)', 'ddl'),
+        ('DROP TABLE package_copy', 'ddl'),
+        ('SET statement_timeout = 0', 'utility'),
+        ('VACUUM ANALYZE package', 'utility'),
+    ])
+    def test_classify(self, statement, kind):
+        """Test the statement kinds."""
+        assert sql.classify(statement) == kind
+
+
+class TestBindParams:
+
+    def test_bind_names(self):
+        """Test that placeholders in literals, comments and casts are ignored."""
+        query = "SELECT :a, ':b', x::int, :c::text /* :d */ FROM t WHERE y = :a -- :e"
+        assert sql.bind_names(query) == ['a']
+
+    def test_to_positional(self):
+        """Test that placeholders are replaced by their $n position."""
+        query = "SELECT * FROM t WHERE a = :a AND b = ':a' AND c = :b OR a = :a"
+        assert sql.to_positional(query, ['a', 'b']) == "SELECT * FROM t WHERE a = $1 AND b = ':a' AND c = $2 OR a = $1"
+
+    @pytest.mark.parametrize('statement,preparable', [
+        ('SELECT * FROM package WHERE name = :name', True),
+        ('UPDATE package SET title = :title', True),
+        ('SELECT * INTO package_copy FROM package', False),
+        ("COPY package TO STDOUT", False),
+        ('SET statement_timeout = 0', False),
+    ])
+    def test_is_preparable(self, statement, preparable):
+        """Test which statements can be prepared."""
+        assert sql.is_preparable(statement) is preparable
+
+
+class TestNormalize:
+
+    def test_normalize(self):
+        """Test that comments and whitespace are removed, but not inside literals."""
+        query = "SELECT  'a  b' AS \"x  y\" /* note */\n FROM package -- latest\n;"
+        assert sql.normalize(query) == "SELECT 'a  b' AS \"x  y\" FROM package"
+
+    def test_line_comment_end_is_kept(self):
+        """Test that a line comment doesn't swallow the next line in the cache key."""
+        assert sql.normalize('SELECT 1 AS a -- c\n, 2 AS b') != sql.normalize('SELECT 1 AS a -- c , 2 AS b')
+        assert sql.normalize('SELECT 1 AS a -- c\n, 2 AS b') == 'SELECT 1 AS a , 2 AS b'
+
+    def test_dollar_quoted_literals_are_kept(self):
+        """Test that whitespace in dollar-quoted literals is kept."""
+        assert sql.normalize('SELECT $$a  b$$') != sql.normalize('SELECT $$a b$$')
+
+
+class TestFingerprint:
+
+    def test_fingerprint_text(self):
+        """Test that constants, comments, case and whitespace are normalized."""
+        query = "SELECT  *\n FROM Package -- latest\n WHERE id IN (1, 2, 3) AND name = 'x' AND n > :n AND \"Title\" = 1.5;"
+        assert sql.fingerprint_text(query) == 'select * from package where id in (...) and name = ? and n > ? and "Title" = ?'
+
+    @pytest.mark.parametrize('a,b', [
+        ("SELECT * FROM package WHERE name = 'a'", "select * from package where name='b'"),
+        ('SELECT * FROM t WHERE id IN (1, 2)', 'SELECT * FROM t WHERE id IN (3,4,5)'),
+        ("SELECT $$a$$, 1e3", "SELECT 'b', 42"),
+    ])
+    def test_same_fingerprint(self, a, b):
+        """Test that statements differing only in constants and formatting share the fingerprint."""
+        assert sql.fingerprint(a) == sql.fingerprint(b)
+
+    @pytest.mark.parametrize('a,b', [
+        ('SELECT * FROM package', 'SELECT * FROM resource'),
+        ('SELECT "A" FROM t', 'SELECT "a" FROM t'),
+        ('SELECT col1 FROM t', 'SELECT col2 FROM t'),
+    ])
+    def test_different_fingerprint(self, a, b):
+        """Test that identifiers are part of the fingerprint."""
+        assert sql.fingerprint(a) != sql.fingerprint(b)
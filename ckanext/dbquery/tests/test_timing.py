@@ -0,0 +1,56 @@
+import json
+import logging
+
+import pytest
+
+from ckanext.dbquery import timing
+
+
+class TestTimer:
+
+    def test_phases(self):
+        """Test that phases are timed in milliseconds and repeated ones are summed up."""
+        timer = timing.Timer()
+        timer.add('execute', 1.5)
+        timer.add('execute', 2)
+        timer.add('fetch', None)
+        with timer.phase('render'):
+            pass
+
+        assert timer.as_dict()['execute'] == 3.5
+        assert 'fetch' not in timer.as_dict()
+        assert timer.server_timing().startswith('execute;dur=3.5, render;dur=')
+
+
+class TestExecutionLog:
+
+    def test_log_line(self, caplog):
+        """Test that executions are logged as one JSON line."""
+        with caplog.at_level(logging.INFO, logger='ckanext.dbquery.timing'):
+            timing.log_execution('SELECT 1', 'user-id', 'ok', 1, {'execute': 1.0})
+
+        record = json.loads(caplog.records[-1].getMessage())
+        assert record['event'] == 'dbquery.execution'
+        assert record['timings'] == {'execute': 1.0}
+
+    @pytest.mark.ckan_config('ckanext.dbquery.timing_log_sample_rate', '0')
+    def test_log_disabled(self, caplog):
+        """Test that a 0 sample rate disables the log."""
+        with caplog.at_level(logging.INFO, logger='ckanext.dbquery.timing'):
+            timing.log_execution('SELECT 1', 'user-id', 'ok', 1, {'execute': 1.0})
+
+        assert not caplog.records
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestProfile:
+
+    def test_profile_dump(self, app, sysadmin, ckan_config, monkeypatch, tmp_path):
+        """Test that a request with profile=1 dumps its cProfile stats."""
+        monkeypatch.setitem(ckan_config, 'ckanext.dbquery.profile_dir', str(tmp_path))
+        headers = {"Authorization": sysadmin['token']}
+
+        response = app.get('/ckan-admin/db-query/history?profile=1', headers=headers)
+
+        assert response.status_code == 200
+        assert [path.name.startswith('dbquery-history-') for path in tmp_path.iterdir()] == [True]
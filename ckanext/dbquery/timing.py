@@ -0,0 +1,104 @@
+"""
+Timing breakdown of the query pipeline: phase timers, the `Server-Timing`
+response header, a structured (JSON) log line per execution and opt-in
+cProfile dumps of single requests.
+"""
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import logging
+import os
+import random
+import time
+
+from ckan.plugins import toolkit
+
+
+log = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """ Durations of the phases of a request, in milliseconds """
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time the code run in this context as the `name` phase """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - started) * 1000)
+
+    def add(self, name, duration):
+        """ Add milliseconds to a phase, phases run several times are summed up """
+        if duration is None:
+            return
+        self.phases[name] = round(self.phases.get(name, 0) + duration, 3)
+
+    def update(self, timings):
+        for name, duration in (timings or {}).items():
+            self.add(name, duration)
+
+    def as_dict(self):
+        return dict(self.phases)
+
+    def server_timing(self):
+        """ Value of the Server-Timing header """
+        return ', '.join(f'{name};dur={duration}' for name, duration in self.phases.items())
+
+
+def set_server_timing(response, timer):
+    """ Add the Server-Timing header to a Flask response """
+    if timer.phases:
+        response.headers['Server-Timing'] = timer.server_timing()
+    return response
+
+
+def log_execution(query, user_id, status, row_count, timings):
+    """
+    Write a JSON log line with the timings of a query execution. Only the
+    fraction of the executions set in ``ckanext.dbquery.timing_log_sample_rate``
+    is logged.
+    """
+    sample_rate = float(toolkit.config.get('ckanext.dbquery.timing_log_sample_rate') or 0)
+    if not sample_rate or random.random() >= sample_rate:
+        return
+    log.info(json.dumps({
+        'event': 'dbquery.execution',
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'user_id': user_id,
+        'status': status,
+        'row_count': row_count,
+        'timings': timings,
+        'query': query,
+    }, default=str))
+
+
+def profiled(view):
+    """
+    Decorator for views: with ``ckanext.dbquery.profile_dir`` set, a sysadmin
+    request with `profile=1` runs under cProfile and the stats are dumped to
+    a `.prof` file in that directory (open it with snakeviz or pstats).
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        directory = toolkit.config.get('ckanext.dbquery.profile_dir')
+        user = toolkit.c.userobj
+        wanted = toolkit.asbool(toolkit.request.values.get('profile'))
+        if not (directory and wanted and user and user.sysadmin):
+            return view(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(view, *args, **kwargs)
+        finally:
+            timestamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+            path = os.path.join(directory, f'dbquery-{view.__name__}-{timestamp}.prof')
+            profiler.dump_stats(path)
+            log.info(f'Profile of the {view.__name__} view saved in {path}')
+    return wrapper